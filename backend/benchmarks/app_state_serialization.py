@@ -0,0 +1,71 @@
+"""
+AppState (de)serialization benchmark
+
+Compares the legacy full JSON payload (with app_state embedded into every session)
+with the storage codecs of AppState.dump_for_storage / AppState.load_from_storage.
+
+Usage (on backend directory):
+    python -m benchmarks.app_state_serialization --handled-orders 300 --repeat 10
+"""
+
+import argparse
+import functools
+import importlib.util
+import statistics
+import time
+import typing
+
+import benchmarks.fixtures as fixtures
+import src.models as models
+
+
+def measure(func: typing.Callable[[], typing.Any], repeat: int) -> float:
+    """Returns median time in milliseconds"""
+    elapsed: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--handled-orders", type=int, default=fixtures.HANDLED_ORDER_COUNT)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    codecs: list[models.AppStateCodec] = ["json"]
+    if importlib.util.find_spec("msgpack"):
+        codecs.append("msgpack")
+
+    print(f"{'sessions':>8} {'format':>12} {'size(KiB)':>10} {'dump(ms)':>10} {'load(ms)':>10}")
+    for session_count in fixtures.SESSION_COUNTS:
+        app_state = fixtures.build_app_state(session_count, args.handled_orders)
+
+        legacy = app_state.model_dump_json()
+        results = {
+            "legacy-json": (
+                len(legacy.encode()),
+                measure(app_state.model_dump_json, args.repeat),
+                measure(functools.partial(models.AppState.model_validate_json, legacy), args.repeat),
+            )
+        }
+        for codec in codecs:
+            data = app_state.dump_for_storage(codec=codec)
+            results[codec] = (
+                len(data),
+                measure(functools.partial(app_state.dump_for_storage, codec=codec), args.repeat),
+                measure(functools.partial(models.AppState.load_from_storage, data), args.repeat),
+            )
+
+        for name, (size, dump_ms, load_ms) in results.items():
+            print(f"{session_count:>8} {name:>12} {size / 1024:>10.1f} {dump_ms:>10.2f} {load_ms:>10.2f}")
+
+        session_state = next(iter(app_state.sessions.values())).state
+        session_dump_ms = measure(lambda: session_state.model_dump(mode="json"), args.repeat)  # noqa: B023
+        print(f"{session_count:>8} {'ws-session':>12} {'':>10} {session_dump_ms:>10.2f} {'':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import importlib.util
+import json
+
+import benchmarks.fixtures as fixtures
+import pytest
+import pytest_benchmark.fixture
+import src.models as models
+
+SEARCH_RESPONSE_ORDER_COUNT = 200
+CODECS: list[models.AppStateCodec] = ["json"] + (["msgpack"] if importlib.util.find_spec("msgpack") else [])
+
+
+@pytest.fixture(scope="module")
+def search_response() -> bytes:
+    orders = [fixtures.build_order(priced_option_count=8) for _ in range(SEARCH_RESPONSE_ORDER_COUNT)]
+    return json.dumps([o.model_dump(mode="json") for o in orders]).encode()
+
+
+def bench_order_validation(benchmark: pytest_benchmark.fixture.BenchmarkFixture, search_response: bytes) -> None:
+    # Same as ShopAPIConfig.search_orders
+    orders = benchmark(lambda: [models.OrderDTO.model_validate(o) for o in json.loads(search_response)])
+    assert [o.model_dump(mode="json") for o in orders] == json.loads(search_response)
+
+
+@pytest.fixture(scope="module", params=fixtures.SESSION_COUNTS)
+def app_state(request: pytest.FixtureRequest) -> models.AppState:
+    # Loaded once from the storage, as the validation normalizes some fields, e.g. the trailing slash of URLs.
+    return models.AppState.load_from_storage(fixtures.build_app_state(session_count=request.param).dump_for_storage())
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def bench_app_state_dump(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture, app_state: models.AppState, codec: models.AppStateCodec
+) -> None:
+    data = benchmark(app_state.dump_for_storage, codec)
+    assert models.AppState.load_from_storage(data).dump_for_storage(codec) == data
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def bench_app_state_load(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture, app_state: models.AppState, codec: models.AppStateCodec
+) -> None:
+    data = app_state.dump_for_storage(codec)
+    loaded = benchmark(models.AppState.load_from_storage, data)
+    assert loaded.dump_for_storage(codec) == data
@@ -0,0 +1,128 @@
+import json
+import typing
+
+import benchmarks.fixtures as fixtures
+import PIL.Image
+import pytest
+import pytest_benchmark.fixture
+import src.utils.hals.printers.escp as escp_utils
+import src.utils.hals.printers.tspl as tspl_utils
+import src.utils.renderers.html_renderer as html_renderer
+
+# Status reply of a QL-710W with 62mm continuous length tape, without errors.
+ESCP_STATUS_RESPONSE = bytes(
+    [0x80, 0x20, 0x42, 0x34, 0x36, 0x30, 0x00, 0x00]
+    + [0x00, 0x00, 62, 0x0A, 0x00, 0x00, 0x00, 0x00]
+    + [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+    + [0x00] * 8
+)
+# Same reply with the "Cover open error" and "No media when printing" errors.
+ESCP_ERROR_RESPONSE = ESCP_STATUS_RESPONSE[:8] + bytes([0x10, 0x01]) + ESCP_STATUS_RESPONSE[10:]
+# Status packets on a single read buffer while monitoring, the last one is not completely received yet.
+ESCP_STATUS_STREAM = (ESCP_STATUS_RESPONSE + ESCP_ERROR_RESPONSE) * 8 + ESCP_STATUS_RESPONSE[:12]
+
+
+@pytest.fixture(scope="module")
+def bw_label(golden_label: tuple[str, bytes]) -> tuple[str, PIL.Image.Image]:
+    name, png = golden_label
+    return name, html_renderer.image_to_bw(png)
+
+
+def bench_image_to_bw(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    golden: fixtures.GoldenDigests,
+    golden_label: tuple[str, bytes],
+) -> None:
+    name, png = golden_label
+    image = benchmark(html_renderer.image_to_bw, png)
+    golden.check(f"image_to_bw/{name}", image.tobytes())
+
+
+def bench_tspl_write_image(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    golden: fixtures.GoldenDigests,
+    bw_label: tuple[str, PIL.Image.Image],
+) -> None:
+    name, image = bw_label
+
+    def encode() -> tspl_utils.TSPL:
+        tspl = tspl_utils.TSPL()
+        with tspl as printer:
+            with printer.page as page:
+                page.write_image(image=image)
+        return tspl
+
+    golden.check(f"tspl/{name}", b"\r\n".join(benchmark(encode).cmdlist))
+
+
+@pytest.fixture(scope="module")
+def composition(bw_label: tuple[str, PIL.Image.Image]) -> tuple[PIL.Image.Image, tspl_utils.TSPLQRCode]:
+    """Background of the label without the top (name) area and the bottom right (QR code) box"""
+    _, image = bw_label
+    width, height = image.size
+    qrcode = tspl_utils.TSPLQRCode(x=width - 120, y=height - 120, size=110, data="AAAAAAAAAAAAAAAAAAAAAA")
+    background = image.copy()
+    background.paste(255, (0, 0, width, 100))
+    background.paste(255, (qrcode.x, qrcode.y, qrcode.x + qrcode.size, qrcode.y + qrcode.size))
+    return background, qrcode
+
+
+def bench_tspl_write_composed_image(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    golden: fixtures.GoldenDigests,
+    bw_label: tuple[str, PIL.Image.Image],
+    composition: tuple[PIL.Image.Image, tspl_utils.TSPLQRCode],
+) -> None:
+    name, image = bw_label
+    background, qrcode = composition
+
+    def encode() -> tspl_utils.TSPL:
+        # Background is already downloaded, as it's downloaded only once per printer.
+        tspl = tspl_utils.TSPL(printer_id="benchmark", stored_files=[tspl_utils.get_background(background)[0]])
+        with tspl as printer:
+            with printer.page as page:
+                page.write_composed_image(image=image, background=background, qrcode=qrcode)
+        return tspl
+
+    golden.check(f"tspl/composed/{name}", b"\r\n".join(benchmark(encode).cmdlist))
+
+
+def bench_escp_write_image(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    golden: fixtures.GoldenDigests,
+    bw_label: tuple[str, PIL.Image.Image],
+) -> None:
+    name, image = bw_label
+
+    def encode() -> escp_utils.ESCP:
+        escp = escp_utils.ESCP()
+        with escp as printer:
+            with printer.page as page:
+                page.write_image(image=image)
+        return escp
+
+    golden.check(f"escp/{name}", b"".join(benchmark(encode).cmdlist))
+
+
+@pytest.mark.parametrize(
+    "parse_response",
+    [escp_utils.ESCP_ResponseParser.parse_response, escp_utils.escp_response_parser.parse_response],
+    ids=["reference", "compiled"],
+)
+@pytest.mark.parametrize("response", [ESCP_STATUS_RESPONSE, ESCP_ERROR_RESPONSE], ids=["status", "error"])
+def bench_escp_parse_response(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    golden: fixtures.GoldenDigests,
+    parse_response: typing.Callable[[bytes], escp_utils.ESCP_Response],
+    response: bytes,
+) -> None:
+    key = "escp/parse_response" if response == ESCP_STATUS_RESPONSE else "escp/parse_response/error"
+    golden.check(key, json.dumps(benchmark(parse_response, response), sort_keys=True).encode())
+
+
+def bench_escp_parse_stream(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture, golden: fixtures.GoldenDigests
+) -> None:
+    responses, remaining = benchmark(escp_utils.escp_response_parser.parse_stream, ESCP_STATUS_STREAM)
+    assert remaining == ESCP_STATUS_RESPONSE[:12]
+    golden.check("escp/parse_stream", json.dumps(responses, sort_keys=True).encode())
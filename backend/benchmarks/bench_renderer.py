@@ -0,0 +1,85 @@
+import asyncio
+import typing
+
+import benchmarks.fakes as fakes
+import pytest
+import pytest_asyncio
+import pytest_benchmark.fixture
+import src.utils.renderers.html_renderer as html_renderer
+
+RENDER_CONTEXT = {"user_name": "홍길동", "user_org": "PyCon Korea", "qrcode_data": "AAAAAAAAAAAAAAAAAAAAAA"}
+
+
+@pytest_asyncio.fixture(scope="module")
+async def loop() -> asyncio.AbstractEventLoop:
+    """Module-scoped loop of pytest-asyncio, to run the renders on the loop the browser is bound to."""
+    return asyncio.get_running_loop()
+
+
+@pytest_asyncio.fixture(scope="module", params=["fake", "chromium"])
+async def browser(request: pytest.FixtureRequest) -> typing.AsyncIterator[typing.Any]:
+    """The fake browser measures everything but Chromium, e.g. the template rendering and the cache lookup."""
+    if request.param == "fake":
+        yield fakes.FakeBrowser()
+        return
+
+    import playwright.async_api
+
+    try:
+        p = await playwright.async_api.async_playwright().start()
+        chromium = await p.chromium.launch()
+    except Exception as e:
+        pytest.skip(f"Chromium is not available: {e}")
+    yield chromium
+    await chromium.close()
+    await p.stop()
+
+
+@pytest.mark.parametrize("cache", ["cold", "warm"])
+def bench_render_html(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    loop: asyncio.AbstractEventLoop,
+    browser: typing.Any,
+    cache: str,
+) -> None:
+    html_renderer.template_registry.load()
+
+    def render() -> None:
+        coro = html_renderer.render_html(browser, "nameplate_label", RENDER_CONTEXT, element="#container")
+        loop.run_until_complete(coro)
+
+    # Output is not compared with the golden digests, as the rendered result depends on the fonts of the host.
+    render()
+    setup = html_renderer._render_html.cache_clear if cache == "cold" else None
+    benchmark.pedantic(render, setup=setup, rounds=20 if cache == "cold" else 200, warmup_rounds=1)
+
+
+@pytest.mark.parametrize("mode", ["gather", "batch"])
+def bench_render_order_labels(
+    benchmark: pytest_benchmark.fixture.BenchmarkFixture,
+    loop: asyncio.AbstractEventLoop,
+    browser: typing.Any,
+    mode: str,
+) -> None:
+    """Nameplate and three exchange tickets of an order, on a page per label or on a single page"""
+    html_renderer.template_registry.load()
+    size = {"width": "960", "height": "410"}
+    labels = [("nameplate_label", RENDER_CONTEXT | size)] + [
+        ("exchange_ticket_label", RENDER_CONTEXT | size | {"option_name": "티셔츠", "option_value": value})
+        for value in ("S", "M", "L")
+    ]
+
+    async def render_labels() -> None:
+        if mode == "batch":
+            await html_renderer.render_html_batch(browser, labels)
+            return
+        await asyncio.gather(*(html_renderer.render_html(browser, t, c, element="#container") for t, c in labels))
+
+    def render() -> None:
+        loop.run_until_complete(render_labels())
+
+    def clear_cache() -> None:
+        html_renderer._render_html.cache_clear()
+        html_renderer._render_html_batch.cache_clear()
+
+    benchmark.pedantic(render, setup=clear_cache, rounds=20, warmup_rounds=1)
@@ -0,0 +1,38 @@
+"""
+Micro-benchmarks of the CPU-bound pieces, run by pytest-benchmark (installed by `poetry install` with the dev group).
+
+Every benchmark is run against the fixed golden label images on golden/, and its output is compared with the digests
+on golden/digests.json, so that an optimization which changes the printed bytes fails instead of looking faster.
+
+Usage (on backend directory):
+    pytest benchmarks                                   # run & check the byte parity
+    pytest benchmarks --benchmark-save=rpi4             # store a baseline of this hardware on benchmarks/baselines
+    pytest benchmarks --benchmark-compare=0001 --benchmark-compare-fail=median:15%  # fail on regressions
+    pytest benchmarks --update-golden                   # only when the output is changed on purpose
+
+Baselines are stored per OS / Python / word size, which is the same for a 64-bit Raspberry Pi and a x86-64 laptop,
+so name the baselines after the hardware with --benchmark-save.
+"""
+
+import typing
+
+import benchmarks.fixtures as fixtures
+import pytest
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption("--update-golden", action="store_true", help="Overwrites the golden digests with the outputs")
+
+
+@pytest.fixture(scope="session")
+def golden(request: pytest.FixtureRequest) -> typing.Iterator[fixtures.GoldenDigests]:
+    digests = fixtures.GoldenDigests(update=request.config.getoption("--update-golden"))
+    yield digests
+    if digests.update:
+        digests.save()
+
+
+@pytest.fixture(scope="session", params=fixtures.GOLDEN_LABELS)
+def golden_label(request: pytest.FixtureRequest) -> tuple[str, bytes]:
+    """Name and PNG screenshot of a golden label image"""
+    return request.param, (fixtures.GOLDEN_DIR / f"{request.param}.png").read_bytes()
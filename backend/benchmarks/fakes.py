@@ -0,0 +1,216 @@
+"""
+In-process fakes for the load test.
+
+- FakeShop: an ASGI app implementing SHOP_V1_API_MAP on the memory
+- FakeRedisClient: fakeredis with the same interface as src.redis_client.RedisClient
+- fake_async_playwright: a browser stub that renders blank labels, for the hosts without Chromium
+- VirtualReader: a pty pair, the slave side is read by qrcode_serial as if it's a USB CDC QR reader
+- FakePrinter: a FIFO capturing the printer commands, one job per open/close
+- ServerThread: uvicorn running on a background thread
+"""
+
+import asyncio
+import contextlib
+import copy
+import io
+import os
+import pathlib
+import queue
+import re
+import socket
+import threading
+import time
+import tty
+import typing
+import uuid
+
+import benchmarks.fixtures as fixtures
+import fastapi
+import PIL.Image
+import src.models as models
+import uvicorn
+
+# Frames of the sprite sheets, see html_renderer.SPRITE_FRAME_HTML.
+SPRITE_FRAME_SIZE_PATTERN = re.compile(r'<iframe style="width: (\d+)px; height: (\d+)px"')
+
+
+class FakeShop:
+    def __init__(self, order_count: int, priced_option_count: int = 0, latency: float = 0) -> None:
+        # Seconds added to the retrieve & modify requests, to simulate a slow shop.
+        self.latency = latency
+        self.orders: dict[uuid.UUID, models.OrderDTO] = {}
+        for _ in range(order_count):
+            order = fixtures.build_order(priced_option_count)
+            self.orders[order.id] = order
+        self.unused_order_ids: list[uuid.UUID] = list(self.orders)
+        self.app = self.build_app()
+
+    def pop_unused_order(self) -> models.OrderDTO:
+        return self.orders[self.unused_order_ids.pop()]
+
+    def count_used_orders(self) -> int:
+        return sum(all(product.status == "used" for product in order.products) for order in self.orders.values())
+
+    def build_app(self) -> fastapi.FastAPI:
+        app = fastapi.FastAPI()
+
+        @app.get(path="/")
+        async def search(custom_responses: str = "", page: int = 1, page_size: int = 20) -> list[models.OrderDTO]:
+            keywords = [k for k in custom_responses.split(",") if k]
+            orders = [
+                o
+                for o in self.orders.values()
+                if all(any(k == opt.custom_response for opt in o.products[0].options) for k in keywords)
+            ]
+            return orders[(page - 1) * page_size : page * page_size]  # noqa: E203
+
+        @app.get(path="/{order_id}/")
+        async def retrieve(order_id: uuid.UUID) -> models.OrderDTO:
+            await asyncio.sleep(self.latency)
+            if not (order := self.orders.get(order_id)):
+                raise fastapi.HTTPException(status_code=404)
+            return order
+
+        @app.patch(path="/{order_id}/")
+        async def modify(order_id: uuid.UUID, payload: models.OrderModifyRequestDTO) -> models.OrderDTO:
+            await asyncio.sleep(self.latency)
+            if not (order := self.orders.get(order_id)):
+                raise fastapi.HTTPException(status_code=404)
+            order = copy.deepcopy(order)
+            for product_modify in payload.products:
+                for product in order.products:
+                    if product.id == product_modify.id and product_modify.status:
+                        product.status = product_modify.status
+            self.orders[order_id] = order
+            return order
+
+        @app.delete(path="/{order_id}/")
+        async def refund(order_id: uuid.UUID, otp: str) -> None:
+            if not (order := self.orders.get(order_id)):
+                raise fastapi.HTTPException(status_code=404)
+            order.current_status = "refunded"
+
+        return app
+
+
+class FakeRedisClient:
+    server: typing.ClassVar[typing.Any] = None
+
+    def __init__(self, dsn: str | None = None) -> None:
+        import fakeredis  # Only required when the load test is run without redis-server
+
+        FakeRedisClient.server = FakeRedisClient.server or fakeredis.FakeServer()
+        self.sync_session = fakeredis.FakeRedis(server=FakeRedisClient.server)
+        self.async_session = fakeredis.aioredis.FakeRedis(server=FakeRedisClient.server)
+
+    async def close(self) -> None:
+        await self.async_session.aclose()
+
+
+class FakePage:
+    def __init__(self, browser: "FakeBrowser") -> None:
+        self._browser = browser
+        self._html = ""
+
+    async def set_content(self, html: str, **kwargs: typing.Any) -> None:
+        self._html = html
+
+    def locator(self, selector: str) -> typing.Self:
+        return self
+
+    async def screenshot(self, **kwargs: typing.Any) -> bytes:
+        # Sprite sheets of the batch renders are as large as their frames stacked.
+        if frames := SPRITE_FRAME_SIZE_PATTERN.findall(self._html):
+            size = (max(int(width) for width, _ in frames), sum(int(height) for _, height in frames))
+        else:
+            label = models.Printer.Label()
+            size = (label.width, label.height)
+        return self._browser.blank_screenshot(size)
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeBrowser:
+    def __init__(self) -> None:
+        self._screenshots: dict[tuple[int, int], bytes] = {}
+
+    def blank_screenshot(self, size: tuple[int, int]) -> bytes:
+        if size not in self._screenshots:
+            with io.BytesIO() as output:
+                PIL.Image.new("RGBA", size, "white").save(output, format="PNG")
+                self._screenshots[size] = output.getvalue()
+        return self._screenshots[size]
+
+    async def new_page(self, **kwargs: typing.Any) -> FakePage:
+        return FakePage(self)
+
+    async def close(self) -> None:
+        pass
+
+
+@contextlib.asynccontextmanager
+async def fake_async_playwright() -> typing.AsyncIterator[typing.Any]:
+    class Chromium:
+        async def launch(self) -> FakeBrowser:
+            return FakeBrowser()
+
+    class Playwright:
+        chromium = Chromium()
+
+    yield Playwright()
+
+
+class VirtualReader:
+    def __init__(self) -> None:
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.path = os.ttyname(self.slave_fd)
+
+    def scan(self, data: str) -> None:
+        os.write(self.master_fd, f"{data}\r".encode())
+
+
+class FakePrinter:
+    def __init__(self, directory: pathlib.Path, name: str) -> None:
+        self.path = directory / name
+        os.mkfifo(self.path)
+        # (finished_at, byte count) for each print job
+        self.jobs: queue.Queue[tuple[float, int]] = queue.Queue()
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _drain(self) -> None:
+        while True:
+            with self.path.open("rb") as fifo:
+                data = fifo.read()
+            self.jobs.put((time.perf_counter(), len(data)))
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerThread(threading.Thread):
+    def __init__(self, app: fastapi.FastAPI, port: int | None = None) -> None:
+        super().__init__(daemon=True)
+        self.port = port or get_free_port()
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self) -> None:
+        self.server.run()
+
+    def __enter__(self) -> typing.Self:
+        self.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.server.should_exit = True
+        self.join()
@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+import json
+import pathlib
+import uuid
+
+import src.models as models
+
+SESSION_COUNTS = (10, 50, 200)
+HANDLED_ORDER_COUNT = 300
+
+GOLDEN_DIR = pathlib.Path(__file__).parent / "golden"
+GOLDEN_DIGESTS_PATH = GOLDEN_DIR / "digests.json"
+GOLDEN_LABELS = ("nameplate_label", "exchange_ticket_label")
+
+
+def build_order(priced_option_count: int = 2) -> models.OrderDTO:
+    def option_group(name: str, is_custom_response: bool) -> dict:
+        return {
+            "id": uuid.uuid4(),
+            "name": name,
+            "is_custom_response": is_custom_response,
+            "custom_response_pattern": None,
+        }
+
+    return models.OrderDTO.model_validate(
+        {
+            "id": uuid.uuid4(),
+            "first_paid_price": 30000,
+            "first_paid_at": datetime.datetime.now().isoformat(),
+            "current_paid_price": 30000,
+            "current_status": "completed",
+            "payment_histories": [{"status": "completed", "price": 30000, "created_at": "2024-08-01T00:00:00"}],
+            "user": {"id": 1, "username": "attendee", "email": "attendee@example.com"},
+            "products": [
+                {
+                    "id": uuid.uuid4(),
+                    "price": 30000,
+                    "donation_price": 0,
+                    "status": "paid",
+                    "product": {"id": uuid.uuid4(), "name": "Conference Ticket", "price": 30000},
+                    "options": [
+                        {
+                            "id": uuid.uuid4(),
+                            "product_option_group": option_group("성함", True),
+                            "product_option": None,
+                            "custom_response": "홍길동",
+                        },
+                        {
+                            "id": uuid.uuid4(),
+                            "product_option_group": option_group("소속", True),
+                            "product_option": None,
+                            "custom_response": "PyCon Korea",
+                        },
+                    ]
+                    + [
+                        {
+                            "id": uuid.uuid4(),
+                            "product_option_group": option_group(f"Option {i}", False),
+                            "product_option": {"id": uuid.uuid4(), "name": f"Value {i}", "additional_price": 5000},
+                            "custom_response": None,
+                        }
+                        for i in range(priced_option_count)
+                    ],
+                }
+            ],
+        }
+    )
+
+
+def build_app_state(session_count: int, handled_order_count: int = HANDLED_ORDER_COUNT) -> models.AppState:
+    app_state = models.AppState()
+    for _ in range(session_count):
+        session = app_state.create_session()
+        session.state.handled_order = [build_order() for _ in range(handled_order_count)]
+        session.state.desk_status = "idle"
+    return app_state
+
+
+class GoldenDigests:
+    """SHA-256 digests of the benchmark outputs, to check the byte parity of the optimized code"""
+
+    def __init__(self, update: bool = False) -> None:
+        self.update = update
+        self.digests: dict[str, str] = (
+            json.loads(GOLDEN_DIGESTS_PATH.read_text()) if GOLDEN_DIGESTS_PATH.exists() else {}
+        )
+
+    def check(self, key: str, data: bytes) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        if self.update:
+            self.digests[key] = digest
+            return
+        assert key in self.digests, f"No golden digest for {key}, run with --update-golden to create it"
+        assert self.digests[key] == digest, f"Output of {key} is changed from the golden digest"
+
+    def save(self) -> None:
+        GOLDEN_DIGESTS_PATH.write_text(json.dumps(dict(sorted(self.digests.items())), indent=2) + "\n")
@@ -0,0 +1,268 @@
+"""
+Scan-to-print load test
+
+Drives N desks through the whole automated flow, with every process of the deployment replaced by in-process fakes:
+    virtual QR reader (pty) -> qrcode_serial -> scanner_manager.set_session_order -> /session/my/order/automated
+    -> fake shop API (GET, PATCH) -> renderer -> Printer.async_print_image -> fake printer (FIFO)
+while the websocket subscribers of each desk are receiving the session state changes.
+
+Everything runs on a single process (threads for the readers and the uvicorn servers, except the image executor),
+so the numbers are a lower bound of what the same host can do with the real deployment.
+
+Usage (on backend directory):
+    python -m benchmarks.load_test --desks 8 --scans 20 --fake-browser
+    python -m benchmarks.load_test --desks 8 --scans 20 --redis-dsn redis://localhost:6379/15
+    python -m benchmarks.load_test --desks 8 --scans 20 --redis-dsn sqlite:////tmp/rosa-load-test.sqlite3 --fake-browser
+    APP_STATE_WRITE_MODE=optimistic python -m benchmarks.load_test --desks 8 --scans 20 --fake-browser
+    IMAGE_EXECUTOR=inline python -m benchmarks.load_test --desks 8 --scans 20 --fake-browser
+    python -m benchmarks.load_test --desks 8 --scans 20 --fake-browser --shop-latency 0.5
+
+Without --redis-dsn, fakeredis is used. Without --fake-browser, Chromium must be installed by `playwright install`.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import pathlib
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import typing
+import uuid
+
+import benchmarks.fakes as fakes
+import httpx
+import src
+import src.metrics as metrics
+import src.models as models
+import src.redis_client as redis_client
+import src.utils.stdlibs.str_utils as str_utils
+import websockets
+
+
+class Desk:
+    def __init__(self, index: int, session_id: uuid.UUID, printer: fakes.FakePrinter) -> None:
+        self.index = index
+        self.session_id = session_id
+        self.reader = fakes.VirtualReader()
+        self.printer = printer
+        # Finish time of each set_session_order call, which returns after the automated flow is done.
+        self.handled: asyncio.Queue[float] = asyncio.Queue()
+
+
+class Report:
+    def __init__(self) -> None:
+        self.scan_to_print: list[float] = []
+        self.scan_to_response: list[float] = []
+        self.scan_to_websocket: list[float] = []
+        self.failures = 0
+        self.websocket_disconnects = 0
+        # Scan start time by order id, for the websocket subscribers
+        self.scanned_at: dict[str, float] = {}
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    q = statistics.quantiles(values, n=100)
+    return f"p50 {q[49] * 1000:8.1f}ms  p95 {q[94] * 1000:8.1f}ms  p99 {q[98] * 1000:8.1f}ms"
+
+
+def attach_devices(redis_session: redis_client.RedisSession, desk: Desk, cmd_type: models.PrinterCmdType) -> None:
+    """Registers the fake devices directly, as the device registration APIs only accept the real USB devices."""
+    app_state = models.AppState.load_from_storage(redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL))
+    state = app_state.sessions[desk.session_id].state
+    common = {"bus": 0, "device": desk.index, "block_path": f"/dev/fake{desk.index}"}
+    state.reader = models.USBDevice(**common, cdc_path=desk.reader.path, name=f"Fake reader {desk.index}")
+    state.printer = models.Printer(
+        **common, cdc_path=str(desk.printer.path), name=f"Fake printer {desk.index}", cmd_type=cmd_type
+    )
+    redis_session.set(redis_client.RedisKey.PUBSUB_CHANNEL, app_state.dump_for_storage())
+    version = redis_session.incr(redis_client.RedisKey.APP_STATE_VERSION)
+    redis_session.publish(redis_client.RedisKey.PUBSUB_CHANNEL, str(version))
+
+
+def run_reader(
+    desk: Desk, port: int, redis_session: redis_client.RedisSession, loop: asyncio.AbstractEventLoop
+) -> None:
+    # Same as scanner_manager.qr_scanner_handler, but on a thread and with a callback notifying the driver.
+    import src.cli.scanner_manager as scanner_manager
+    import src.utils.hals.readers.qrcode_serial as qrcode_serial
+
+    set_session_order = functools.partial(
+        scanner_manager.set_session_order,
+        port=port,
+        automated=True,
+        session_id=desk.session_id,
+        reader=desk.reader.path,
+        redis_session=redis_session,
+    )
+
+    def callback(data: str) -> None:
+        set_session_order(data)
+        loop.call_soon_threadsafe(desk.handled.put_nowait, time.perf_counter())
+
+    qrcode_serial.SerialInfo(port=desk.reader.path).retrieve_and_exec(callback=callback)
+
+
+async def drive_desk(desk: Desk, shop: fakes.FakeShop, scans: int, label_count: int, report: Report) -> None:
+    for _ in range(scans):
+        order = shop.pop_unused_order()
+        report.scanned_at[str(order.id)] = scanned_at = time.perf_counter()
+        desk.reader.scan(str_utils.uuid_to_b64(order.id))
+
+        # set_session_order returns after the labels are printed, but it doesn't tell whether the request failed,
+        # so the scan is counted as failed if the labels are not printed by then.
+        try:
+            handled_at = await asyncio.wait_for(desk.handled.get(), timeout=60)
+            for _ in range(label_count):
+                printed_at, _ = await asyncio.to_thread(desk.printer.jobs.get, timeout=1)
+        except (queue.Empty, asyncio.TimeoutError):
+            report.failures += 1
+            continue
+        report.scan_to_print.append(printed_at - scanned_at)
+        report.scan_to_response.append(handled_at - scanned_at)
+
+
+async def subscribe(url: str, session_id: uuid.UUID, report: Report, stop: asyncio.Event) -> None:
+    seen: set[str] = set()
+    with contextlib.suppress(websockets.ConnectionClosed):
+        async with websockets.connect(f"{url}/ws?session_id={session_id}") as ws:
+            while not stop.is_set():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    state = json.loads(await asyncio.wait_for(ws.recv(), timeout=1))
+                    if (order := state.get("order")) and (order_id := order["id"]) not in seen:
+                        seen.add(order_id)
+                        if scanned_at := report.scanned_at.get(order_id):
+                            report.scan_to_websocket.append(time.perf_counter() - scanned_at)
+    if not stop.is_set():
+        report.websocket_disconnects += 1
+
+
+def read_metrics(redis_session: redis_client.RedisSession) -> dict[str, float]:
+    metrics.registry.flush(redis_session)
+    return {k.decode(): float(v) for k, v in redis_session.hgetall(redis_client.RedisKey.METRICS).items()}
+
+
+def summarize_histogram(before: dict[str, float], after: dict[str, float], name: str) -> str:
+    def delta(suffix: str, labels: dict) -> float:
+        field = json.dumps([name + suffix, labels], ensure_ascii=False)
+        return after.get(field, 0) - before.get(field, 0)
+
+    labels = {"mode": redis_client.APP_STATE_WRITE_MODE}
+    if not (count := delta("_count", labels)):
+        return "n/a"
+    histogram = metrics.registry.metrics[name]
+    assert isinstance(histogram, metrics.Histogram)
+    p95 = next(
+        (b for b in histogram.buckets if delta("_bucket", labels | {"le": str(b)}) >= count * 0.95), float("inf")
+    )
+    total = delta("_sum", labels)
+    return f"count {count:6.0f}  mean {total / count * 1000:8.1f}ms  p95 <= {p95 * 1000:.0f}ms  total {total:.2f}s"
+
+
+async def run(args: argparse.Namespace) -> None:
+    label_count = 1 + (args.priced_options if args.priced_labels else 0)
+    shop = fakes.FakeShop(
+        order_count=args.desks * args.scans, priced_option_count=args.priced_options, latency=args.shop_latency
+    )
+
+    if args.redis_dsn:
+        os.environ["REDIS_DSN"] = args.redis_dsn
+    else:
+        redis_client.RedisClient = fakes.FakeRedisClient  # type: ignore[misc,assignment]
+    if args.fake_browser:
+        import playwright.async_api
+
+        playwright.async_api.async_playwright = fakes.fake_async_playwright  # type: ignore[assignment]
+    os.environ["AUTOMATED_ORDER_WAITING_TIME"] = str(args.display_wait)
+
+    redis_session = redis_client.connect(args.redis_dsn or "redis://fake").sync_session
+    report = Report()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    with (
+        tempfile.TemporaryDirectory() as tmpdir,
+        fakes.ServerThread(shop.app) as shop_server,
+        fakes.ServerThread(src.create_app()) as app_server,
+    ):
+        async with httpx.AsyncClient(base_url=app_server.url) as client:
+            await client.put("/config/shop-domain", json={"domain": shop_server.url})
+            desks: list[Desk] = []
+            for index in range(args.desks):
+                session_id = uuid.UUID((await client.post("/session")).json()["id"])
+                headers = {"X-Session-ID": str(session_id)}
+                config = {"automated": True, "print_priced_option_label": args.priced_labels}
+                await client.put("/config/session-state", json=config, headers=headers)
+                desk = Desk(index, session_id, fakes.FakePrinter(pathlib.Path(tmpdir), f"printer{index}"))
+                attach_devices(redis_session, desk, args.printer_cmd)
+                desks.append(desk)
+
+        for desk in desks:
+            threading.Thread(target=run_reader, args=(desk, app_server.port, redis_session, loop), daemon=True).start()
+        subscribers = [
+            asyncio.create_task(subscribe(app_server.url.replace("http", "ws"), desk.session_id, report, stop))
+            for desk in desks
+            for _ in range(args.ws_per_desk)
+        ]
+        await asyncio.sleep(1)  # Waits for the readers and the subscribers to be ready
+
+        metrics_before = read_metrics(redis_session)
+        started_at = time.perf_counter()
+        # scanner_manager prints every scan, so stdout is muted while the load is running.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            await asyncio.gather(*(drive_desk(desk, shop, args.scans, label_count, report) for desk in desks))
+        elapsed = time.perf_counter() - started_at
+        metrics_after = read_metrics(redis_session)
+
+        # Orders are marked as used on the shop in background, after the labels are printed.
+        sync_deadline = time.perf_counter() + 30
+        while shop.count_used_orders() < len(report.scanned_at) and time.perf_counter() < sync_deadline:
+            await asyncio.sleep(0.1)
+        synced_after = time.perf_counter() - started_at - elapsed
+
+        stop.set()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+
+    scans = len(report.scan_to_print)
+    print(f"desks {args.desks}, scans {scans} (failed {report.failures}), {elapsed:.1f}s")
+    print(f"throughput        {scans / elapsed:8.2f} scans/s, {scans * label_count / elapsed:8.2f} labels/s")
+    print(f"scan -> print     {percentiles(report.scan_to_print)}")
+    print(f"scan -> response  {percentiles(report.scan_to_response)}")
+    print(f"scan -> websocket {percentiles(report.scan_to_websocket)}  (disconnected {report.websocket_disconnects})")
+    synced = f"{shop.count_used_orders()}/{len(report.scanned_at)} orders"
+    print(f"shop synced       {synced}, {synced_after:.1f}s after the load")
+    print(f"lock wait         {summarize_histogram(metrics_before, metrics_after, 'rosa_app_state_lock_wait_seconds')}")
+    print(f"lock hold         {summarize_histogram(metrics_before, metrics_after, 'rosa_app_state_lock_hold_seconds')}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--desks", type=int, default=4)
+    parser.add_argument("--scans", type=int, default=10, help="Scans per desk")
+    parser.add_argument("--ws-per-desk", type=int, default=2, help="Websocket subscribers per desk")
+    parser.add_argument("--redis-dsn", default=None, help="Uses fakeredis if not given")
+    parser.add_argument("--fake-browser", action="store_true", help="Renders blank labels without Chromium")
+    parser.add_argument("--printer-cmd", choices=typing.get_args(models.PrinterCmdType), default="TSPL")
+    parser.add_argument("--priced-labels", action="store_true", help="Prints the exchange ticket labels too")
+    parser.add_argument("--priced-options", type=int, default=2, help="Priced options per order")
+    parser.add_argument("--shop-latency", type=float, default=0, help="Seconds added to the shop API requests")
+    parser.add_argument("--display-wait", type=float, default=0, help="AUTOMATED_ORDER_WAITING_TIME in seconds")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if sys.platform == "win32":
+        raise SystemExit("pty and FIFO are required for the fake devices")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Startup time benchmark
+
+Runs each entry point on a fresh interpreter with `python -X importtime`, and reports the wall time of the process
+and the slowest top-level imports, which is what supervisord waits for when it restarts the processes.
+
+Usage (on backend directory):
+    python -m benchmarks.startup --repeat 5
+    python -m benchmarks.startup --repeat 5 --top 20 session-cleaner
+"""
+
+import argparse
+import collections
+import re
+import statistics
+import subprocess  # nosec: B404
+import sys
+import time
+
+# The commands exit right after parsing the arguments, so only the startup is measured.
+TARGETS: dict[str, list[str]] = {
+    "session-cleaner": ["-m", "src.cli", "session-cleaner", "--help"],
+    "scanner-manager": ["-m", "src.cli", "scanner-manager", "--help"],
+    "api": ["-c", "import src; src.create_app()"],
+}
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def run(args: list[str]) -> tuple[float, dict[str, int]]:
+    """Returns wall time in milliseconds, and cumulative import time in microseconds of each top-level import"""
+    start = time.perf_counter()
+    result = subprocess.run(  # nosec: B603
+        [sys.executable, "-X", "importtime", *args], capture_output=True, text=True, check=True
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+
+    top_level_imports: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if (match := IMPORTTIME_PATTERN.match(line)) and len(match.group(3)) == 1:
+            top_level_imports[match.group(4)] = int(match.group(2))
+    return elapsed, top_level_imports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*", help=f"Any of {', '.join(TARGETS)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Number of the slowest imports to show")
+    args = parser.parse_args()
+    if unknown_targets := set(args.targets) - set(TARGETS):
+        parser.error(f"Unknown targets: {', '.join(sorted(unknown_targets))}")
+
+    for target in args.targets or TARGETS:
+        run(TARGETS[target])  # warm up the bytecode cache
+        wall_times: list[float] = []
+        import_times: dict[str, list[int]] = collections.defaultdict(list)
+        for _ in range(args.repeat):
+            elapsed, top_level_imports = run(TARGETS[target])
+            wall_times.append(elapsed)
+            for module, cumulative in top_level_imports.items():
+                import_times[module].append(cumulative)
+
+        print(f"{target:<20} wall p50 {statistics.median(wall_times):8.1f}ms  min {min(wall_times):8.1f}ms")
+        medians = {module: statistics.median(times) for module, times in import_times.items()}
+        for module, cumulative in sorted(medians.items(), key=lambda item: item[1], reverse=True)[: args.top]:
+            print(f"    {module:<40} {cumulative / 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
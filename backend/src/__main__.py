@@ -11,7 +11,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     uvicorn.run(
-        app="src:create_app",
+        app="src.app:create_app",
         factory=True,
         reload=args.debug,
         host=args.host,
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import http
+import os
+import typing
+
+import fastapi
+import fastapi.middleware.cors
+import playwright.async_api
+import src.dependencies as dependencies
+import src.executors as executors
+import src.metrics as metrics
+import src.models as models
+import src.order_journal as order_journal
+import src.redis_client as redis_client
+import src.routes as routes
+import src.static_assets as static_assets
+import src.tracing as tracing
+import src.utils.renderers.html_renderer as html_renderer
+import src.warmup as warmup
+
+
+async def _redirect_to_front_404_handler(*_: tuple, **__: dict) -> fastapi.responses.RedirectResponse:
+    return fastapi.responses.RedirectResponse("/")
+
+
+def create_app(**kwargs: typing.Any) -> fastapi.FastAPI:
+    @contextlib.asynccontextmanager
+    async def app_lifespan(app: fastapi.FastAPI) -> typing.AsyncGenerator[None, None]:
+        app.state.redis_client = redis_client.connect(os.getenv("REDIS_DSN"))
+        snapshot_listener = asyncio.create_task(
+            dependencies.app_state_snapshot_cache.listen(app.state.redis_client.async_session)
+        )
+        metrics_flusher = asyncio.create_task(metrics.registry.flush_periodically(app.state.redis_client.async_session))
+        span_flusher = asyncio.create_task(tracing.recorder.flush_periodically(app.state.redis_client.async_session))
+        order_journal_replayer = asyncio.create_task(
+            order_journal.order_journal.replay_periodically(app.state.redis_client.async_session)
+        )
+
+        await asyncio.to_thread(static_assets.static_assets.build)
+        html_renderer.template_registry.load()
+        executors.image_executor.start()
+        template_watcher = asyncio.create_task(html_renderer.template_registry.watch())
+
+        async with playwright.async_api.async_playwright() as p:
+            app.state.browser = await p.chromium.launch()
+            # Runs in background, as the pre-rendering needs the static files served after the startup.
+            app.state.warm_up = warmup.WarmUp()
+            warm_up_task = asyncio.create_task(
+                app.state.warm_up.run(app.state.redis_client.async_session, app.state.browser)
+            )
+            yield
+            warm_up_task.cancel()
+            with contextlib.suppress(Exception):
+                # If the browser is closed without opening any pages,
+                # it will raise an error as the browser never started.
+                # We can safely ignore this error.
+                await app.state.browser.close()
+
+        for task in (template_watcher, snapshot_listener, metrics_flusher, span_flusher, order_journal_replayer):
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        executors.image_executor.shutdown()
+        await models.shop_api_client_pool.aclose()
+        await metrics.registry.async_flush(app.state.redis_client.async_session)
+        await tracing.recorder.async_flush(app.state.redis_client.async_session)
+        await app.state.redis_client.close()
+
+    app = fastapi.FastAPI(
+        **kwargs,
+        lifespan=app_lifespan,
+        middleware=[
+            fastapi.middleware.Middleware(
+                fastapi.middleware.cors.CORSMiddleware,
+                allow_origins=["*"],
+                allow_credentials=True,
+                allow_methods=["*"],
+                allow_headers=["*"],
+            ),
+            fastapi.middleware.Middleware(tracing.TraceContextMiddleware),
+        ],
+    )
+    app.exception_handler(exc_class_or_status_code=http.HTTPStatus.NOT_FOUND)(_redirect_to_front_404_handler)
+    app.mount("/static", static_assets.PrecompressedStaticFiles(static_assets.static_assets), name="static")
+    for route in routes.get_routes():
+        app.include_router(route)
+
+    return app
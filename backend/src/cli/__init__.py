@@ -1,20 +1,42 @@
-import pathlib
+import importlib
 import typing
 
-import src.utils.stdlibs.import_utils as import_utils
+import click
 import typer
+import typer.core
 
-typer_app = typer.Typer()
+# Entry point style manifest of the commands, as "module:function".
+# Modules are imported only when the command is run, so a command doesn't pay for the imports of the others.
+CLI_COMMANDS: dict[str, str] = {
+    "label-prerender": "src.cli.label_prerender:label_prerender",
+    "scanner-manager": "src.cli.scanner_manager:scanner_manager",
+    "session-cleaner": "src.cli.session_cleaner:session_cleaner",
+    "static-build": "src.cli.static_build:static_build",
+}
 
-current_dir = pathlib.Path(__file__).parent
-for module_path in current_dir.glob("*.py"):
-    if module_path.stem.startswith("__"):
-        continue
-    module = import_utils.load_module(module_path)
 
-    cli_patterns: list[typing.Callable]
-    if not import_utils.isiterable(cli_patterns := getattr(module, "cli_patterns", None)):
-        continue
+def load_command(entry_point: str) -> click.Command:
+    module_name, func_name = entry_point.split(":")
+    func: typing.Callable = getattr(importlib.import_module(module_name), func_name)
 
-    for cli_func in cli_patterns:
-        typer_app.command()(cli_func)
+    command_app = typer.Typer(add_completion=False)
+    command_app.command()(func)
+    return typer.main.get_command(command_app)
+
+
+class LazyTyperGroup(typer.core.TyperGroup):
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted(CLI_COMMANDS)
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
+        if cmd_name not in CLI_COMMANDS:
+            return None
+        return load_command(CLI_COMMANDS[cmd_name])
+
+
+typer_app = typer.Typer(cls=LazyTyperGroup)
+
+
+@typer_app.callback()
+def main() -> None:
+    """POCA CLI"""
@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+
+import playwright.async_api
+import src.label_store as label_store
+import src.models as models
+import src.redis_client as redis_client
+import src.utils.renderers.html_renderer as html_renderer
+
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+PRERENDER_ORDER_STATUSES: set[models.PaymentHistoryStatus] = {"completed", "partial_refunded"}
+
+# Browser of each worker process, which is kept open while the worker is alive.
+worker_loop: asyncio.AbstractEventLoop | None = None
+worker_browser: playwright.async_api.Browser | None = None
+
+
+def init_worker() -> None:
+    global worker_loop, worker_browser
+
+    worker_loop = asyncio.new_event_loop()
+    playwright_ctx = worker_loop.run_until_complete(playwright.async_api.async_playwright().start())
+    worker_browser = worker_loop.run_until_complete(playwright_ctx.chromium.launch())
+    html_renderer.template_registry.load()
+    # Workers exit without running atexit, but the finalizers of multiprocessing are run.
+    multiprocessing.util.Finalize(None, close_worker, args=(playwright_ctx,), exitpriority=10)
+
+
+def close_worker(playwright_ctx: playwright.async_api.Playwright) -> None:
+    if worker_loop and worker_browser:
+        worker_loop.run_until_complete(worker_browser.close())
+        worker_loop.run_until_complete(playwright_ctx.stop())
+
+
+def render_labels(profile: models.PrinterProfile, labels: list[label_store.Label]) -> list[str]:
+    """Renders the labels on the worker, and returns the object names of the stored printer commands."""
+    if not (worker_loop and worker_browser):
+        raise RuntimeError("Worker is not initialized")
+    images = worker_loop.run_until_complete(
+        html_renderer.render_html_batch(worker_browser, labels, **profile.render_options.model_dump())
+    )
+
+    # Stored labels don't depend on the files downloaded on each printer, so they're encoded without the printer id.
+    return [label_store.label_store.write_object(profile.encode(image).payload) for image in images]
+
+
+async def prerender_labels(
+    shop_api: models.ShopAPIConfig,
+    profiles: list[models.PrinterProfile],
+    workers: int,
+    page_size: int,
+    force: bool,
+) -> None:
+    loop = asyncio.get_running_loop()
+    started_at = time.time()
+    # Workers are spawned, as the browsers' threads and the event loop of this process cannot be forked.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker
+    ) as pool:
+        # Orders are paged in while the previous ones are being rendered, up to twice the number of workers.
+        semaphore = asyncio.Semaphore(workers * 2)
+        counts = {"rendered": 0, "skipped": 0, "failed": 0}
+
+        async def prerender(order_id: str, profile: models.PrinterProfile, labels: list[label_store.Label]) -> None:
+            try:
+                object_names = await loop.run_in_executor(pool, render_labels, profile, labels)
+                label_store.label_store.put(order_id, profile.profile_key, labels, object_names)
+                counts["rendered"] += 1
+            except Exception as e:
+                logger.warning(f"Failed to render the labels of {order_id}: {e!r}")
+                counts["failed"] += 1
+            finally:
+                semaphore.release()
+
+        tasks: list[asyncio.Task] = []
+        async for order in shop_api.iter_orders(page_size=page_size):
+            if order.current_status not in PRERENDER_ORDER_STATUSES:
+                continue
+
+            for profile in profiles:
+                labels = order.get_labels(profile.label.model_dump(mode="json"), include_exchange_tickets=True)
+                if not force and label_store.label_store.get(str(order.id), profile.profile_key, labels):
+                    counts["skipped"] += 1
+                    continue
+
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(prerender(str(order.id), profile, labels)))
+                if len(tasks) % 100 == 0:
+                    logger.info(f"Queued {len(tasks)} orders, {counts}")
+
+        await asyncio.gather(*tasks)
+        logger.info(f"Finished, {counts}")
+
+    # Payloads of the changed orders are replaced by this run, so the previous ones are not referred anymore.
+    removed = await asyncio.to_thread(label_store.label_store.prune, started_at)
+    logger.info(f"Removed {removed} unreferred payloads.")
+
+    await models.shop_api_client_pool.aclose()
+
+
+def label_prerender(redis_dsn: str | None = None, workers: int = 2, page_size: int = 100, force: bool = False) -> None:
+    """
+    Renders the labels of every paid order ahead of the event,
+    for the printer profiles registered on the sessions, including the printer pools they use.
+    The API server must be running, as the templates load the static files from it.
+    Only the new & changed orders are rendered again, unless --force is given.
+    """
+    redis_dsn = redis_dsn or os.getenv("REDIS_DSN") or "redis://localhost:6379/0"
+
+    redis_session: redis_client.RedisSession = redis_client.connect(redis_dsn).sync_session
+    if not (app_state_data := redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL)):
+        logger.error("App state is not initialized yet.")
+        return
+
+    app_state = models.AppState.load_from_storage(app_state_data)
+    # Printers of a pool share the same profile, so only the first one of each desk is taken.
+    profiles = {p.profile_key: p.profile for s in app_state.sessions.values() for p in s.state.printers[:1]}
+    if not profiles:
+        logger.error("No printers are registered on the sessions.")
+        return
+
+    html_renderer.template_registry.load()
+    logger.info(f"Rendering the labels for {len(profiles)} printer profiles.")
+    asyncio.run(prerender_labels(app_state.shop_api, list(profiles.values()), workers, page_size, force))
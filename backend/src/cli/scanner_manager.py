@@ -4,12 +4,13 @@ import logging
 import multiprocessing as mp
 import os
 import traceback
-import typing
 import uuid
 
 import httpx
+import src.metrics as metrics
 import src.models as models
 import src.redis_client as redis_client
+import src.tracing as tracing
 import src.utils.hals.readers.qrcode_serial as qrcode_serial
 import src.utils.stdlibs.str_utils as str_utils
 
@@ -28,7 +29,15 @@ def print_exc(e: Exception) -> None:
     logger.warning(f"{ERROR_MSG_DIVIDER.format(e.__class__.__name__)}{''.join(traceback.format_exception(e))}")
 
 
-def set_session_order(shortened_order_id: str, port: int, automated: bool, session_id: uuid.UUID) -> None:
+def set_session_order(
+    shortened_order_id: str,
+    port: int,
+    automated: bool,
+    session_id: uuid.UUID,
+    reader: str,
+    redis_session: redis_client.RedisSession,
+) -> None:
+    metrics.READER_SCANS_TOTAL.inc(reader=reader)
     try:
         order_id = shortened_order_id
         if not str_utils.UUID_REGEX.match(shortened_order_id):
@@ -39,18 +48,29 @@ def set_session_order(shortened_order_id: str, port: int, automated: bool, sessi
         sub_path = f"/automated?order_id={order_id}" if automated else f"?order_id={order_id}"
         url = main_path + sub_path
         print(f"Request to {url=}")
-        httpx.put(url=url, headers={"X-Session-ID": str(session_id)})
+        with tracing.span("scanner.request", order_id=str(order_id)):
+            httpx.put(url=url, headers={"X-Session-ID": str(session_id)} | tracing.inject_headers())
     except Exception as e:
         print_exc(e)
+    finally:
+        # Scans are sparse, so the metrics are flushed on every scan rather than periodically,
+        # but after the request so that the Redis round trip doesn't delay the scanned order.
+        metrics.registry.flush(redis_session)
 
 
-def qr_scanner_handler(reader: ReaderState, port: int) -> None:
+def qr_scanner_handler(reader: ReaderState, port: int, redis_dsn: str) -> None:
+    # Metrics recorded on the parent process are inherited by fork, and they'll be flushed by the parent.
+    metrics.registry.reset()
     try:
+        redis_session = redis_client.connect(redis_dsn).sync_session
+        tracing.recorder.autoflush_to(redis_session)
         callback = functools.partial(
             set_session_order,
             port=port,
             automated=reader.automated,
             session_id=reader.session_id,
+            reader=reader.identifier,
+            redis_session=redis_session,
         )
         device = qrcode_serial.SerialInfo(port=reader.cdc_path)
         device.retrieve_and_exec(callback=callback)
@@ -64,31 +84,41 @@ def scanner_manager(redis_dsn: str | None = None, port: int | None = None) -> No
     redis_dsn = redis_dsn or os.getenv("REDIS_DSN") or "redis://localhost:6379/0"
     port = port or int(os.getenv("PORT") or 0) or 8000
 
-    with redis_client.RedisClient(dsn=redis_dsn).sync_session as redis_session:
+    with redis_client.connect(redis_dsn).sync_session as redis_session:
+        pubsub = redis_session.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(redis_client.RedisKey.PUBSUB_CHANNEL)
+
+        version: bytes | None = None
+        readers: list[ReaderState] = []
         while True:
             try:
-                app_state_json: str = redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL)
-                app_state: models.AppState = models.AppState.model_validate_json(json_data=app_state_json)
-                readers: list[ReaderState] = [
-                    ReaderState(
-                        **s.state.reader.model_dump(),
-                        automated=s.state.automated,
-                        session_id=s.state.id,
-                    )
-                    for s in app_state.sessions.values()
-                    if s.state.reader
-                ]
+                # Wait for the app state change, but also check the processes periodically to restart dead ones.
+                pubsub.get_message(timeout=1)
+                new_version = redis_session.get(redis_client.RedisKey.APP_STATE_VERSION)
+                if new_version is None or new_version != version:
+                    app_state_data: bytes = redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL)
+                    app_state: models.AppState = models.AppState.load_from_storage(app_state_data)
+                    version = new_version
+                    readers = [
+                        ReaderState(
+                            **s.state.reader.model_dump(),
+                            automated=s.state.automated,
+                            session_id=s.state.id,
+                        )
+                        for s in app_state.sessions.values()
+                        if s.state.reader
+                    ]
                 for reader in readers:
                     if reader not in processes:
                         logger.info(f"Starting process for {reader.name}")
-                        processes[reader] = mp.Process(target=qr_scanner_handler, args=(reader, port))
+                        processes[reader] = mp.Process(target=qr_scanner_handler, args=(reader, port, redis_dsn))
                         processes[reader].start()
 
                     if not processes[reader].is_alive():
                         with contextlib.suppress(Exception):
                             processes[reader].terminate()
                         logger.info(f"Process for {reader.name} is dead. Restarting...")
-                        processes[reader] = mp.Process(target=qr_scanner_handler, args=(reader, port))
+                        processes[reader] = mp.Process(target=qr_scanner_handler, args=(reader, port, redis_dsn))
                         processes[reader].start()
 
                 for reader, process in list(processes.items()):
@@ -104,6 +134,4 @@ def scanner_manager(redis_dsn: str | None = None, port: int | None = None) -> No
 
         for process in processes.values():
             process.terminate()
-
-
-cli_patterns: list[typing.Callable] = [scanner_manager]
+        pubsub.close()
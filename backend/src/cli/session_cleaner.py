@@ -1,10 +1,14 @@
+import contextlib
 import datetime
 import logging
 import os
 import time
 import typing
+import uuid
 
 import pydantic
+import redis
+import src.metrics as metrics
 import src.models as models
 import src.redis_client as redis_client
 
@@ -12,39 +16,113 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 
-def session_cleaner(redis_dsn: str | None = None) -> None:
+def index_unindexed_sessions(redis_session: redis_client.RedisSession) -> None:
+    # Sessions created before the session expiry index was introduced are not on the index yet.
+    try:
+        app_state = models.AppState.load_from_storage(redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL))
+    except pydantic.ValidationError:
+        logger.info("Failed to validate app state.")
+        return
+
+    pings: redis_client.SortedSetScores = {
+        str(sid): info.ping_at.timestamp() for sid, info in app_state.sessions.items()
+    }
+    if pings:
+        redis_session.zadd(redis_client.RedisKey.SESSION_PING_AT, pings, nx=True)
+
+
+def clean_expired_sessions(redis_session: redis_client.RedisSession, candidate_ids: list[str]) -> None:
+    locked = redis_client.APP_STATE_WRITE_MODE == "lock"
+    lock: typing.ContextManager = (
+        redis_session.lock(redis_client.RedisKey.APP_STATE_WRITE_LOCK) if locked else contextlib.nullcontext()
+    )
+    with lock:
+        if locked:
+            logger.info("Lock acquired.")
+        # State is committed with WATCH, so that we can retry if the state is modified by optimistic writers.
+        for _ in range(redis_client.OPTIMISTIC_COMMIT_MAX_RETRIES):
+            with contextlib.suppress(redis.WatchError):
+                clean_expired_sessions_in_transaction(redis_session, candidate_ids)
+                break
+        else:
+            logger.warning(
+                f"Gave up cleaning {len(candidate_ids)} sessions after {redis_client.OPTIMISTIC_COMMIT_MAX_RETRIES} "
+                "conflicting writes, they will be retried on the next tick."
+            )
+    if locked:
+        logger.info("Lock released.")
+
+
+def clean_expired_sessions_in_transaction(redis_session: redis_client.RedisSession, candidate_ids: list[str]) -> None:
+    with redis_session.pipeline(transaction=True) as pipeline:
+        pipeline.watch(redis_client.RedisKey.PUBSUB_CHANNEL)
+        try:
+            # Commands are run at once while watching, so the value is returned instead of the pipeline.
+            data = typing.cast(bytes | None, pipeline.get(redis_client.RedisKey.PUBSUB_CHANNEL))
+            app_state = models.AppState.load_from_storage(data)
+        except pydantic.ValidationError:
+            logger.info("Failed to validate app state.")
+            return
+
+        # Sessions might be pinged after the index was queried, so we need to check it again.
+        expire_threshold = datetime.datetime.now() - models.SESSION_EXPIRED_DELTA
+        expired_session_ids: list[str] = []
+        unindexed_session_ids: list[str] = []  # Already removed from the state, only left on the index
+        outdated_pings: redis_client.SortedSetScores = {}
+        for sid in candidate_ids:
+            if not (info := app_state.sessions.get(uuid.UUID(sid))):
+                unindexed_session_ids.append(sid)
+            elif info.ping_at >= expire_threshold:
+                outdated_pings[sid] = info.ping_at.timestamp()
+            else:
+                app_state.sessions.pop(uuid.UUID(sid))
+                expired_session_ids.append(sid)
+
+        if not expired_session_ids:
+            # State is not changed, so only the index is fixed, without rewriting the state or broadcasting.
+            pipeline.unwatch()
+            with redis_session.pipeline(transaction=False) as index_pipeline:
+                if outdated_pings:
+                    index_pipeline.zadd(redis_client.RedisKey.SESSION_PING_AT, outdated_pings)
+                if unindexed_session_ids:
+                    index_pipeline.zrem(redis_client.RedisKey.SESSION_PING_AT, *unindexed_session_ids)
+                index_pipeline.execute()
+            logger.info("No sessions to clean.")
+            return
+
+        pipeline.multi()
+        pipeline.incr(redis_client.RedisKey.APP_STATE_VERSION)
+        pipeline.set(redis_client.RedisKey.PUBSUB_CHANNEL, app_state.dump_for_storage())
+        for session_id, orders in app_state.archivable_orders.items():
+            redis_client.archive_handled_orders(pipeline, session_id, [o.model_dump_json() for o in orders])
+        if refreshed_pings := app_state.refreshed_pings | outdated_pings:
+            pipeline.zadd(redis_client.RedisKey.SESSION_PING_AT, refreshed_pings)
+        pipeline.zrem(redis_client.RedisKey.SESSION_PING_AT, *expired_session_ids, *unindexed_session_ids)
+        version, *_ = pipeline.execute()
+        redis_session.publish(redis_client.RedisKey.PUBSUB_CHANNEL, str(version))
+        logger.info(f"Cleaned {len(expired_session_ids)} sessions.")
+
+
+def session_cleaner(redis_dsn: str | None = None, interval: int = 5) -> None:
     redis_dsn = redis_dsn or os.getenv("REDIS_DSN") or "redis://localhost:6379/0"
 
-    redis_session = redis_client.RedisClient(dsn=redis_dsn).sync_session
+    redis_session = redis_client.connect(redis_dsn).sync_session
+    index_unindexed_sessions(redis_session)
     logger.info("Session cleaner started.")
     while True:
-        time.sleep(30)
-        with redis_session.lock(redis_client.RedisKey.APP_STATE_WRITE_LOCK):
-            logger.info("Lock acquired.")
-            try:
-                app_state_data = redis_session.get(redis_client.RedisKey.PUBSUB_CHANNEL)
-                app_state = models.AppState.model_validate_json(app_state_data)
-            except pydantic.ValidationError:
-                logger.info("Failed to validate app state.")
-                continue
-
-            if not (
-                expired_session_ids := [
-                    sid
-                    for sid, info in app_state.sessions.items()
-                    if info.ping_at + models.SESSION_EXPIRED_DELTA < datetime.datetime.now()
-                ]
-            ):
-                logger.info("No sessions to clean.")
-                continue
-
-            for sid in expired_session_ids:
-                del app_state.sessions[sid]
-
-            redis_session.set(redis_client.RedisKey.PUBSUB_CHANNEL, app_state.model_dump_json())
-            redis_session.publish(redis_client.RedisKey.PUBSUB_CHANNEL, app_state.model_dump_json())
-            logger.info(f"Cleaned {len(expired_session_ids)} sessions.")
-        logger.info("Lock released.")
+        time.sleep(interval)
+        metrics.registry.flush_if_due(redis_session)
 
+        # Only the expiry index is queried here, so nothing is done while no sessions are expired.
+        expire_threshold = datetime.datetime.now() - models.SESSION_EXPIRED_DELTA
+        if not (
+            candidate_ids := [
+                sid.decode()
+                for sid in redis_session.zrangebyscore(
+                    redis_client.RedisKey.SESSION_PING_AT, "-inf", expire_threshold.timestamp()
+                )
+            ]
+        ):
+            continue
 
-cli_patterns: list[typing.Callable] = [session_cleaner]
+        clean_expired_sessions(redis_session, candidate_ids)
@@ -0,0 +1,15 @@
+import logging
+import os
+
+import src.static_assets as static_assets
+
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
+
+def static_build() -> None:
+    """
+    Precompresses the static files (gzip, and brotli if installed) into STATIC_BUILD_DIR,
+    so that the API server doesn't compress them on the first startup.
+    Run it after the frontend build is copied into the static directory.
+    """
+    static_assets.static_assets.build()
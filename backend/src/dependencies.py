@@ -1,21 +1,31 @@
+import asyncio
 import contextlib
 import datetime
 import http
 import logging
+import os
+import random
+import time
 import traceback
 import typing
 import uuid
+import weakref
 
 import fastapi
 import playwright.async_api
 import pydantic
-import redis.asyncio as aioredis
+import redis
+import src.metrics as metrics
 import src.models as models
 import src.redis_client as redis_client
+import src.tracing as tracing
 import src.utils.stdlibs.str_utils as str_utils
 
 logger = logging.getLogger(__name__)
 
+# Seconds to trust the cached app state without querying Redis, while the PubSub listener is running.
+APP_STATE_SNAPSHOT_TTL = float(os.getenv("APP_STATE_SNAPSHOT_TTL", "5"))
+
 
 async def browser(request: fastapi.Request = None, websocket: fastapi.WebSocket = None) -> playwright.async_api.Browser:
     fastapi_app: fastapi.FastAPI = request.app if request else websocket.app
@@ -25,13 +35,15 @@ async def browser(request: fastapi.Request = None, websocket: fastapi.WebSocket
 browserDI = typing.Annotated[playwright.async_api.Browser, fastapi.Depends(browser)]
 
 
-async def redis_session_di(request: fastapi.Request = None, websocket: fastapi.WebSocket = None) -> aioredis.Redis:
+async def redis_session_di(
+    request: fastapi.Request = None, websocket: fastapi.WebSocket = None
+) -> redis_client.AsyncRedisSession:
     fastapi_app: fastapi.FastAPI = request.app if request else websocket.app
-    redis_cli: redis_client.RedisClient = fastapi_app.state.redis_client
+    redis_cli: redis_client.StateClient = fastapi_app.state.redis_client
     return await redis_cli.async_session
 
 
-redisDI = typing.Annotated[aioredis.Redis, fastapi.Depends(redis_session_di)]
+redisDI = typing.Annotated[redis_client.AsyncRedisSession, fastapi.Depends(redis_session_di)]
 
 
 async def get_session_id(
@@ -48,14 +60,79 @@ async def get_session_id(
 sessionIDDI = typing.Annotated[uuid.UUID | None, fastapi.Depends(get_session_id)]
 
 
-async def query_app_state(redis_cli: redisDI) -> models.AppState:
+def load_app_state(data: bytes | None) -> models.AppState:
     with contextlib.suppress(pydantic.ValidationError):
-        json_data = await redis_cli.get(redis_client.RedisKey.PUBSUB_CHANNEL)
-        return models.AppState.model_validate_json(json_data)
+        return models.AppState.load_from_storage(data)
     return models.AppState()
 
 
-appStateQuerierDI = typing.Annotated[models.AppState, fastapi.Depends(query_app_state)]
+async def query_app_state(redis_cli: redisDI) -> models.AppState:
+    return load_app_state(await redis_cli.get(redis_client.RedisKey.PUBSUB_CHANNEL))
+
+
+class AppStateSnapshotCache:
+    """
+    Per-worker cache of the validated app state, for the read-only dependencies.
+    Cached state is invalidated when a new version is published on the PubSub channel.
+    While the PubSub listener is running, the cached state is returned without touching Redis until ttl passes.
+    After that (or without the listener), only the version counter is queried to check if the cache is still valid.
+
+    Cached state is shared between requests, so it must not be modified.
+    """
+
+    def __init__(self, ttl: float = APP_STATE_SNAPSHOT_TTL) -> None:
+        self.ttl = ttl
+        self.listening = False
+        self.app_state: models.AppState | None = None
+        self.version: bytes | None = None
+        self.checked_at: float = 0
+
+    def invalidate(self) -> None:
+        self.app_state = None
+
+    async def get(self, redis_cli: redis_client.AsyncRedisSession) -> models.AppState:
+        if self.app_state and self.listening and time.monotonic() - self.checked_at < self.ttl:
+            return self.app_state
+
+        checked_at = time.monotonic()
+        if self.app_state and await redis_cli.get(redis_client.RedisKey.APP_STATE_VERSION) == self.version:
+            self.checked_at = checked_at
+            return self.app_state
+
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            pipeline.get(redis_client.RedisKey.APP_STATE_VERSION)
+            pipeline.get(redis_client.RedisKey.PUBSUB_CHANNEL)
+            version, data = await pipeline.execute()
+
+        app_state = load_app_state(data)
+        self.app_state, self.version, self.checked_at = app_state, version, checked_at
+        return app_state
+
+    async def listen(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        while True:
+            try:
+                async with redis_cli.pubsub() as pubsub:
+                    await pubsub.subscribe(redis_client.RedisKey.PUBSUB_CHANNEL)
+                    self.listening = True
+                    async for message in pubsub.listen():
+                        if message["type"] == "message" and message["data"] != self.version:
+                            self.invalidate()
+            except Exception as e:
+                logger.warning(f"App state snapshot listener disconnected: {e}")
+            finally:
+                self.listening = False
+                self.invalidate()
+            await asyncio.sleep(1)
+
+
+app_state_snapshot_cache = AppStateSnapshotCache()
+
+
+async def query_app_state_snapshot(redis_cli: redisDI) -> models.AppState:
+    return await app_state_snapshot_cache.get(redis_cli)
+
+
+appStateQuerierDI = typing.Annotated[models.AppState, fastapi.Depends(query_app_state_snapshot)]
 
 
 async def query_session(app: appStateQuerierDI, session_id: sessionIDDI) -> models.SessionInfo:
@@ -67,24 +144,124 @@ async def query_session(app: appStateQuerierDI, session_id: sessionIDDI) -> mode
 sessionInfoQuerierDI = typing.Annotated[models.SessionInfo, fastapi.Depends(query_session)]
 
 
+async def query_fresh_session(
+    app: typing.Annotated[models.AppState, fastapi.Depends(query_app_state)], session_id: sessionIDDI
+) -> models.SessionInfo:
+    # Not from the snapshot cache, for the requests which act on the shop with the session's current order.
+    return await query_session(app, session_id)
+
+
+freshSessionInfoQuerierDI = typing.Annotated[models.SessionInfo, fastapi.Depends(query_fresh_session)]
+
+
+def queue_app_state_commit(pipeline: redis_client.RedisCommands, app_state: models.AppState, data: bytes) -> None:
+    # APP_STATE_VERSION must be the first command, as the result is used as the new version.
+    pipeline.incr(redis_client.RedisKey.APP_STATE_VERSION)
+    pipeline.set(redis_client.RedisKey.PUBSUB_CHANNEL, data)
+    for session_id, orders in app_state.archivable_orders.items():
+        redis_client.archive_handled_orders(pipeline, session_id, [o.model_dump_json() for o in orders])
+    if refreshed_pings := app_state.refreshed_pings:
+        pipeline.zadd(redis_client.RedisKey.SESSION_PING_AT, refreshed_pings)
+
+
+async def finish_app_state_commit(
+    redis_cli: redis_client.AsyncRedisSession, app_state: models.AppState, version: int, broadcast: bool
+) -> None:
+    app_state.mark_committed()
+    app_state_snapshot_cache.invalidate()
+    if broadcast:
+        # Subscribers compare it with the version read by GET, which is the same bytes as the decimal string.
+        await redis_cli.publish(redis_client.RedisKey.PUBSUB_CHANNEL, str(version))
+
+
+# Optimistic commits of a worker are serialized, so that WATCH only has to resolve the conflicts between the workers.
+# Otherwise, the requests of a busy worker keep invalidating each other's WATCH and run out of the retries.
+_optimistic_commit_locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def optimistic_commit_lock() -> asyncio.Lock:
+    if not (lock := _optimistic_commit_locks.get(loop := asyncio.get_running_loop())):
+        # Locks which were waited on refer to their loops, so the closed loops are not always collected.
+        for closed_loop in [other for other in _optimistic_commit_locks if other.is_closed()]:
+            del _optimistic_commit_locks[closed_loop]
+        lock = _optimistic_commit_locks[loop] = asyncio.Lock()
+    return lock
+
+
+async def commit_app_state(
+    redis_cli: redis_client.AsyncRedisSession, app_state: models.AppState, base_data: bytes | None, broadcast: bool
+) -> None:
+    # Pings, archived orders and new sessions are all written on the blob, so an unchanged blob has nothing to commit.
+    # Skipping it keeps the version, so that the snapshot caches stay valid while the websockets poll their sessions.
+    if redis_client.APP_STATE_WRITE_MODE == "lock":
+        if (data := app_state.dump_for_storage()) == base_data:
+            return
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            queue_app_state_commit(pipeline, app_state, data)
+            version, *_ = await pipeline.execute()
+        await finish_app_state_commit(redis_cli, app_state, version, broadcast)
+        return
+
+    # Optimistic mode: the state is written only if nobody committed after we loaded it (compare-and-set).
+    # If somebody did, our changes are merged onto their state per session, and we try again.
+    async with optimistic_commit_lock():
+        for attempt in range(redis_client.OPTIMISTIC_COMMIT_MAX_RETRIES):
+            async with redis_cli.pipeline(transaction=True) as pipeline:
+                try:
+                    await pipeline.watch(redis_client.RedisKey.PUBSUB_CHANNEL)
+                    if (current_data := await pipeline.get(redis_client.RedisKey.PUBSUB_CHANNEL)) != base_data:
+                        app_state = models.AppState.merge(
+                            base=load_app_state(base_data), ours=app_state, theirs=load_app_state(current_data)
+                        )
+                        base_data = current_data
+                    if (data := app_state.dump_for_storage()) == base_data:
+                        return
+
+                    pipeline.multi()
+                    queue_app_state_commit(pipeline, app_state, data)
+                    version, *_ = await pipeline.execute()
+                except redis.WatchError:
+                    # Writers which conflicted at once would conflict again if they retried at once.
+                    await asyncio.sleep(random.uniform(0, redis_client.OPTIMISTIC_COMMIT_BACKOFF * 2**attempt))
+                    continue
+                except models.SessionConflictError as e:
+                    raise fastapi.HTTPException(status_code=http.HTTPStatus.CONFLICT, detail=str(e)) from e
+
+            await finish_app_state_commit(redis_cli, app_state, version, broadcast)
+            return
+
+    raise fastapi.HTTPException(status_code=http.HTTPStatus.CONFLICT, detail="Too many concurrent modifications")
+
+
 async def get_and_commit_app_state_with_lock(
     redis_cli: redisDI,
     used_as_dependency: bool = True,
     broadcast: bool = True,
 ) -> typing.AsyncGenerator[models.AppState, None]:
-    async with redis_cli.lock(redis_client.RedisKey.APP_STATE_WRITE_LOCK):
-        app_state = await query_app_state(redis_cli=redis_cli)
-        try:
-            yield app_state
-        except Exception as e:
-            logger.error(f"Error occurred while processing app state\n{''.join(traceback.format_exception(e))}")
-            if used_as_dependency:
-                raise
-        finally:
-            result = app_state.model_dump_json()
-            await redis_cli.set(redis_client.RedisKey.PUBSUB_CHANNEL, result)
-            if broadcast:
-                await redis_cli.publish(redis_client.RedisKey.PUBSUB_CHANNEL, result)
+    lock: typing.AsyncContextManager = (
+        redis_cli.lock(redis_client.RedisKey.APP_STATE_WRITE_LOCK)
+        if redis_client.APP_STATE_WRITE_MODE == "lock"
+        else contextlib.nullcontext()
+    )
+    mode = redis_client.APP_STATE_WRITE_MODE
+    waited_at, waited_at_ns = time.perf_counter(), time.time_ns()
+    async with lock:
+        metrics.APP_STATE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waited_at, mode=mode)
+        tracing.record_span("app_state.lock_wait", waited_at_ns, time.time_ns(), mode=mode)
+        with metrics.APP_STATE_LOCK_HOLD_SECONDS.time(mode=mode):
+            base_data: bytes | None = await redis_cli.get(redis_client.RedisKey.PUBSUB_CHANNEL)
+            app_state = load_app_state(base_data)
+            try:
+                yield app_state
+            except Exception as e:
+                logger.error(f"Error occurred while processing app state\n{''.join(traceback.format_exception(e))}")
+                if used_as_dependency:
+                    raise
+            finally:
+                with tracing.span("app_state.commit", mode=mode):
+                    await commit_app_state(redis_cli, app_state, base_data, broadcast)
 
 
 locked_app_state_context = contextlib.asynccontextmanager(get_and_commit_app_state_with_lock)
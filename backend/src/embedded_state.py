@@ -0,0 +1,646 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import fcntl
+import functools
+import logging
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
+import weakref
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+EMBEDDED_STATE_DSN_PREFIX = "sqlite://"
+# Seconds to wait for the other processes' write transactions, which take a few milliseconds at most.
+EMBEDDED_STATE_BUSY_TIMEOUT = float(os.getenv("EMBEDDED_STATE_BUSY_TIMEOUT", "5"))
+# Seconds between the tries to take a lock held by another process.
+EMBEDDED_LOCK_POLL_INTERVAL = 0.005
+EMBEDDED_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS strings (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lists (key BLOB NOT NULL, seq INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (key, seq));
+CREATE TABLE IF NOT EXISTS hashes (
+    key BLOB NOT NULL, field BLOB NOT NULL, value BLOB NOT NULL, PRIMARY KEY (key, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (
+    key BLOB NOT NULL, member BLOB NOT NULL, score REAL NOT NULL, PRIMARY KEY (key, member)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score);
+CREATE TABLE IF NOT EXISTS expires (key BLOB PRIMARY KEY, expire_at REAL NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS expires_expire_at ON expires (expire_at);
+"""
+DATA_TABLES = ("strings", "lists", "hashes", "zsets")
+WRITE_COMMANDS = frozenset(
+    ("set", "incr", "delete", "expire", "lpush", "ltrim", "hset", "hdel", "hincrbyfloat")
+    + ("zadd", "zrem", "zremrangebyscore")
+)
+READ_COMMANDS = frozenset(("get", "lrange", "hgetall", "hmget", "zrangebyscore", "zrevrangebyscore", "zcard"))
+
+Command = tuple[str, tuple, dict]
+EncodableT = bytes | str | int | float
+
+
+class EmbeddedStateError(redis.RedisError):
+    pass
+
+
+def encode(value: EncodableT) -> bytes:
+    # Same as redis-py, so that the values read back are the same bytes as on Redis.
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).removesuffix(".0").encode()
+    return str(value).encode()
+
+
+def score_bound(value: EncodableT) -> float:
+    return float(value.decode() if isinstance(value, bytes) else value)
+
+
+def dsn_path(dsn: str) -> pathlib.Path:
+    """
+    Path of the database on the DSN, which is read as SQLAlchemy does:
+    sqlite:///state/rosa.sqlite3 is relative to the working directory, and sqlite:////var/lib/rosa.sqlite3 is absolute.
+    """
+    url = urllib.parse.urlsplit(dsn)
+    # In-memory databases (sqlite://) cannot be shared by the processes, and no host is expected.
+    if url.scheme != "sqlite" or url.netloc or len(url.path) < 2:
+        raise ValueError(f"Invalid DSN of the embedded state, expected sqlite:///path/to/state.sqlite3: {dsn}")
+    return pathlib.Path(urllib.parse.unquote(url.path.removeprefix("/")))
+
+
+def seconds_of(value: int | datetime.timedelta) -> float:
+    return value.total_seconds() if isinstance(value, datetime.timedelta) else float(value)
+
+
+class EmbeddedStore:
+    """
+    The Redis commands used by ROSA, on a SQLite database in WAL mode, shared by the processes of a single node.
+    Each call of execute() is a transaction, so the pipelines are applied atomically as on Redis.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the threads of the process (e.g. the async sessions' executor), so it's guarded by the mutex.
+        self._connection = sqlite3.connect(
+            path, timeout=EMBEDDED_STATE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self._mutex = threading.Lock()
+        with self._mutex:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # Commits are not synced until the checkpoint, which is still durable against the process crashes.
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(EMBEDDED_STATE_SCHEMA)
+
+    def close(self) -> None:
+        with self._mutex:
+            self._connection.close()
+
+    def execute(self, commands: list[Command], watched: dict[bytes, bytes | None] | None = None) -> list:
+        """Runs the commands in a transaction. Raises WatchError if any watched key is changed since watched."""
+        writes = watched is not None or any(name in WRITE_COMMANDS for name, _, _ in commands)
+        with self._mutex:
+            db = self._connection
+            try:
+                # Writers take the write lock up front, so that the transaction never fails halfway as busy.
+                db.execute("BEGIN IMMEDIATE" if writes else "BEGIN")
+                try:
+                    if writes:
+                        self._purge_expired(db)
+                    if watched and any(self._get(db, key) != value for key, value in watched.items()):
+                        raise redis.WatchError("Watched variable changed.")
+                    results = [getattr(self, f"_{name}")(db, *args, **kwargs) for name, args, kwargs in commands]
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+                return results
+            except sqlite3.Error as e:
+                raise EmbeddedStateError(str(e)) from e
+
+    def _purge_expired(self, db: sqlite3.Connection) -> None:
+        if keys := [row[0] for row in db.execute("SELECT key FROM expires WHERE expire_at <= ?", (time.time(),))]:
+            self._delete(db, *keys)
+
+    def _is_alive(self, db: sqlite3.Connection, key: bytes) -> bool:
+        # Expired keys are purged only by the writers, so the readers skip them here.
+        row = db.execute("SELECT expire_at FROM expires WHERE key = ?", (key,)).fetchone()
+        return not row or row[0] > time.time()
+
+    def _get(self, db: sqlite3.Connection, key: EncodableT) -> bytes | None:
+        row = db.execute("SELECT value FROM strings WHERE key = ?", (encode(key),)).fetchone()
+        return row[0] if row and self._is_alive(db, encode(key)) else None
+
+    def _set(self, db: sqlite3.Connection, key: EncodableT, value: EncodableT) -> bool:
+        db.execute("INSERT OR REPLACE INTO strings VALUES (?, ?)", (encode(key), encode(value)))
+        db.execute("DELETE FROM expires WHERE key = ?", (encode(key),))
+        return True
+
+    def _incr(self, db: sqlite3.Connection, key: EncodableT) -> int:
+        value = int(self._get(db, key) or 0) + 1
+        db.execute("INSERT OR REPLACE INTO strings VALUES (?, ?)", (encode(key), encode(value)))
+        return value
+
+    def _delete(self, db: sqlite3.Connection, *keys: EncodableT) -> int:
+        deleted = 0
+        for key in map(encode, keys):
+            for table in DATA_TABLES:
+                deleted += db.execute(f"DELETE FROM {table} WHERE key = ?", (key,)).rowcount > 0  # nosec B608
+            db.execute("DELETE FROM expires WHERE key = ?", (key,))
+        return deleted
+
+    def _expire(self, db: sqlite3.Connection, key: EncodableT, ttl: int | datetime.timedelta) -> bool:
+        db.execute("INSERT OR REPLACE INTO expires VALUES (?, ?)", (encode(key), time.time() + seconds_of(ttl)))
+        return True
+
+    def _lpush(self, db: sqlite3.Connection, key: EncodableT, *values: EncodableT) -> int:
+        # Head of the list has the smallest seq, so each pushed value takes the seq before the current head.
+        (head,) = db.execute("SELECT COALESCE(MIN(seq), 0) FROM lists WHERE key = ?", (encode(key),)).fetchone()
+        db.executemany(
+            "INSERT INTO lists VALUES (?, ?, ?)",
+            [(encode(key), head - offset, encode(value)) for offset, value in enumerate(values, start=1)],
+        )
+        return db.execute("SELECT COUNT(*) FROM lists WHERE key = ?", (encode(key),)).fetchone()[0]
+
+    def _list_slice(self, db: sqlite3.Connection, key: bytes, start: int, end: int) -> tuple[int, int]:
+        # Redis ranges are inclusive and can count from the tail, so they're converted to LIMIT & OFFSET.
+        if start < 0 or end < 0:
+            (length,) = db.execute("SELECT COUNT(*) FROM lists WHERE key = ?", (key,)).fetchone()
+            start, end = (max(start + length, 0) if start < 0 else start), (end + length if end < 0 else end)
+        return max(end - start + 1, 0), start
+
+    def _lrange(self, db: sqlite3.Connection, key: EncodableT, start: int, end: int) -> list[bytes]:
+        if not self._is_alive(db, encode(key)):
+            return []
+        limit, offset = self._list_slice(db, encode(key), start, end)
+        query = "SELECT value FROM lists WHERE key = ? ORDER BY seq LIMIT ? OFFSET ?"
+        return [row[0] for row in db.execute(query, (encode(key), limit, offset))]
+
+    def _ltrim(self, db: sqlite3.Connection, key: EncodableT, start: int, end: int) -> bool:
+        limit, offset = self._list_slice(db, encode(key), start, end)
+        db.execute(
+            "DELETE FROM lists WHERE key = ? AND seq NOT IN "
+            "(SELECT seq FROM lists WHERE key = ? ORDER BY seq LIMIT ? OFFSET ?)",
+            (encode(key), encode(key), limit, offset),
+        )
+        return True
+
+    def _hset(self, db: sqlite3.Connection, key: EncodableT, field: EncodableT, value: EncodableT) -> int:
+        query = "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)"
+        existed = self._hmget(db, key, [field])[0] is not None
+        db.execute(query, (encode(key), encode(field), encode(value)))
+        return 0 if existed else 1
+
+    def _hdel(self, db: sqlite3.Connection, key: EncodableT, *fields: EncodableT) -> int:
+        query = "DELETE FROM hashes WHERE key = ? AND field = ?"
+        return sum(db.execute(query, (encode(key), encode(field))).rowcount for field in fields)
+
+    def _hincrbyfloat(self, db: sqlite3.Connection, key: EncodableT, field: EncodableT, amount: float) -> float:
+        value = float(self._hmget(db, key, [field])[0] or 0) + amount
+        db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)", (encode(key), encode(field), encode(value)))
+        return value
+
+    def _hgetall(self, db: sqlite3.Connection, key: EncodableT) -> dict[bytes, bytes]:
+        if not self._is_alive(db, encode(key)):
+            return {}
+        return dict(db.execute("SELECT field, value FROM hashes WHERE key = ?", (encode(key),)).fetchall())
+
+    def _hmget(self, db: sqlite3.Connection, key: EncodableT, keys: list[EncodableT]) -> list[bytes | None]:
+        if not self._is_alive(db, encode(key)):
+            return [None] * len(keys)
+        query = "SELECT value FROM hashes WHERE key = ? AND field = ?"
+        return [(row[0] if (row := db.execute(query, (encode(key), encode(f))).fetchone()) else None) for f in keys]
+
+    def _zadd(
+        self, db: sqlite3.Connection, name: EncodableT, mapping: dict[EncodableT, float], nx: bool = False
+    ) -> int:
+        query = f"INSERT OR {'IGNORE' if nx else 'REPLACE'} INTO zsets VALUES (?, ?, ?)"
+        added = 0
+        for member, score in mapping.items():
+            exists = db.execute(
+                "SELECT 1 FROM zsets WHERE key = ? AND member = ?", (encode(name), encode(member))
+            ).fetchone()
+            db.execute(query, (encode(name), encode(member), float(score)))
+            added += not exists
+        return added
+
+    def _zrem(self, db: sqlite3.Connection, name: EncodableT, *members: EncodableT) -> int:
+        query = "DELETE FROM zsets WHERE key = ? AND member = ?"
+        return sum(db.execute(query, (encode(name), encode(member))).rowcount for member in members)
+
+    def _zrangebyscore(self, db: sqlite3.Connection, name: EncodableT, min: EncodableT, max: EncodableT) -> list[bytes]:
+        if not self._is_alive(db, encode(name)):
+            return []
+        query = "SELECT member FROM zsets WHERE key = ? AND score BETWEEN ? AND ? ORDER BY score, member"
+        return [row[0] for row in db.execute(query, (encode(name), score_bound(min), score_bound(max)))]
+
+    def _zrevrangebyscore(
+        self,
+        db: sqlite3.Connection,
+        name: EncodableT,
+        max: EncodableT,
+        min: EncodableT,
+        start: int | None = None,
+        num: int | None = None,
+    ) -> list[bytes]:
+        if not self._is_alive(db, encode(name)):
+            return []
+        query = (
+            "SELECT member FROM zsets WHERE key = ? AND score BETWEEN ? AND ? "
+            "ORDER BY score DESC, member DESC LIMIT ? OFFSET ?"
+        )
+        params = (encode(name), score_bound(min), score_bound(max), -1 if num is None else num, start or 0)
+        return [row[0] for row in db.execute(query, params)]
+
+    def _zremrangebyscore(self, db: sqlite3.Connection, name: EncodableT, min: EncodableT, max: EncodableT) -> int:
+        query = "DELETE FROM zsets WHERE key = ? AND score BETWEEN ? AND ?"
+        return db.execute(query, (encode(name), score_bound(min), score_bound(max))).rowcount
+
+    def _zcard(self, db: sqlite3.Connection, name: EncodableT) -> int:
+        if not self._is_alive(db, encode(name)):
+            return 0
+        return db.execute("SELECT COUNT(*) FROM zsets WHERE key = ?", (encode(name),)).fetchone()[0]
+
+
+class Notifier:
+    """
+    PubSub between the processes of a single node, over the Unix datagram sockets on a directory.
+    Each subscription binds a socket on the directory, and a message is sent to every socket on it.
+    Messages are dropped if a subscriber doesn't read them in time, as Redis drops them for the slow clients.
+    """
+
+    def __init__(self, directory: pathlib.Path) -> None:
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def publish(self, channel: EncodableT, message: EncodableT) -> int:
+        datagram = encode(channel) + b"\0" + encode(message)
+        received = 0
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for path in self.directory.iterdir():
+                try:
+                    sock.sendto(datagram, str(path))
+                    received += 1
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Socket of a subscriber which exited without unbinding it.
+                    with contextlib.suppress(FileNotFoundError):
+                        path.unlink()
+                except BlockingIOError:
+                    pass
+        return received
+
+    def bind(self) -> tuple[socket.socket, pathlib.Path]:
+        # Short name, as the socket paths are limited to about 100 bytes.
+        path = self.directory / uuid.uuid4().hex[:16]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(path))
+        return sock, path
+
+
+class PubSub:
+    """Subset of redis.client.PubSub and redis.asyncio.client.PubSub, without the subscribe messages."""
+
+    def __init__(self, notifier: Notifier) -> None:
+        self.channels: set[bytes] = set()
+        self.sock, self.path = notifier.bind()
+        self._finalizer = weakref.finalize(self, PubSub._unbind, self.sock, self.path)
+
+    @staticmethod
+    def _unbind(sock: socket.socket, path: pathlib.Path) -> None:
+        sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+
+    def _parse(self, datagram: bytes) -> dict[str, typing.Any] | None:
+        channel, _, data = datagram.partition(b"\0")
+        if channel not in self.channels:
+            return None
+        return {"type": "message", "pattern": None, "channel": channel, "data": data}
+
+    def subscribe(self, *channels: EncodableT) -> None:
+        self.channels.update(map(encode, channels))
+
+    def unsubscribe(self, *channels: EncodableT) -> None:
+        self.channels.difference_update(map(encode, channels))
+        if not self.channels:
+            self.close()
+
+    def get_message(self, ignore_subscribe_messages: bool = False, timeout: float = 0.0) -> dict | None:
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0 and self.sock.fileno() != -1:
+            self.sock.settimeout(remaining)
+            with contextlib.suppress(TimeoutError):
+                if message := self._parse(self.sock.recv(65536)):
+                    return message
+        return None
+
+    def close(self) -> None:
+        self._finalizer()
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+
+class AsyncPubSub(PubSub):
+    def __init__(self, notifier: Notifier) -> None:
+        super().__init__(notifier)
+        self.sock.setblocking(False)
+
+    async def subscribe(self, *channels: EncodableT) -> None:  # type: ignore[override]
+        super().subscribe(*channels)
+
+    async def unsubscribe(self, *channels: EncodableT) -> None:  # type: ignore[override]
+        super().unsubscribe(*channels)
+
+    async def get_message(  # type: ignore[override]
+        self, ignore_subscribe_messages: bool = False, timeout: float | None = 0.0
+    ) -> dict | None:
+        loop = asyncio.get_running_loop()
+        with contextlib.suppress(asyncio.TimeoutError):
+            async with asyncio.timeout(timeout):
+                while self.sock.fileno() != -1:
+                    if message := self._parse(await loop.sock_recv(self.sock, 65536)):
+                        return message
+        return None
+
+    async def listen(self) -> typing.AsyncIterator[dict]:
+        while self.channels:
+            if message := await self.get_message(timeout=None):
+                yield message
+
+    async def aclose(self) -> None:
+        self.close()
+
+    async def __aenter__(self) -> typing.Self:
+        return self
+
+    async def __aexit__(self, *args: typing.Any) -> None:
+        self.close()
+
+
+class Lock:
+    """
+    Lock of the name, held by a single thread or task of the node at a time.
+    Waiters of the same process are queued on the in-process lock, and only its holder takes the file lock,
+    which is polled while another process is holding it.
+    """
+
+    def __init__(self, path: pathlib.Path, thread_lock: threading.Lock, task_lock: asyncio.Lock | None) -> None:
+        self.path = path
+        self.thread_lock = thread_lock
+        self.task_lock = task_lock
+        self._fd: int | None = None
+
+    def _try_lock_file(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def _unlock_file(self) -> None:
+        if (fd := self._fd) is not None:
+            self._fd = None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self) -> typing.Self:
+        self.thread_lock.acquire()
+        while not self._try_lock_file():
+            time.sleep(EMBEDDED_LOCK_POLL_INTERVAL)
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self._unlock_file()
+        self.thread_lock.release()
+
+    async def __aenter__(self) -> typing.Self:
+        if not self.task_lock:
+            raise RuntimeError("Lock is not taken on the event loop")
+        await self.task_lock.acquire()
+        try:
+            while not self._try_lock_file():
+                await asyncio.sleep(EMBEDDED_LOCK_POLL_INTERVAL)
+        except BaseException:
+            self.task_lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, *args: typing.Any) -> None:
+        self._unlock_file()
+        typing.cast(asyncio.Lock, self.task_lock).release()
+
+
+class Pipeline:
+    """
+    Subset of redis.client.Pipeline. Commands are queued and run in a transaction on execute(),
+    except while watching the keys (until multi() is called), when they're run right away as on redis-py.
+    """
+
+    def __init__(self, store: EmbeddedStore) -> None:
+        self.store = store
+        self.commands: list[Command] = []
+        self.watched: dict[bytes, bytes | None] | None = None
+        self.immediate = False
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Any]:
+        if name not in WRITE_COMMANDS | READ_COMMANDS:
+            raise AttributeError(name)
+        if self.immediate:
+            return lambda *args, **kwargs: self.store.execute([(name, args, kwargs)])[0]
+        return functools.partial(self._queue, name)
+
+    def _queue(self, name: str, *args: typing.Any, **kwargs: typing.Any) -> typing.Self:
+        self.commands.append((name, args, kwargs))
+        return self
+
+    def watch(self, *keys: EncodableT) -> None:
+        values = self.store.execute([("get", (key,), {}) for key in keys])
+        self.watched = dict(zip(map(encode, keys), values))
+        self.immediate = True
+
+    def unwatch(self) -> None:
+        self.watched, self.immediate = None, False
+
+    def multi(self) -> None:
+        self.immediate = False
+
+    def reset(self) -> None:
+        self.commands = []
+        self.unwatch()
+
+    def execute(self) -> list:
+        try:
+            return self.store.execute(self.commands, self.watched)
+        finally:
+            self.reset()
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.reset()
+
+
+class AsyncPipeline(Pipeline):
+    """Same as Pipeline, with the immediate commands and execute() run on the executor of the session."""
+
+    def __init__(self, store: EmbeddedStore, run: typing.Callable[..., typing.Awaitable]) -> None:
+        super().__init__(store)
+        self.run = run
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Any]:
+        if name in WRITE_COMMANDS | READ_COMMANDS and self.immediate:
+            return lambda *args, **kwargs: self.run(lambda: self.store.execute([(name, args, kwargs)])[0])
+        return super().__getattr__(name)
+
+    async def watch(self, *keys: EncodableT) -> None:  # type: ignore[override]
+        await self.run(super().watch, *keys)
+
+    async def execute(self) -> list:  # type: ignore[override]
+        return await self.run(super().execute)
+
+    async def __aenter__(self) -> typing.Self:
+        return self
+
+    async def __aexit__(self, *args: typing.Any) -> None:
+        self.reset()
+
+
+class EmbeddedRedis:
+    """Subset of redis.Redis used by ROSA, on the embedded store"""
+
+    def __init__(self, client: EmbeddedStateClient) -> None:
+        self.client = client
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Any]:
+        if name not in WRITE_COMMANDS | READ_COMMANDS:
+            raise AttributeError(name)
+        return functools.partial(self._execute, name)
+
+    def _execute(self, name: str, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        return self.client.store.execute([(name, args, kwargs)])[0]
+
+    def ping(self) -> bool:
+        return True
+
+    def publish(self, channel: EncodableT, message: EncodableT) -> int:
+        return self.client.notifier.publish(channel, message)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> PubSub:
+        return PubSub(self.client.notifier)
+
+    def pipeline(self, transaction: bool = True) -> Pipeline:
+        return Pipeline(self.client.store)
+
+    def lock(self, name: str, timeout: float | None = None) -> Lock:
+        # File locks are released when the holding process dies, so they don't need the timeout of the Redis locks.
+        return self.client.lock(name)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        pass
+
+
+class AsyncEmbeddedRedis(EmbeddedRedis):
+    """
+    Subset of redis.asyncio.Redis used by ROSA, on the embedded store.
+    Commands are run on a thread, so that the event loop doesn't wait for the other processes' transactions.
+    """
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Any]:
+        command = super().__getattr__(name)
+        return lambda *args, **kwargs: self.client.run(command, *args, **kwargs)
+
+    async def ping(self) -> bool:  # type: ignore[override]
+        return True
+
+    async def publish(self, channel: EncodableT, message: EncodableT) -> int:  # type: ignore[override]
+        return await self.client.run(self.client.notifier.publish, channel, message)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> AsyncPubSub:
+        return AsyncPubSub(self.client.notifier)
+
+    def pipeline(self, transaction: bool = True) -> AsyncPipeline:
+        return AsyncPipeline(self.client.store, self.client.run)
+
+    async def aclose(self) -> None:
+        pass
+
+    def __await__(self) -> typing.Generator[typing.Any, None, typing.Self]:
+        # Same as redis.asyncio.Redis, which can be awaited to be initialized.
+        return self._initialize().__await__()
+
+    async def _initialize(self) -> typing.Self:
+        return self
+
+
+class EmbeddedStateClient:
+    """
+    Replacement of RedisClient for the single node deployments, chosen by a DSN like sqlite:///state/rosa.sqlite3
+    (or sqlite:////var/lib/rosa/state.sqlite3 for an absolute path).
+
+    State is stored on the SQLite database (WAL mode) shared by the uvicorn workers and the CLI processes,
+    the locks are the file locks next to it, and PubSub messages are sent over the Unix datagram sockets,
+    so no network round trip nor the Redis server is involved.
+    """
+
+    def __init__(self, dsn: str) -> None:
+        self.path = dsn_path(dsn)
+        self.store = EmbeddedStore(self.path)
+        self.notifier = Notifier(self.path.with_name(f"{self.path.name}.pubsub"))
+        # Single thread, so that the commands of the async sessions are run in order as on a Redis connection.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedded-state")
+        self._thread_locks: dict[str, threading.Lock] = {}
+        self._task_locks: dict[tuple[asyncio.AbstractEventLoop, str], asyncio.Lock] = {}
+        logger.info(f"Embedded state store opened: {self.path}")
+
+    async def run(self, fn: typing.Callable[..., typing.Any], *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def lock(self, name: str) -> Lock:
+        task_lock: asyncio.Lock | None = None
+        with contextlib.suppress(RuntimeError):  # Not on the event loop, e.g. on the CLI processes
+            task_lock = self._task_locks.setdefault((asyncio.get_running_loop(), name), asyncio.Lock())
+        thread_lock = self._thread_locks.setdefault(name, threading.Lock())
+        # Names may contain the printer's device path, so they're quoted to be a file name.
+        return Lock(
+            self.path.with_name(f"{self.path.name}.{urllib.parse.quote(name, safe='')}.lock"), thread_lock, task_lock
+        )
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.store.close()
+        logger.info("Embedded state store closed")
+
+    @property
+    def async_session(self) -> AsyncEmbeddedRedis:
+        return AsyncEmbeddedRedis(self)
+
+    @property
+    def sync_session(self) -> EmbeddedRedis:
+        return EmbeddedRedis(self)
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import importlib
+import logging
+import multiprocessing
+import multiprocessing.shared_memory as shared_memory
+import os
+import signal
+import typing
+import weakref
+
+import PIL.Image
+import pydantic
+import src.metrics as metrics
+import src.tracing as tracing
+
+if typing.TYPE_CHECKING:
+    import src.models as models
+    import src.utils.hals.printers.escp as escp_utils
+    import src.utils.hals.printers.tspl as tspl_utils
+
+ImageExecutorKind = typing.Literal["process", "thread", "inline"]
+T = typing.TypeVar("T")
+
+# process: runs the image conversion & encoding on the worker processes, so a label doesn't stall the other requests.
+# thread: runs them on the threads, which helps less as only some parts of Pillow release the GIL.
+# inline: runs them on the event loop.
+IMAGE_EXECUTOR: ImageExecutorKind = typing.cast(ImageExecutorKind, os.getenv("IMAGE_EXECUTOR", "process"))
+IMAGE_EXECUTOR_WORKERS = int(os.getenv("IMAGE_EXECUTOR_WORKERS", "2"))
+# Modules used by the jobs on the worker processes, which are imported by name as nothing on this module uses them.
+WORKER_MODULES = (
+    "src.models",
+    "src.utils.hals.printers.escp",
+    "src.utils.hals.printers.tspl",
+    "src.utils.renderers.html_renderer",
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Shared memory blocks of the live images, keyed by id() as PIL images are not hashable.
+# Each block is kept until its image is garbage collected, so that the same image is copied only once.
+_shared_bitmaps: dict[int, SharedBitmap] = {}
+
+
+class SharedBitmap(pydantic.BaseModel):
+    """1-bit image passed to the other process through a shared memory block, instead of pickling the pixels"""
+
+    name: str
+    size: tuple[int, int]
+
+    model_config = pydantic.ConfigDict(frozen=True)
+
+    @property
+    def nbytes(self) -> int:
+        # Each row is packed into the whole bytes.
+        return (self.size[0] + 7) // 8 * self.size[1]
+
+    @classmethod
+    def share(cls, image: PIL.Image.Image) -> tuple[SharedBitmap, shared_memory.SharedMemory]:
+        """Copies the image to a new shared memory block. The caller owns the block, and must unlink it."""
+        bw_img = image if image.mode == "1" else image.convert("1")
+        data = bw_img.tobytes()
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[: len(data)] = data
+        return cls(name=block.name, size=bw_img.size), block
+
+    @classmethod
+    def of(cls, image: PIL.Image.Image) -> SharedBitmap:
+        """Shares the image until it's garbage collected."""
+        if not (bitmap := _shared_bitmaps.get(id(image))):
+            bitmap, block = cls.share(image)
+            bitmap._bind(image, block)
+        return bitmap
+
+    def load(self, bind: bool = False) -> PIL.Image.Image:
+        """Copies the pixels to a new image. If bind is set, the block is unlinked along with the new image."""
+        block = shared_memory.SharedMemory(name=self.name)
+        with block.buf[: self.nbytes] as view:
+            image = PIL.Image.frombytes("1", self.size, view)
+        if bind:
+            self._bind(image, block)
+        else:
+            block.close()
+        return image
+
+    def unlink(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            block = shared_memory.SharedMemory(name=self.name)
+            block.close()
+            block.unlink()
+
+    def _bind(self, image: PIL.Image.Image, block: shared_memory.SharedMemory) -> None:
+        _shared_bitmaps[id(image)] = self
+        weakref.finalize(image, _release_shared_bitmap, id(image), block)
+
+
+def _release_shared_bitmap(key: int, block: shared_memory.SharedMemory) -> None:
+    _shared_bitmaps.pop(key, None)
+    block.close()
+    block.unlink()
+
+
+def _init_worker() -> None:
+    # Modules are imported once when the worker starts, instead of on the first label.
+    for module_name in WORKER_MODULES:
+        importlib.import_module(module_name)
+
+    # Ctrl+C is handled by the API server, which shuts the workers down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_background(background: SharedBitmap) -> PIL.Image.Image:
+    # Backgrounds are shared once per layout, and the same image lets the TSPL driver skip hashing it again.
+    return background.load()
+
+
+def _decode_screenshot(screenshot: bytes) -> SharedBitmap:
+    import src.utils.renderers.html_renderer as html_renderer
+
+    bitmap, block = SharedBitmap.share(html_renderer.image_to_bw(screenshot))
+    block.close()  # The API server unlinks it after loading.
+    return bitmap
+
+
+def _encode_label(
+    printer: models.Printer,
+    label: SharedBitmap,
+    info: dict[str, typing.Any],
+    background: SharedBitmap | None,
+    qrcode_box: tuple[int, int, int] | None,
+    stored_files: list[str] | None,
+) -> tspl_utils.TSPL | escp_utils.ESCP:
+    import src.utils.renderers.html_renderer as html_renderer
+
+    image = label.load()
+    image.info.update(info)
+    if background:
+        image.info["label_layout"] = html_renderer.LabelLayout(
+            background=_load_background(background), qrcode_box=qrcode_box
+        )
+    return printer.encode_label(image, stored_files)
+
+
+def _unlink_result(future: concurrent.futures.Future[SharedBitmap]) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().unlink()
+
+
+class ImageExecutor:
+    """
+    Runs the CPU-bound image conversion & encoding out of the event loop.
+    Runs them on the event loop (as the CLI tools and the benchmarks do) until it's started.
+
+    Usage:
+        image_executor.start()  # on startup
+        await image_executor.warm_up()  # spawns the workers before the first label
+        image = await image_executor.decode_screenshot(png)
+        driver_ctx = await image_executor.encode_label(printer, image)
+        image_executor.shutdown()
+    """
+
+    def __init__(self, kind: ImageExecutorKind = IMAGE_EXECUTOR, workers: int = IMAGE_EXECUTOR_WORKERS) -> None:
+        self.kind = kind
+        self.workers = workers
+        self._pool: concurrent.futures.Executor | None = None
+
+    @property
+    def is_process_pool(self) -> bool:
+        return isinstance(self._pool, concurrent.futures.ProcessPoolExecutor)
+
+    def start(self) -> None:
+        if self.kind == "process":
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                # Forking the API server would copy its event loop and the threads of Playwright.
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        elif self.kind == "thread":
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="image-executor"
+            )
+
+    def shutdown(self) -> None:
+        if pool := self._pool:
+            self._pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self) -> None:
+        # Workers are spawned on demand, so as many jobs as the workers are submitted at once.
+        if self.is_process_pool:
+            await asyncio.gather(*(self._run(os.getpid) for _ in range(self.workers)))
+
+    async def _run(
+        self,
+        fn: typing.Callable[..., T],
+        *args: typing.Any,
+        discard: typing.Callable[[concurrent.futures.Future[T]], None] | None = None,
+    ) -> T:
+        if not (pool := self._pool):
+            return fn(*args)
+
+        if self.is_process_pool:
+            future = pool.submit(fn, *args)
+        else:
+            # Threads don't inherit the context, which holds the current span.
+            future = pool.submit(contextvars.copy_context().run, fn, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Job cannot be cancelled once it's running, so its result is cleaned up when it's done.
+            if discard:
+                future.add_done_callback(discard)
+            raise
+        except concurrent.futures.process.BrokenProcessPool:
+            # A crashed worker breaks the whole pool, so it's replaced for the next jobs.
+            logger.error("Image executor is broken, restarting the workers")
+            if self._pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.start()
+            raise
+
+    async def decode_screenshot(self, screenshot: bytes) -> PIL.Image.Image:
+        import src.utils.renderers.html_renderer as html_renderer
+
+        if not self.is_process_pool:
+            return await self._run(html_renderer.image_to_bw, screenshot)
+
+        # Metrics & spans recorded on the workers are not collected, so they are recorded here instead.
+        with tracing.span("image_to_bw"), metrics.IMAGE_TO_BW_SECONDS.time():
+            bitmap = await self._run(_decode_screenshot, screenshot, discard=_unlink_result)
+            # Block is kept along with the image, so that printing it doesn't copy the pixels again.
+            return bitmap.load(bind=True)
+
+    async def encode_label(
+        self, printer: models.Printer, image: PIL.Image.Image, stored_files: list[str] | None = None
+    ) -> tspl_utils.TSPL | escp_utils.ESCP:
+        if not self.is_process_pool:
+            return await self._run(printer.encode_label, image, stored_files)
+
+        layout = image.info.get("label_layout")
+        info = {key: value for key, value in image.info.items() if key != "label_layout"}
+        return await self._run(
+            _encode_label,
+            printer,
+            SharedBitmap.of(image),
+            info,
+            SharedBitmap.of(layout.background) if layout else None,
+            layout.qrcode_box if layout else None,
+            stored_files,
+        )
+
+
+image_executor = ImageExecutor()
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+import typing
+
+import src.metrics as metrics
+import src.models as models
+import src.utils.renderers.html_renderer as html_renderer
+
+LABEL_STORE_DIR = pathlib.Path(os.getenv("LABEL_STORE_DIR", "label_store"))
+LABEL_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+    order_id TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    label_digest TEXT NOT NULL,
+    object TEXT NOT NULL,
+    rendered_at REAL NOT NULL,
+    PRIMARY KEY (order_id, profile, position)
+);
+"""
+
+Label = tuple[str, dict[str, str]]  # template id & context
+
+
+class StoredLabelPrintError(Exception):
+    """Raised when a stored label could not be printed, after the labels before it are printed."""
+
+    def __init__(self, printed: int) -> None:
+        super().__init__(f"Failed to print the stored label at {printed}")
+        self.printed = printed
+
+
+def label_digest(label: Label) -> str:
+    # Template version is included, so the labels are rendered again when the template is changed.
+    template_id, context = label
+    version = html_renderer.template_registry.get(template_id).version
+    return hashlib.sha256(json.dumps([version, context], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class LabelStore:
+    """
+    Printer commands of the labels rendered ahead of the event by the label-prerender command.
+
+    Payloads are stored as files named by the sha256 of the content (objects/ab/cdef...), which are memory-mapped
+    and written to the printers as-is. The sqlite index maps the order id & printer profile to the payloads
+    of its labels (nameplate first, then the exchange tickets), along with the digest of the label inputs,
+    so that the labels of the changed orders are not served.
+
+    Usage:
+        object_name = label_store.write_object(payload)  # on any process
+        label_store.put(order_id, profile_key, labels, object_names)
+        label_store.get(order_id, profile_key, labels)  # paths of the payloads, or None if any of them is outdated
+        label_store.prune(before=started_at)  # removes the payloads which are not referred anymore
+    """
+
+    def __init__(self, directory: pathlib.Path = LABEL_STORE_DIR) -> None:
+        self.directory = directory
+
+    @property
+    def index_path(self) -> pathlib.Path:
+        return self.directory / "index.sqlite3"
+
+    def object_path(self, object_name: str) -> pathlib.Path:
+        return self.directory / "objects" / object_name[:2] / object_name[2:]
+
+    @contextlib.contextmanager
+    def connect(self) -> typing.Iterator[sqlite3.Connection]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.index_path)
+        try:
+            # WAL lets the API server read the index while the command is writing it.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(LABEL_STORE_SCHEMA)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def write_object(self, payload: bytes) -> str:
+        object_name = hashlib.sha256(payload).hexdigest()
+        if (path := self.object_path(object_name)).exists():
+            return object_name
+
+        # Written to a temporary file first, so that a partially written payload is never served.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            file.write(payload)
+        os.replace(file.name, path)
+        return object_name
+
+    def put(self, order_id: str, profile_key: str, labels: list[Label], object_names: list[str]) -> None:
+        rendered_at = time.time()
+        with self.connect() as connection:
+            connection.execute("DELETE FROM labels WHERE order_id = ? AND profile = ?", (order_id, profile_key))
+            connection.executemany(
+                "INSERT INTO labels VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (order_id, profile_key, position, label_digest(label), object_name, rendered_at)
+                    for position, (label, object_name) in enumerate(zip(labels, object_names))
+                ],
+            )
+
+    def get(self, order_id: str, profile_key: str, labels: list[Label]) -> list[pathlib.Path] | None:
+        if not self.index_path.exists():
+            return None
+
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT label_digest, object FROM labels WHERE order_id = ? AND profile = ? ORDER BY position",
+                (order_id, profile_key),
+            ).fetchall()
+        # Labels to print are the leading ones of the stored labels, e.g. only the nameplate.
+        if len(rows) < len(labels) or any(row[0] != label_digest(label) for row, label in zip(rows, labels)):
+            return None
+        paths = [self.object_path(row[1]) for row in rows[: len(labels)]]
+        return paths if all(path.exists() for path in paths) else None
+
+    def prune(self, before: float) -> int:
+        """
+        Removes the payloads which are not referred by the index, and returns the number of the removed ones.
+        Only the files modified before the given time are removed, so that the payloads being stored are kept.
+        """
+        if not self.index_path.exists():
+            return 0
+
+        with self.connect() as connection:
+            referred = {row[0] for row in connection.execute("SELECT DISTINCT object FROM labels")}
+
+        removed = 0
+        # Left-over temporary files of the interrupted writes are not referred either.
+        for path in (self.directory / "objects").glob("*/*"):
+            if path.parent.name + path.name in referred:
+                continue
+            # Might be removed at the same time, e.g. by the prune of another process.
+            with contextlib.suppress(FileNotFoundError):
+                if path.stat().st_mtime < before:
+                    path.unlink()
+                    removed += 1
+        return removed
+
+    async def print_labels(self, printer: models.Printer, order_id: str, labels: list[Label]) -> int:
+        """
+        Prints the stored labels, and returns the number of the printed ones, which is 0 if any of them is not stored.
+        If printing fails, StoredLabelPrintError tells how many labels were printed before,
+        so that the rest can be printed without printing the same label twice.
+        """
+        printed = 0
+        try:
+            if not (paths := await asyncio.to_thread(self.get, order_id, printer.profile_key, labels)):
+                metrics.LABEL_STORE_LOOKUPS_TOTAL.inc(result="miss")
+                return 0
+
+            metrics.LABEL_STORE_LOOKUPS_TOTAL.inc(result="hit")
+            for path in paths:
+                await asyncio.to_thread(printer.print_stored_payload, path)
+                printed += 1
+            return printed
+        except Exception as e:
+            raise StoredLabelPrintError(printed) from e
+
+
+label_store = LabelStore()
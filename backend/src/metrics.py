@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import redis
+import src.redis_client as redis_client
+
+logger = logging.getLogger(__name__)
+
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def series_sort_key(labels: dict[str, str]) -> tuple[list[tuple[str, str]], float]:
+    return sorted((k, v) for k, v in labels.items() if k != "le"), float(labels.get("le", 0))
+
+
+class Metric(abc.ABC):
+    type: typing.ClassVar[str]
+    suffixes: typing.ClassVar[tuple[str, ...]] = ("",)
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        # Increments since the last flush, keyed by the label values.
+        self._values: dict[tuple[str, ...], list[float]] = {}
+        registry.register(self)
+
+    def _label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _field(self, suffix: str, labels: dict[str, str]) -> str:
+        return json.dumps([self.name + suffix, labels], ensure_ascii=False)
+
+    @abc.abstractmethod
+    def _iter_fields(self, labels: dict[str, str], values: list[float]) -> typing.Iterator[tuple[str, float]]:
+        """Yields the Redis hash fields of the series and their increments, from the values recorded since the flush."""
+
+    def collect(self) -> dict[str, float]:
+        with self._lock:
+            values, self._values = self._values, {}
+        return {
+            field: delta
+            for label_values, value in values.items()
+            for field, delta in self._iter_fields(dict(zip(self.label_names, label_values)), value)
+        }
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            if (values := self._values.get(key)) is None:
+                self._values[key] = [amount]
+            else:
+                values[0] += amount
+
+    def _iter_fields(self, labels: dict[str, str], values: list[float]) -> typing.Iterator[tuple[str, float]]:
+        yield self._field("", labels), values[0]
+
+
+class Histogram(Metric):
+    type = "histogram"
+    suffixes = ("_bucket", "_sum", "_count")
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if (values := self._values.get(key)) is None:
+                # Non-cumulative counts of each bucket and +Inf, followed by the sum of the observed values.
+                values = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> typing.Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _iter_fields(self, labels: dict[str, str], values: list[float]) -> typing.Iterator[tuple[str, float]]:
+        # Sum of the increments is the increment of the sums, so the cumulative buckets can be flushed as increments.
+        cumulative = 0.0
+        for bound, count in zip((*map(str, self.buckets), "+Inf"), values[:-1]):
+            cumulative += count
+            yield self._field("_bucket", labels | {"le": bound}), cumulative
+        yield self._field("_sum", labels), values[-1]
+        yield self._field("_count", labels), cumulative
+
+
+class MetricRegistry:
+    """
+    Metrics are recorded on the process memory, and only the increments since the last flush are written to a Redis hash
+    with HINCRBYFLOAT, so that every uvicorn worker and CLI process adds up to the same series.
+    Recording a value is a dictionary update under a lock, so it's cheap enough to stay on the hot paths.
+
+    Usage:
+        with metrics.RENDER_HTML_SECONDS.time(template="nameplate_label"):
+            ...
+        metrics.READER_SCANS_TOTAL.inc(reader="...")
+        metrics.registry.flush_if_due(redis_session)  # on the CLI loops, web workers flush on a background task
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.flushed_at = time.monotonic()
+        # Increments that failed to be flushed, retried on the next flush.
+        self._unflushed: dict[str, float] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def collect(self) -> dict[str, float]:
+        fields, self._unflushed = self._unflushed, {}
+        for metric in self.metrics.values():
+            for field, delta in metric.collect().items():
+                fields[field] = fields.get(field, 0) + delta
+        return fields
+
+    def reset(self) -> None:
+        """Drops the increments not flushed yet, e.g. the ones inherited by a forked process."""
+        self.collect()
+
+    def _restore(self, fields: dict[str, float]) -> None:
+        for field, delta in fields.items():
+            self._unflushed[field] = self._unflushed.get(field, 0) + delta
+
+    def _queue_flush(self, pipeline: redis_client.RedisCommands, fields: dict[str, float]) -> None:
+        for field, delta in fields.items():
+            pipeline.hincrbyfloat(redis_client.RedisKey.METRICS, field, delta)
+
+    def flush(self, redis_cli: redis_client.RedisSession) -> None:
+        self.flushed_at = time.monotonic()
+        if not (fields := self.collect()):
+            return
+        try:
+            with redis_cli.pipeline(transaction=False) as pipeline:
+                self._queue_flush(pipeline, fields)
+                pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to flush metrics: {e}")
+            self._restore(fields)
+
+    async def async_flush(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        self.flushed_at = time.monotonic()
+        if not (fields := self.collect()):
+            return
+        try:
+            async with redis_cli.pipeline(transaction=False) as pipeline:
+                self._queue_flush(pipeline, fields)
+                await pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to flush metrics: {e}")
+            self._restore(fields)
+
+    def flush_if_due(self, redis_cli: redis_client.RedisSession) -> None:
+        if time.monotonic() - self.flushed_at >= METRICS_FLUSH_INTERVAL:
+            self.flush(redis_cli)
+
+    async def flush_periodically(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+            await self.async_flush(redis_cli)
+
+    async def render(self, redis_cli: redis_client.AsyncRedisSession) -> str:
+        """Renders the metrics of all processes in the Prometheus text exposition format."""
+        await self.async_flush(redis_cli)
+
+        series: dict[str, list[tuple[dict[str, str], str]]] = collections.defaultdict(list)
+        for field, value in (await redis_cli.hgetall(redis_client.RedisKey.METRICS)).items():
+            name, labels = json.loads(field)
+            series[name].append((labels, value.decode()))
+
+        lines: list[str] = []
+        for metric in self.metrics.values():
+            lines += [f"# HELP {metric.name} {metric.documentation}", f"# TYPE {metric.name} {metric.type}"]
+            for suffix in metric.suffixes:
+                for labels, value in sorted(series[metric.name + suffix], key=lambda s: series_sort_key(s[0])):
+                    lines.append(f"{metric.name}{suffix}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricRegistry()
+
+# All metrics are declared here, so that every process can render the metrics recorded by the others.
+APP_STATE_LOCK_WAIT_SECONDS = Histogram(
+    "rosa_app_state_lock_wait_seconds", "Time waited to acquire the app state write lock.", ("mode",)
+)
+APP_STATE_LOCK_HOLD_SECONDS = Histogram(
+    "rosa_app_state_lock_hold_seconds", "Time from loading the app state to committing it.", ("mode",)
+)
+SHOP_API_REQUEST_SECONDS = Histogram(
+    "rosa_shop_api_request_seconds", "Latency of the shop API requests.", ("operation", "status")
+)
+SHOP_API_HEDGES_TOTAL = Counter(
+    "rosa_shop_api_hedges_total", "Shop API requests sent again as they were slower than usual.", ("operation",)
+)
+SHOP_API_SHORT_CIRCUITS_TOTAL = Counter(
+    "rosa_shop_api_short_circuits_total",
+    "Shop API operations failed fast by the circuit breaker, or cut off by the timeout.",
+    ("operation", "reason"),
+)
+SHOP_API_FALLBACKS_TOTAL = Counter(
+    "rosa_shop_api_fallbacks_total", "Cached orders served while the shop API was unavailable.", ("operation",)
+)
+RENDER_HTML_SECONDS = Histogram(
+    "rosa_render_html_seconds", "Time to get a rendered label image, including the cache hits.", ("template",)
+)
+RENDER_HTML_PAGE_SECONDS = Histogram(
+    "rosa_render_html_page_seconds",
+    "Time to render a label on a browser page. Only recorded on the cache misses, "
+    "so the cache hit rate is 1 - rosa_render_html_page_seconds_count / rosa_render_html_seconds_count.",
+)
+IMAGE_TO_BW_SECONDS = Histogram("rosa_image_to_bw_seconds", "Time to decode a screenshot into a 1-bit image.")
+PRINTER_ENCODE_SECONDS = Histogram(
+    "rosa_printer_encode_seconds", "Time to encode an image into the printer commands.", ("driver",)
+)
+PRINTER_WRITE_SECONDS = Histogram(
+    "rosa_printer_write_seconds", "Time to write the printer commands to the device.", ("printer",)
+)
+PRINTER_PAYLOAD_BYTES = Histogram(
+    "rosa_printer_payload_bytes",
+    "Size of the printer commands of a label.",
+    ("driver",),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144),
+)
+PRINTER_DISPATCHES_TOTAL = Counter(
+    "rosa_printer_dispatches_total", "Print jobs dispatched to the printers of the pools.", ("pool", "printer")
+)
+LABEL_STORE_LOOKUPS_TOTAL = Counter(
+    "rosa_label_store_lookups_total", "Lookups of the pre-rendered labels on printing.", ("result",)
+)
+ORDER_JOURNAL_ENTRIES_TOTAL = Counter(
+    "rosa_order_journal_entries_total",
+    "Order modifications journaled, and the results of applying them to the shop.",
+    ("result",),
+)
+ORDER_JOURNAL_LAG_SECONDS = Histogram(
+    "rosa_order_journal_lag_seconds",
+    "Time from journaling an order modification to applying it to the shop.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+READER_SCANS_TOTAL = Counter("rosa_reader_scans_total", "Number of the QR codes scanned.", ("reader",))
+WEBSOCKET_FANOUT_LAG_SECONDS = Histogram(
+    "rosa_websocket_fanout_lag_seconds", "Time from receiving an app state change to sending it to the websocket."
+)
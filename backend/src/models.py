@@ -3,35 +3,67 @@ from __future__ import annotations
 import asyncio
 import contextlib
 import datetime
+import hashlib
 import http
+import importlib
 import itertools
+import mmap
+import os
 import pathlib
+import time
 import typing
 import uuid
 
-import fastapi
 import httpx
-import playwright.async_api
 import pydantic
-import src.utils.hals.printers.escp as escp_utils
-import src.utils.hals.printers.tspl as tspl_utils
-import src.utils.renderers.html_renderer as html_renderer
+import src.metrics as metrics
+import src.shop_api_resilience as shop_api_resilience
+import src.tracing as tracing
 import src.utils.stdlibs.str_utils as str_utils
 
+if typing.TYPE_CHECKING:
+    # Only needed by the API server, and the CLI commands importing the models shouldn't pay for the imports.
+    import PIL.Image
+    import playwright.async_api
+    import src.redis_client as redis_client
+    import src.utils.hals.printers.escp as escp_utils
+    import src.utils.hals.printers.tspl as tspl_utils
+    import src.utils.renderers.html_renderer as html_renderer
+
 DeskStatus = typing.Literal["idle", "registering", "closed", "automated"]
 PaymentHistoryStatus = typing.Literal["pending", "completed", "partial_refunded", "refunded"]
 OrderProductStatus = typing.Literal["pending", "paid", "used", "refunded"]
+# Status of the order modifications journaled locally, which are not applied to the shop yet or failed to be applied.
+OrderSyncStatus = typing.Literal["pending", "failed"]
 PrinterCmdType = typing.Literal["ESCP", "TSPL"]
+ShopAPIOperation = typing.Literal["search", "retrieve", "modify", "refund"]
+AppStateCodec = typing.Literal["json", "msgpack"]
 
 SESSION_REFRESH_REQUIRED_DELTA = datetime.timedelta(seconds=30)
 SESSION_EXPIRED_DELTA = datetime.timedelta(minutes=5)
-
-PRINTER_SUPPORTS: dict[PrinterCmdType, type] = {
-    "TSPL": tspl_utils.TSPL,
-    "ESCP": escp_utils.ESCP,
+# Number of handled orders kept on the session state. Older ones are moved to the archive on Redis.
+HANDLED_ORDER_LIVE_LIMIT = int(os.getenv("HANDLED_ORDER_LIVE_LIMIT", "20"))
+
+# Codec used when storing AppState on Redis. Stored data is decoded regardless of this setting,
+# so this can be changed without migrating the stored data. msgpack is installed with `poetry install -E msgpack`.
+APP_STATE_CODEC: AppStateCodec = typing.cast(AppStateCodec, os.getenv("APP_STATE_CODEC", "json"))
+# Session payloads sent to the frontend contain the shared app state, but it's redundant on the stored data.
+APP_STATE_STORAGE_EXCLUDE: dict = {"sessions": {"__all__": {"state": {"app_state"}}}}
+
+PRINTER_SUPPORTS: dict[PrinterCmdType, str] = {
+    "TSPL": "src.utils.hals.printers.tspl:TSPL",
+    "ESCP": "src.utils.hals.printers.escp:ESCP",
 }
 
 
+class RenderOptions(pydantic.BaseModel):
+    """Options of html_renderer.render_html to render the labels in the printer's dots"""
+
+    device_scale_factor: float = 1.0
+    rotate: bool = False
+    dpi: int | None = None
+
+
 class APIDef(pydantic.BaseModel):
     method: typing.Literal["GET", "POST", "PATCH", "DELETE"]
     path: str
@@ -43,7 +75,7 @@ class APIDef(pydantic.BaseModel):
         return {"method": self.method, "url": path}
 
 
-SHOP_V1_API_MAP = {
+SHOP_V1_API_MAP: dict[ShopAPIOperation, APIDef] = {
     "search": APIDef(method="GET", path=""),
     "retrieve": APIDef(method="GET", path="{order_id}/"),
     "modify": APIDef(method="PATCH", path="{order_id}/"),
@@ -124,39 +156,48 @@ class OrderDTO(pydantic.BaseModel):
     def __eq__(self, other: object) -> bool:
         return self.id == other.id if isinstance(other, OrderDTO) else False
 
-    async def get_rendered_nameplate_label_image(
-        self,
-        browser: playwright.async_api.Browser,
-        additional_context: dict[str, str],
-    ) -> bytes:
+    def apply_modification(self, data: OrderModifyRequestDTO) -> OrderDTO:
+        """Returns the order as the shop would return after the modification, without calling the Shop API."""
+        modifications = {product.id: product for product in data.products}
+        products: list[OrderDTO.OrderProductRelationDTO] = []
+        for product in self.products:
+            if not (modification := modifications.get(product.id)):
+                products.append(product)
+                continue
+
+            responses = {option.id: option.custom_response for option in modification.options}
+            options = [
+                (
+                    option.model_copy(update={"custom_response": responses[option.id]})
+                    if option.id in responses
+                    else option
+                )
+                for option in product.options
+            ]
+            products.append(
+                product.model_copy(update={"status": modification.status or product.status, "options": options})
+            )
+        return self.model_copy(update={"products": products})
+
+    def get_nameplate_label(self, additional_context: dict[str, str]) -> tuple[str, dict[str, str]]:
+        """Returns the template id and the context of the nameplate label"""
         # TODO: FIXME: 지금이야 단건 주문만 가능하지만, 만약 여러 상품을 한번에 주문할 수 있는 경우 수정 필요
         ticket_opr = self.products[0]
         user_name = ticket_opr.get_option_by_name("성함").custom_response or ""
         user_org = ticket_opr.get_option_by_name("소속").custom_response or ""
-        template_path_str = (
-            "src/templates/nameplate_label_for_volunteer.html"
-            if user_org == "자원봉사자"
-            else "src/templates/nameplate_label.html"
-        )
-        return html_renderer.image_to_bw(
-            image=await html_renderer.render_html(
-                browser=browser,
-                template=pathlib.Path(template_path_str).read_text(),
-                context={
-                    "user_name": user_name,
-                    "user_org": user_org,
-                    "qrcode_data": str_utils.uuid_to_b64(self.id),
-                }
-                | additional_context,
-                element="#container",
-            )
+        template_id = "nameplate_label_for_volunteer" if user_org == "자원봉사자" else "nameplate_label"
+        return (
+            template_id,
+            {
+                "user_name": user_name,
+                "user_org": user_org,
+                "qrcode_data": str_utils.uuid_to_b64(self.id),
+            }
+            | additional_context,
         )
 
-    def _get_exchange_ticket_label_images_coroutine(
-        self,
-        browser: playwright.async_api.Browser,
-        additional_context: dict[str, str],
-    ) -> list[typing.Awaitable[bytes]]:
+    def get_exchange_ticket_labels(self, additional_context: dict[str, str]) -> list[tuple[str, dict[str, str]]]:
+        """Returns the template ids and the contexts of the exchange ticket labels, one for each priced option"""
         contexts = itertools.chain.from_iterable(
             [
                 [
@@ -172,37 +213,95 @@ class OrderDTO(pydantic.BaseModel):
                 for opr in self.products
             ]
         )
+        return [("exchange_ticket_label", context) for context in contexts]
+
+    def get_labels(
+        self, additional_context: dict[str, str], include_exchange_tickets: bool
+    ) -> list[tuple[str, dict[str, str]]]:
+        return [
+            self.get_nameplate_label(additional_context),
+            *(self.get_exchange_ticket_labels(additional_context) if include_exchange_tickets else []),
+        ]
+
+    async def get_rendered_nameplate_label_image(
+        self,
+        browser: playwright.async_api.Browser,
+        additional_context: dict[str, str],
+        render_options: RenderOptions | None = None,
+    ) -> PIL.Image.Image:
+        import src.utils.renderers.html_renderer as html_renderer
+
+        template_id, context = self.get_nameplate_label(additional_context)
+        return await html_renderer.render_html(
+            browser=browser,
+            template_id=template_id,
+            context=context,
+            element="#container",
+            **(render_options or RenderOptions()).model_dump(),
+        )
+
+    def _get_exchange_ticket_label_images_coroutine(
+        self,
+        browser: playwright.async_api.Browser,
+        additional_context: dict[str, str],
+        render_options: RenderOptions | None = None,
+    ) -> list[typing.Awaitable[PIL.Image.Image]]:
+        import src.utils.renderers.html_renderer as html_renderer
+
         return [
             html_renderer.render_html(
                 browser=browser,
-                template=pathlib.Path("src/templates/exchange_ticket_label.html").read_text(),
+                template_id=template_id,
                 context=context,
                 element="#container",
+                **(render_options or RenderOptions()).model_dump(),
             )
-            for context in contexts
+            for template_id, context in self.get_exchange_ticket_labels(additional_context)
         ]
 
     async def get_rendered_exchange_ticket_label_images(
         self,
         browser: playwright.async_api.Browser,
         additional_context: dict[str, str],
-    ) -> list[bytes]:
-        images = await asyncio.gather(*self._get_exchange_ticket_label_images_coroutine(browser, additional_context))
-        return [html_renderer.image_to_bw(image=image) for image in images]
+        render_options: RenderOptions | None = None,
+    ) -> list[PIL.Image.Image]:
+        return list(
+            await asyncio.gather(
+                *self._get_exchange_ticket_label_images_coroutine(browser, additional_context, render_options)
+            )
+        )
 
-    async def get_all_rendered_label_images(
+    def get_label_images_coroutine(
         self,
         browser: playwright.async_api.Browser,
         additional_context: dict[str, str],
-    ) -> list[bytes]:
+        include_exchange_tickets: bool,
+        render_options: RenderOptions | None = None,
+    ) -> list[typing.Awaitable[PIL.Image.Image]]:
         return [
-            html_renderer.image_to_bw(image=image)
-            for image in await asyncio.gather(
-                self.get_rendered_nameplate_label_image(browser, additional_context),
-                *self._get_exchange_ticket_label_images_coroutine(browser, additional_context),
-            )
+            self.get_rendered_nameplate_label_image(browser, additional_context, render_options),
+            *(
+                self._get_exchange_ticket_label_images_coroutine(browser, additional_context, render_options)
+                if include_exchange_tickets
+                else []
+            ),
         ]
 
+    async def get_all_rendered_label_images(
+        self,
+        browser: playwright.async_api.Browser,
+        additional_context: dict[str, str],
+        render_options: RenderOptions | None = None,
+    ) -> list[PIL.Image.Image]:
+        import src.utils.renderers.html_renderer as html_renderer
+
+        # Labels of the order are rendered on a single page, instead of a page per label.
+        return await html_renderer.render_html_batch(
+            browser,
+            self.get_labels(additional_context, include_exchange_tickets=True),
+            **(render_options or RenderOptions()).model_dump(),
+        )
+
 
 class USBDevice(pydantic.BaseModel):
     bus: int
@@ -214,25 +313,229 @@ class USBDevice(pydantic.BaseModel):
 
     model_config = pydantic.ConfigDict(frozen=True)
 
+    @property
+    def identifier(self) -> str:
+        # CDC paths can be changed on reconnection, so the serial number is preferred.
+        return self.serial_number or self.cdc_path
+
+
+class PrinterProfile(pydantic.BaseModel):
+    """Settings deciding the label output of a printer, which are the same on the printers of the same model & media"""
 
-class Printer(USBDevice, pydantic.BaseModel):
     class Label(pydantic.BaseModel):
         width: int = 960  # px
         height: int = 410  # px
 
+    class RenderProfile(pydantic.BaseModel):
+        dpi: int = pydantic.Field(default=203, gt=0)
+        printable_width: int = pydantic.Field(gt=0)  # dots across the print head, multiple of 8 for TSPL
+        # landscape: label width is across the print head / portrait: label height is, so the image is rotated.
+        orientation: typing.Literal["landscape", "portrait"] = "landscape"
+
     cmd_type: PrinterCmdType = "ESCP"
     label: Label = pydantic.Field(default_factory=Label)
+    # Labels are rendered in CSS px of the label size and resampled by the drivers if not set.
+    render_profile: RenderProfile | None = None
+
+    @pydantic.field_validator("render_profile")
+    @classmethod
+    def validate_render_profile(
+        cls, value: PrinterProfile.RenderProfile | None, info: pydantic.ValidationInfo
+    ) -> PrinterProfile.RenderProfile | None:
+        # BITMAP commands of TSPL take the width in bytes, so the dots which don't fill a byte can't be printed.
+        if value and info.data.get("cmd_type") == "TSPL" and value.printable_width % 8:
+            raise ValueError("printable_width must be a multiple of 8 for TSPL printers.")
+        return value
+
+    @property
+    def profile_key(self) -> str:
+        profile_json = self.model_dump_json(include=set(PrinterProfile.model_fields))
+        return hashlib.sha256(profile_json.encode()).hexdigest()[:16]
+
+    @property
+    def render_options(self) -> RenderOptions:
+        if not (profile := self.render_profile):
+            return RenderOptions()
+        rotate = profile.orientation == "portrait"
+        return RenderOptions(
+            device_scale_factor=profile.printable_width / (self.label.height if rotate else self.label.width),
+            rotate=rotate,
+            dpi=profile.dpi,
+        )
+
+    @property
+    def page_size(self) -> tuple[int, int] | None:
+        """Size of the rendered labels in dots, with the width across the print head. None if rendered in CSS px."""
+        if not self.render_profile:
+            return None
+        options = self.render_options
+        width, height = (
+            (self.label.height, self.label.width) if options.rotate else (self.label.width, self.label.height)
+        )
+        return round(width * options.device_scale_factor), round(height * options.device_scale_factor)
 
     @property
     def driver(self) -> type[tspl_utils.TSPL | escp_utils.ESCP]:
-        return PRINTER_SUPPORTS[self.cmd_type]
+        module_name, class_name = PRINTER_SUPPORTS[self.cmd_type].split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+
+    def encode(
+        self, image: PIL.Image.Image, printer_id: str | None = None, stored_files: list[str] | None = None
+    ) -> tspl_utils.TSPL | escp_utils.ESCP:
+        """
+        Builds the printer commands of the label, for the printer of printer_id which has the stored_files if given.
+        Without it, the commands don't depend on the files downloaded on the printer, e.g. the stored labels.
+        """
+        import src.utils.hals.printers.escp as escp_utils
+        import src.utils.hals.printers.tspl as tspl_utils
 
-    def print_image(self, image: bytes) -> None:
         driver_ctx = self.driver()
+        if isinstance(driver_ctx, tspl_utils.TSPL):
+            driver_ctx.printer_id, driver_ctx.stored_files = printer_id, stored_files or []
+        elif isinstance(driver_ctx, escp_utils.ESCP) and (page_size := self.page_size):
+            # Labels rendered in the printer's dots are already in the feed direction.
+            driver_ctx.page_size, driver_ctx.rotate = page_size, False
         with driver_ctx as driver:
             with driver.page as page:
-                page.write_image(image=image)
-        driver_ctx.print(self.cdc_path)
+                self.write_label(page, image, printer_id)
+        return driver_ctx
+
+    def write_label(
+        self,
+        page: tspl_utils.TSPL.Page | escp_utils.ESCP.Page,
+        image: PIL.Image.Image,
+        printer_id: str | None = None,
+    ) -> None:
+        """
+        Writes the label, composed on the printer side if both the printer and the rendered label support it.
+        Without printer_id, the files can't be reused on the printer, so the label is written as a whole.
+        """
+        layout: html_renderer.LabelLayout | None = image.info.get("label_layout")
+        if self.cmd_type != "TSPL" or not printer_id or not layout or layout.background.size != image.size:
+            page.write_image(image=image)
+            return
+
+        import src.utils.hals.printers.tspl as tspl_utils
+
+        qrcode: tspl_utils.TSPLQRCode | None = None
+        if layout.qrcode_box and (qrcode_data := image.info.get("qrcode_data")):
+            x, y, size = layout.qrcode_box
+            qrcode = tspl_utils.TSPLQRCode(x=x, y=y, size=size, data=qrcode_data)
+        typing.cast(tspl_utils.TSPL.Page, page).write_composed_image(image, layout.background, qrcode)
+
+
+class Printer(USBDevice, PrinterProfile, pydantic.BaseModel):
+    @property
+    def profile(self) -> PrinterProfile:
+        return PrinterProfile.model_validate(self.model_dump(include=set(PrinterProfile.model_fields)))
+
+    def encode_label(
+        self, image: PIL.Image.Image, stored_files: list[str] | None = None
+    ) -> tspl_utils.TSPL | escp_utils.ESCP:
+        """
+        Builds the printer commands of the label. CPU-bound, so the API server runs it on the image executor.
+        Files on the printer are reused only if the stored_files recorded on Redis are given,
+        as a job of another process may have KILLed them otherwise.
+        """
+        return self.encode(image, self.identifier if stored_files is not None else None, stored_files)
+
+    def print_image(self, image: PIL.Image.Image) -> None:
+        """Writes the label as a whole, as the files stored on the printer are recorded by async_print_image."""
+        with tracing.span("printer.print", printer=self.identifier, driver=self.cmd_type):
+            with tracing.span("printer.encode"), metrics.PRINTER_ENCODE_SECONDS.time(driver=self.cmd_type):
+                driver_ctx = self.encode_label(image)
+            metrics.PRINTER_PAYLOAD_BYTES.observe(sum(map(len, driver_ctx.cmdlist)), driver=self.cmd_type)
+            with tracing.span("printer.write"), metrics.PRINTER_WRITE_SECONDS.time(printer=self.identifier):
+                driver_ctx.print(self.cdc_path)
+
+    async def async_print_image(
+        self, image: PIL.Image.Image, redis_cli: redis_client.AsyncRedisSession | None = None
+    ) -> None:
+        """
+        Same as print_image, without blocking the event loop while encoding and writing the label.
+        With redis_cli, labels composed on a TSPL printer reuse the files stored on it, which are recorded on Redis.
+        """
+        import src.executors as executors
+        import src.printer_dispatcher as printer_dispatcher
+        import src.redis_client as redis_client
+
+        # Printer may be shared by the API workers, and a job of another worker may KILL the files this job uses,
+        # so the files are read, used and recorded under the lock of the printer.
+        # Lock expires as the jobs in flight do, so that a crashed worker doesn't hold the printer forever.
+        recorded = redis_cli is not None and self.cmd_type == "TSPL" and "label_layout" in image.info
+        lock = (
+            redis_cli.lock(
+                redis_client.RedisKey.PRINTER_FILES_LOCK.format(printer=self.identifier),
+                timeout=printer_dispatcher.PRINTER_JOB_TIMEOUT,
+            )
+            if recorded
+            else contextlib.nullcontext()
+        )
+        with tracing.span("printer.print", printer=self.identifier, driver=self.cmd_type):
+            async with lock:
+                stored_files = await self._query_stored_files(redis_cli) if recorded else None
+                with tracing.span("printer.encode"), metrics.PRINTER_ENCODE_SECONDS.time(driver=self.cmd_type):
+                    driver_ctx = await executors.image_executor.encode_label(self, image, stored_files)
+                metrics.PRINTER_PAYLOAD_BYTES.observe(sum(map(len, driver_ctx.cmdlist)), driver=self.cmd_type)
+                sent = False
+                try:
+                    with tracing.span("printer.write"), metrics.PRINTER_WRITE_SECONDS.time(printer=self.identifier):
+                        await asyncio.to_thread(driver_ctx.print, self.cdc_path)
+                    sent = True
+                finally:
+                    if recorded:
+                        await self._record_stored_files(redis_cli, typing.cast("tspl_utils.TSPL", driver_ctx), sent)
+
+    async def _query_stored_files(self, redis_cli: redis_client.AsyncRedisSession) -> list[str]:
+        """Files stored on the TSPL printer, least recently used first"""
+        import src.redis_client as redis_client
+
+        key = redis_client.RedisKey.PRINTER_FILES.format(printer=self.identifier)
+        return [file_name.decode() for file_name in await redis_cli.zrangebyscore(key, "-inf", "+inf")]
+
+    async def _record_stored_files(
+        self, redis_cli: redis_client.AsyncRedisSession, driver_ctx: tspl_utils.TSPL, sent: bool
+    ) -> None:
+        """
+        Records the files used by the job as stored on the TSPL printer, and unrecords the KILLed ones.
+        Files of a failed job are unrecorded too, as the printer may have received only a part of it.
+        """
+        import src.redis_client as redis_client
+
+        key = redis_client.RedisKey.PRINTER_FILES.format(printer=self.identifier)
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            if unrecorded := driver_ctx.killed_files + ([] if sent else driver_ctx.used_files):
+                pipeline.zrem(key, *unrecorded)
+            if sent and driver_ctx.used_files:
+                pipeline.zadd(key, {file_name: time.time() for file_name in driver_ctx.used_files})
+            await pipeline.execute()
+
+    def print_stored_payload(self, path: pathlib.Path) -> None:
+        """Writes the printer commands pre-rendered on the label store, straight from the memory-mapped file."""
+        if not (dev := pathlib.Path(self.cdc_path)).exists():
+            raise FileNotFoundError(f"Device {dev} not found")
+
+        with tracing.span("printer.write", printer=self.identifier, stored=True):
+            with metrics.PRINTER_WRITE_SECONDS.time(printer=self.identifier):
+                with path.open("rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as payload:
+                    with dev.open("wb") as device:
+                        device.write(payload)
+
+
+class PrinterPool(pydantic.BaseModel):
+    """Printers of the same profile shared by the desks, where each print job goes to the least loaded one"""
+
+    name: str
+    printers: list[Printer] = pydantic.Field(min_length=1)
+
+    model_config = pydantic.ConfigDict(frozen=True)
+
+    @pydantic.model_validator(mode="after")
+    def validate_profiles(self) -> typing.Self:
+        # Labels are rendered once for the pool before picking the printer, so they must print the same on any of them.
+        if len({printer.profile_key for printer in self.printers}) > 1:
+            raise ValueError("Printers of a pool must have the same label profile.")
+        return self
 
 
 class SessionStateConfig(pydantic.BaseModel):
@@ -252,87 +555,348 @@ class SessionState(SessionStateConfig, pydantic.BaseModel):
 
     reader: USBDevice | None = None
     printer: Printer | None = None
+    # Name of the printer pool on the app state, which is used instead of the printer if set.
+    printer_pool: str | None = None
+    # Orders handled on this desk whose modifications are on the local journal, see src.order_journal.
+    unsynced_orders: dict[uuid.UUID, OrderSyncStatus] = pydantic.Field(default_factory=dict)
+
+    _archivable_orders: list[OrderDTO] = pydantic.PrivateAttr(default_factory=list)
 
     @pydantic.computed_field  # type: ignore[misc]
     @property
     def app_state(self) -> dict:
-        return (self.app or AppState()).model_dump(mode="json", exclude={"sessions"})
+        return (self.app or AppState()).shared_state
 
     @pydantic.model_validator(mode="after")
     def validate_model_after(self) -> typing.Self:
-        if not self.order:
-            if self.desk_status == "registering":
-                self.desk_status = "idle"
-            return self
-
-        if self.order in self.handled_order:
-            self.handled_order.remove(self.order)
-        self.handled_order.append(self.order)
-        self.desk_status = "registering"
+        if self.order:
+            self.handled_order = [o for o in self.handled_order if o != self.order] + [self.order]
+            self.desk_status = "registering"
+        elif self.desk_status == "registering":
+            self.desk_status = "idle"
+
+        # Only the recent orders are kept on the live state, and the older ones are archived on commit.
+        if (overflow := len(self.handled_order) - HANDLED_ORDER_LIVE_LIMIT) > 0:
+            self._archivable_orders.extend(self.handled_order[:overflow])
+            self.handled_order = self.handled_order[overflow:]
         return self
 
+    @property
+    def printers(self) -> list[Printer]:
+        """Printers which the labels of this desk can be printed on"""
+        if self.printer_pool:
+            pool = self.app.printer_pools.get(self.printer_pool) if self.app else None
+            return list(pool.printers) if pool else []
+        return [self.printer] if self.printer else []
+
+    @property
+    def printer_profile(self) -> PrinterProfile | None:
+        """Label profile of the printers of this desk, which decides how the labels are rendered"""
+        return printers[0] if (printers := self.printers) else None
+
+    @property
+    def unarchived_orders(self) -> list[OrderDTO]:
+        """handled_order including the orders evicted but not archived yet, oldest first."""
+        return [*self._archivable_orders, *self.handled_order]
+
+    def pop_archivable_orders(self) -> list[OrderDTO]:
+        """Returns the orders evicted from handled_order, oldest first."""
+        orders, self._archivable_orders = self._archivable_orders, []
+        return orders
+
     def check_order_available(self) -> None:
+        import fastapi
+
         status_code = http.HTTPStatus.UNPROCESSABLE_ENTITY
         if not self.order:
             raise fastapi.HTTPException(status_code=status_code, detail="주문 정보가 없습니다.")
         if not self.order.products:
             raise fastapi.HTTPException(status_code=status_code, detail="상품 정보가 없습니다.")
 
+    @classmethod
+    def merge(cls, base: SessionState, ours: SessionState, theirs: SessionState) -> SessionState:
+        """
+        Applies our changes from base onto theirs, for a session modified on both sides.
+        Fields are merged separately, unsynced_orders per order id and handled_order per order,
+        so that e.g. the order journal reporting a synced order doesn't conflict with the next scan on the desk.
+        Raises SessionConflictError if the same field or order is changed differently on both sides.
+        """
+        exclude = {"app_state", "commit_id", "handled_order", "unsynced_orders"}
+        base_dump, our_dump, their_dump = (s.model_dump(mode="json", exclude=exclude) for s in (base, ours, theirs))
+        for name, our_value in our_dump.items():
+            if our_value in (base_dump[name], their_dump[name]):
+                continue
+            if their_dump[name] != base_dump[name]:
+                raise SessionConflictError(theirs.id)
+            setattr(theirs, name, getattr(ours, name))
+
+        for order_id in base.unsynced_orders.keys() | ours.unsynced_orders.keys():
+            base_status, our_status = base.unsynced_orders.get(order_id), ours.unsynced_orders.get(order_id)
+            if our_status in (base_status, their_status := theirs.unsynced_orders.get(order_id)):
+                continue
+            if their_status != base_status:
+                raise SessionConflictError(theirs.id)
+            if our_status:
+                theirs.unsynced_orders[order_id] = our_status
+            else:
+                theirs.unsynced_orders.pop(order_id, None)
+
+        base_orders, our_orders, their_orders = (
+            {o.id: o.model_dump_json() for o in s.handled_order} for s in (base, ours, theirs)
+        )
+        # Orders evicted by us are archived by us, unless they're already evicted & archived by them.
+        archivable = [o for o in ours._archivable_orders if o.id in their_orders]
+        removed = base_orders.keys() - our_orders.keys()
+        handled_order = [o for o in theirs.handled_order if o.id not in removed]
+        for order in ours.handled_order:
+            if our_orders[order.id] in (base_orders.get(order.id), their_orders.get(order.id)):
+                continue
+            if their_orders.get(order.id) != base_orders.get(order.id):
+                raise SessionConflictError(theirs.id)
+            if order.id in their_orders:
+                handled_order = [order if o.id == order.id else o for o in handled_order]
+            else:
+                handled_order.append(order)
+        if (overflow := len(handled_order) - HANDLED_ORDER_LIVE_LIMIT) > 0:
+            archivable.extend(handled_order[:overflow])
+            handled_order = handled_order[overflow:]
+        theirs.handled_order = handled_order
+        theirs._archivable_orders.extend(archivable)
+
+        theirs.commit_id = uuid.uuid4()
+        return theirs
+
+    def check_order_unchanged(self, order_id: uuid.UUID | None) -> None:
+        """Shop API is called before locking the session, so the session must still have the order it was called for."""
+        import fastapi
+
+        if (self.order.id if self.order else None) != order_id:
+            raise fastapi.HTTPException(
+                status_code=http.HTTPStatus.CONFLICT, detail="다른 요청에 의해 주문 정보가 변경되었습니다."
+            )
+
 
 class ShopAPIConfig(pydantic.BaseModel):
     api_key: str = "registration_desk"
     api_secret: str = "api_key_registration_desk"
-    domain: pydantic.HttpUrl = "http://localhost:8000"
+    # Validated, so that the default is stored the same as it is loaded back (with the trailing slash).
+    domain: pydantic.HttpUrl = pydantic.Field(default="http://localhost:8000", validate_default=True)
 
     @property
-    def client(self) -> httpx.AsyncClient:
+    def client(self) -> contextlib.AbstractAsyncContextManager[httpx.AsyncClient]:
+        # The pooled client is kept open to reuse the connections, so it must not be closed on exit.
+        return contextlib.nullcontext(shop_api_client_pool.get(self))
+
+    def build_client(self) -> httpx.AsyncClient:
         return httpx.AsyncClient(
             base_url=str(self.domain), headers={"X-API-KEY": self.api_key, "X-API-SECRET": self.api_secret}
         )
 
+    @property
+    def guard(self) -> shop_api_resilience.ShopAPIGuard:
+        return shop_api_resilience.shop_api_guards.get(str(self.domain))
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        operation: ShopAPIOperation,
+        json: dict | None = None,
+        headers: dict[str, str] | None = None,
+        **kwargs: str | dict,
+    ) -> httpx.Response:
+        started_at, status = time.perf_counter(), "error"
+        with tracing.span(f"shop_api.{operation}"):
+            try:
+                request_args = SHOP_V1_API_MAP[operation](**kwargs)
+                response = await self.guard.call(
+                    operation, lambda: client.request(**request_args, json=json, headers=headers)
+                )
+                status = str(response.status_code)
+                tracing.annotate(**{"http.status_code": response.status_code})
+                return response
+            finally:
+                metrics.SHOP_API_REQUEST_SECONDS.observe(
+                    time.perf_counter() - started_at, operation=operation, status=status
+                )
+
     async def can_communicate(self) -> bool:
         with contextlib.suppress(httpx.HTTPError):
             async with self.client as client:
-                return (await client.request(**(SHOP_V1_API_MAP["search"]()))).is_success
+                return (await self.request(client, "search")).is_success
         return False
 
     async def search_orders(self, keywords: typing.Iterable[str]) -> list[OrderDTO]:
+        query_params: dict[str, str] = {"custom_responses": ",".join(keywords)}
+        try:
+            async with self.client as client:
+                response = await self.request(client, "search", query=query_params)
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            # Same search done before the shop went unavailable is answered from the cache.
+            if shop_api_resilience.is_unavailable(e) and (orders := self.guard.searches.get(str(query_params))):
+                metrics.SHOP_API_FALLBACKS_TOTAL.inc(operation="search")
+                return orders
+            raise
+
+        orders = [OrderDTO.model_validate(order) for order in response.json()]
+        self.guard.searches.put(str(query_params), orders)
+        for order in orders:
+            self.guard.orders.put(str(order.id), order)
+        return orders
+
+    async def iter_orders(self, page_size: int = 100) -> typing.AsyncIterator[OrderDTO]:
+        """Pages through every order with the search API without keywords, as the shop has no listing API."""
+        seen_order_ids: set[uuid.UUID] = set()
         async with self.client as client:
-            query_params: dict[str, str] = {"custom_responses": ",".join(keywords)}
-            response = await client.request(**(SHOP_V1_API_MAP["search"](query=query_params)))
-            response.raise_for_status()
-            return [OrderDTO.model_validate(order) for order in response.json()]
+            for page in itertools.count(1):
+                query_params: dict[str, str] = {"page": str(page), "page_size": str(page_size)}
+                response = await self.request(client, "search", query=query_params)
+                response.raise_for_status()
+                orders = [OrderDTO.model_validate(order) for order in response.json()]
+                # Stops on the last page, or when the API ignores the paging and returns the same orders again.
+                if not (new_orders := [order for order in orders if order.id not in seen_order_ids]):
+                    return
+                seen_order_ids.update(order.id for order in new_orders)
+                for order in new_orders:
+                    yield order
+                if len(orders) < page_size:
+                    return
 
     async def get_order(self, order_id: str) -> OrderDTO:
+        try:
+            async with self.client as client:
+                response = await self.request(client, "retrieve", order_id=order_id)
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            # Orders fetched before the shop went unavailable are served from the cache.
+            if shop_api_resilience.is_unavailable(e) and (order := self.guard.orders.get(order_id)):
+                metrics.SHOP_API_FALLBACKS_TOTAL.inc(operation="retrieve")
+                return order
+            raise
+
+        order = OrderDTO.model_validate(response.json())
+        self.guard.orders.put(order_id, order)
+        return order
+
+    async def modify_order(
+        self, order_id: str, data: OrderModifyRequestDTO, idempotency_key: str | None = None
+    ) -> OrderDTO:
         async with self.client as client:
-            response = await client.request(**(SHOP_V1_API_MAP["retrieve"](order_id=order_id)))
-            response.raise_for_status()
-            return OrderDTO.model_validate(response.json())
-
-    async def modify_order(self, order_id: str, data: OrderModifyRequestDTO) -> OrderDTO:
-        async with self.client as client:
-            response = await client.request(
-                **(SHOP_V1_API_MAP["modify"](order_id=order_id)),
+            response = await self.request(
+                client,
+                "modify",
                 json=data.model_dump(exclude_none=True, exclude_unset=True, exclude_defaults=True, mode="json"),
+                # Lets the shop ignore the retries of a modification which is already applied.
+                headers={"Idempotency-Key": idempotency_key} if idempotency_key else None,
+                order_id=order_id,
             )
             response.raise_for_status()
-            return OrderDTO.model_validate(response.json())
+        order = OrderDTO.model_validate(response.json())
+        self.guard.orders.put(order_id, order)
+        return order
 
     async def refund_order(self, order_id: str, otp: str) -> None:
         async with self.client as client:
-            response = await client.request(**(SHOP_V1_API_MAP["refund"](order_id=order_id, query={"otp": otp})))
+            response = await self.request(client, "refund", order_id=order_id, query={"otp": otp})
             response.raise_for_status()
             return None
 
 
+class ShopAPIClientPool:
+    """
+    httpx clients shared per Shop API config, so that the connections are kept alive between the requests.
+    Clients are bound to the event loop they're created on, so they're also keyed by the running loop.
+    """
+
+    def __init__(self) -> None:
+        self.clients: dict[tuple[asyncio.AbstractEventLoop, str, str, str], httpx.AsyncClient] = {}
+        # Stale clients being closed, referenced until they're closed and awaited by aclose().
+        self.closing: set[asyncio.Task] = set()
+
+    def get(self, config: ShopAPIConfig) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        key = (loop, str(config.domain), config.api_key, config.api_secret)
+        if (client := self.clients.get(key)) and not client.is_closed:
+            return client
+
+        # Config is replaced rather than modified, so the clients of the previous configs are not used anymore.
+        for stale_key in [k for k in self.clients if k[0] is loop and k != key]:
+            self.closing.add(task := loop.create_task(self.clients.pop(stale_key).aclose()))
+            task.add_done_callback(self.closing.discard)
+        self.clients[key] = config.build_client()
+        return self.clients[key]
+
+    async def warm_up(self, config: ShopAPIConfig) -> None:
+        """Opens a connection to the Shop API, which is kept on the pool for the first request."""
+        await self.get(config).head("/")
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        for key in [k for k in self.clients if k[0] is loop]:
+            await self.clients.pop(key).aclose()
+        await asyncio.gather(*(task for task in self.closing if task.get_loop() is loop))
+
+
+shop_api_client_pool = ShopAPIClientPool()
+
+
+class SessionConflictError(Exception):
+    def __init__(self, session_id: uuid.UUID) -> None:
+        super().__init__(f"Session {session_id} is modified concurrently")
+        self.session_id = session_id
+
+
 class SessionInfo(pydantic.BaseModel):
     ping_at: datetime.datetime = pydantic.Field(default_factory=datetime.datetime.now)
     state: SessionState
 
+    # ping_at that is already written on the session expiry index. None if the session is not indexed yet.
+    _indexed_ping_at: datetime.datetime | None = pydantic.PrivateAttr(default=None)
+
+    def dump_for_comparison(self) -> str:
+        return self.model_dump_json(exclude={"state": {"app_state"}})
+
 
 class AppState(pydantic.BaseModel):
     shop_api: ShopAPIConfig = pydantic.Field(default_factory=ShopAPIConfig)
     sessions: dict[uuid.UUID, SessionInfo] = pydantic.Field(default_factory=dict)
+    printer_pools: dict[str, PrinterPool] = pydantic.Field(default_factory=dict)
+
+    _shared_state_cache: tuple[ShopAPIConfig, dict[str, PrinterPool], dict] | None = pydantic.PrivateAttr(default=None)
+
+    @property
+    def shared_state(self) -> dict:
+        """App state without sessions, which is embedded into every session payloads."""
+        # shop_api and printer_pools are always replaced rather than modified,
+        # so we can cache the dumped data until either of them is replaced.
+        if (
+            not (cache := self._shared_state_cache)
+            or cache[0] is not self.shop_api
+            or cache[1] is not self.printer_pools
+        ):
+            cache = (self.shop_api, self.printer_pools, self.model_dump(mode="json", exclude={"sessions"}))
+            self._shared_state_cache = cache
+        return cache[2]
+
+    @classmethod
+    def load_from_storage(cls, data: bytes | str | None) -> typing.Self:
+        if isinstance(data, bytes) and data[:1] != b"{":
+            import msgpack
+
+            app_state = cls.model_validate(msgpack.unpackb(data))
+        else:
+            app_state = cls.model_validate_json(data)
+
+        for session in app_state.sessions.values():
+            session._indexed_ping_at = session.ping_at
+        return app_state
+
+    def dump_for_storage(self, codec: AppStateCodec = APP_STATE_CODEC) -> bytes:
+        if codec == "msgpack":
+            import msgpack
+
+            return msgpack.packb(self.model_dump(mode="json", exclude=APP_STATE_STORAGE_EXCLUDE))
+        return self.model_dump_json(exclude=APP_STATE_STORAGE_EXCLUDE).encode()
 
     @pydantic.model_validator(mode="after")
     def validate(self) -> typing.Self:
@@ -340,6 +904,64 @@ class AppState(pydantic.BaseModel):
             session.state.app = self
         return self
 
+    @property
+    def archivable_orders(self) -> dict[uuid.UUID, list[OrderDTO]]:
+        return {
+            session_id: session.state._archivable_orders
+            for session_id, session in self.sessions.items()
+            if session.state._archivable_orders
+        }
+
+    @property
+    def refreshed_pings(self) -> redis_client.SortedSetScores:
+        """Ping timestamps of the sessions that are created or pinged after loaded from the storage."""
+        return {
+            str(session_id): session.ping_at.timestamp()
+            for session_id, session in self.sessions.items()
+            if session.ping_at != session._indexed_ping_at
+        }
+
+    def mark_committed(self) -> None:
+        """Marks archivable orders as archived and refreshed pings as indexed, after the state is written."""
+        for session in self.sessions.values():
+            session.state.pop_archivable_orders()
+            session._indexed_ping_at = session.ping_at
+
+    @classmethod
+    def merge(cls, base: AppState, ours: AppState, theirs: AppState) -> AppState:
+        """
+        Applies the changes from base to ours onto theirs, which is committed by others after base was loaded.
+        Changes are merged per session, and per field of the sessions modified on both sides (see SessionState.merge).
+        Sessions that only got pinged on one side are not considered as modified, as the commit_id stays the same.
+        """
+        if ours.shop_api != base.shop_api:
+            theirs.shop_api = ours.shop_api
+        if ours.printer_pools != base.printer_pools:
+            theirs.printer_pools = ours.printer_pools
+
+        for session_id in base.sessions.keys() | ours.sessions.keys():
+            base_session, our_session = base.sessions.get(session_id), ours.sessions.get(session_id)
+            their_session = theirs.sessions.get(session_id)
+            if not our_session:
+                theirs.sessions.pop(session_id, None)
+            elif not base_session:
+                theirs.sessions[session_id] = our_session
+            elif not their_session or our_session.dump_for_comparison() == base_session.dump_for_comparison():
+                # Session is removed by others (e.g. expired), or not modified by us.
+                continue
+            elif their_session.state.commit_id == base_session.state.commit_id:
+                our_session.ping_at = max(our_session.ping_at, their_session.ping_at)
+                theirs.sessions[session_id] = our_session
+            elif our_session.state.commit_id == base_session.state.commit_id:
+                their_session.ping_at = max(our_session.ping_at, their_session.ping_at)
+            else:
+                SessionState.merge(base_session.state, our_session.state, their_session.state)
+                their_session.ping_at = max(our_session.ping_at, their_session.ping_at)
+
+        for session in theirs.sessions.values():
+            session.state.app = theirs
+        return theirs
+
     def create_session(self) -> SessionInfo:
         session_info = SessionInfo(state=SessionState(app=self))
         self.sessions[session_info.state.id] = session_info
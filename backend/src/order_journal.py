@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+import time
+import typing
+import uuid
+
+import fastapi
+import httpx
+import pydantic
+import src.dependencies as dependencies
+import src.metrics as metrics
+import src.models as models
+import src.redis_client as redis_client
+import src.tracing as tracing
+
+# Delay of the first retry, which is doubled on every failed attempt up to the max delay.
+ORDER_JOURNAL_RETRY_MIN_DELAY = float(os.getenv("ORDER_JOURNAL_RETRY_MIN_DELAY", "1"))  # seconds
+ORDER_JOURNAL_RETRY_MAX_DELAY = float(os.getenv("ORDER_JOURNAL_RETRY_MAX_DELAY", "60"))  # seconds
+# Attempts before giving up on an entry, which is about an hour with the max delay.
+ORDER_JOURNAL_MAX_ATTEMPTS = int(os.getenv("ORDER_JOURNAL_MAX_ATTEMPTS", "60"))
+# Failed entries are kept on the journal for this long, to look into them.
+ORDER_JOURNAL_FAILED_RETENTION = datetime.timedelta(days=7)
+# Entries being applied by a crashed worker are applied by the others after the lease expires.
+ORDER_JOURNAL_LEASE = float(os.getenv("ORDER_JOURNAL_LEASE", "30"))  # seconds
+# Interval to look for the entries to retry, and the ones journaled by the other workers.
+ORDER_JOURNAL_POLL_INTERVAL = float(os.getenv("ORDER_JOURNAL_POLL_INTERVAL", "1"))  # seconds
+# Requests to the shop in flight per worker, so that a slow request doesn't hold back the others.
+ORDER_JOURNAL_CONCURRENCY = int(os.getenv("ORDER_JOURNAL_CONCURRENCY", "4"))
+# Used tickets are remembered on the journal for this long, to detect the double use before the shop is updated.
+ORDER_PRODUCT_CLAIM_TTL = datetime.timedelta(days=1)
+RETRYABLE_STATUS_CODES = {408, 425, 429}
+
+logger = logging.getLogger(__name__)
+
+OrderJournalEntryStatus = typing.Literal["pending", "applied", "failed"]
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+class OrderJournalEntry(pydantic.BaseModel):
+    # Also sent as the idempotency key, so that the shop can ignore the retries of an applied modification.
+    id: uuid.UUID = pydantic.Field(default_factory=uuid.uuid4)
+    order_id: uuid.UUID
+    # Desk which the result is reported to
+    session_id: uuid.UUID | None = None
+    data: models.OrderModifyRequestDTO
+    status: OrderJournalEntryStatus = "pending"
+    attempts: int = 0
+    journaled_at: float = pydantic.Field(default_factory=time.time)
+    next_attempt_at: float = 0
+    last_error: str | None = None
+    # Order returned by the shop, which replaces the one on the desk's handled orders.
+    result: models.OrderDTO | None = None
+
+
+class OrderJournal:
+    """
+    Write-behind journal of the order modifications, so that the desks don't wait for the shop to apply them.
+
+    Entries are stored on Redis (or the embedded state store), and applied to the shop by the replayer running on
+    every API worker, retried with backoff while the shop is unreachable, and sent with the entry id as the
+    idempotency key. Each entry is worked on by a single worker at a time, under a lease which expires if it crashes.
+    Entries which the shop rejects, or which are still failing after the max attempts, are kept as failed for a while.
+    Tickets are claimed on the journal when they're used, so that a ticket used twice is detected
+    even before the shop is updated. Results are reported to the desk's unsynced_orders.
+
+    Usage:
+        if not await order_journal.claim(redis_cli, product_id):
+            ...  # The ticket is used twice
+        await order_journal.append(redis_cli, order_id, data, session_id)
+        order = await order_journal.apply_pending(redis_cli, order)  # order fetched from the shop
+        await order_journal.replay_periodically(redis_cli)  # on startup
+    """
+
+    def __init__(self) -> None:
+        # Set when an entry is journaled on this worker, to apply it without waiting for the next poll.
+        self.wakeup = asyncio.Event()
+
+    async def claim(self, redis_cli: redis_client.AsyncRedisSession, product_id: uuid.UUID) -> bool:
+        """Marks the ticket as used. Returns False if it's already marked, which means the ticket is used twice."""
+        now = time.time()
+        async with redis_cli.pipeline(transaction=False) as pipeline:
+            pipeline.zremrangebyscore(
+                redis_client.RedisKey.ORDER_PRODUCT_CLAIMS, "-inf", now - ORDER_PRODUCT_CLAIM_TTL.total_seconds()
+            )
+            pipeline.zadd(redis_client.RedisKey.ORDER_PRODUCT_CLAIMS, {str(product_id): now}, nx=True)
+            _, claimed = await pipeline.execute()
+        return bool(claimed)
+
+    async def release(self, redis_cli: redis_client.AsyncRedisSession, *product_ids: uuid.UUID) -> None:
+        """Unmarks the tickets claimed by a request failed before journaling, or by an entry failed on the shop."""
+        if product_ids:
+            await redis_cli.zrem(redis_client.RedisKey.ORDER_PRODUCT_CLAIMS, *(str(p) for p in product_ids))
+
+    async def append(
+        self,
+        redis_cli: redis_client.AsyncRedisSession,
+        order_id: uuid.UUID,
+        data: models.OrderModifyRequestDTO,
+        session_id: uuid.UUID | None = None,
+    ) -> OrderJournalEntry:
+        entry = OrderJournalEntry(order_id=order_id, session_id=session_id, data=data)
+        await self.save(redis_cli, entry)
+        metrics.ORDER_JOURNAL_ENTRIES_TOTAL.inc(result="journaled")
+        self.wakeup.set()
+        return entry
+
+    def queue_save(self, pipeline: redis_client.RedisCommands, entry: OrderJournalEntry) -> None:
+        pipeline.hset(redis_client.RedisKey.ORDER_JOURNAL, str(entry.id), entry.model_dump_json())
+        pipeline.zadd(redis_client.RedisKey.ORDER_JOURNAL_PENDING, {str(entry.id): entry.next_attempt_at})
+
+    async def save(self, redis_cli: redis_client.AsyncRedisSession, entry: OrderJournalEntry) -> None:
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            self.queue_save(pipeline, entry)
+            await pipeline.execute()
+
+    async def load(
+        self, redis_cli: redis_client.AsyncRedisSession, entry_ids: list[bytes] | list[str]
+    ) -> list[OrderJournalEntry]:
+        if not entry_ids:
+            return []
+        return [
+            OrderJournalEntry.model_validate_json(data)
+            for data in await redis_cli.hmget(redis_client.RedisKey.ORDER_JOURNAL, entry_ids)
+            if data
+        ]
+
+    async def apply_pending(self, redis_cli: redis_client.AsyncRedisSession, order: models.OrderDTO) -> models.OrderDTO:
+        """Returns the order fetched from the shop, with the journaled modifications not applied to the shop yet."""
+        entry_ids = await redis_cli.zrangebyscore(redis_client.RedisKey.ORDER_JOURNAL_PENDING, "-inf", "+inf")
+        for entry in sorted(await self.load(redis_cli, entry_ids), key=lambda entry: entry.journaled_at):
+            if entry.order_id == order.id and entry.status == "pending":
+                order = order.apply_modification(entry.data)
+        return order
+
+    async def replay_periodically(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.replay_due(redis_cli)
+            except Exception as e:
+                logger.warning(f"Failed to replay the order journal: {e!r}")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), ORDER_JOURNAL_POLL_INTERVAL)
+
+    async def replay_due(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        semaphore = asyncio.Semaphore(ORDER_JOURNAL_CONCURRENCY)
+
+        async def replay(entry_id: str) -> OrderJournalEntry | None:
+            async with semaphore:
+                return await self.replay(redis_cli, entry_id)
+
+        await self.prune_failed(redis_cli)
+        entry_ids = await redis_cli.zrangebyscore(redis_client.RedisKey.ORDER_JOURNAL_PENDING, "-inf", time.time())
+        entries: list[OrderJournalEntry] = []
+        for result in await asyncio.gather(*(replay(e.decode()) for e in entry_ids), return_exceptions=True):
+            if isinstance(result, BaseException):
+                logger.warning(f"Failed to replay an order journal entry: {result!r}")
+            elif result:
+                entries.append(result)
+        if not entries:
+            return
+
+        # Results are reported together, so that the app state is locked once per poll instead of once per entry.
+        try:
+            await self.report(redis_cli, entries)
+        finally:
+            await redis_cli.zrem(redis_client.RedisKey.ORDER_JOURNAL_LEASES, *(str(entry.id) for entry in entries))
+
+    async def prune_failed(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        expired_at = time.time() - ORDER_JOURNAL_FAILED_RETENTION.total_seconds()
+        if not (
+            entry_ids := await redis_cli.zrangebyscore(redis_client.RedisKey.ORDER_JOURNAL_FAILED, "-inf", expired_at)
+        ):
+            return
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            pipeline.hdel(redis_client.RedisKey.ORDER_JOURNAL, *entry_ids)
+            pipeline.zrem(redis_client.RedisKey.ORDER_JOURNAL_FAILED, *entry_ids)
+            await pipeline.execute()
+
+    async def acquire_lease(self, redis_cli: redis_client.AsyncRedisSession, entry_id: str) -> bool:
+        now = time.time()
+        async with redis_cli.pipeline(transaction=False) as pipeline:
+            pipeline.zremrangebyscore(redis_client.RedisKey.ORDER_JOURNAL_LEASES, "-inf", now)
+            pipeline.zadd(redis_client.RedisKey.ORDER_JOURNAL_LEASES, {entry_id: now + ORDER_JOURNAL_LEASE}, nx=True)
+            _, acquired = await pipeline.execute()
+        return bool(acquired)
+
+    async def replay(self, redis_cli: redis_client.AsyncRedisSession, entry_id: str) -> OrderJournalEntry | None:
+        """Applies the entry, and returns it if the result is to be reported. Its lease is kept until it's reported."""
+        if not await self.acquire_lease(redis_cli, entry_id):
+            return None
+
+        to_report: OrderJournalEntry | None = None
+        try:
+            if not (entries := await self.load(redis_cli, [entry_id])):
+                await redis_cli.zrem(redis_client.RedisKey.ORDER_JOURNAL_PENDING, entry_id)
+                return None
+            # Entry might be rescheduled by another worker after this one listed the due entries.
+            if (entry := entries[0]).next_attempt_at > time.time():
+                return None
+
+            if entry.status == "pending":
+                await self.apply(redis_cli, entry)
+            if entry.status != "pending":
+                to_report = entry
+            return to_report
+        finally:
+            if not to_report:
+                await redis_cli.zrem(redis_client.RedisKey.ORDER_JOURNAL_LEASES, entry_id)
+
+    async def apply(self, redis_cli: redis_client.AsyncRedisSession, entry: OrderJournalEntry) -> None:
+        app_state = await dependencies.app_state_snapshot_cache.get(redis_cli)
+        entry.attempts += 1
+        with tracing.span("order_journal.apply", order_id=str(entry.order_id), attempt=entry.attempts):
+            try:
+                entry.result = await app_state.shop_api.modify_order(
+                    order_id=str(entry.order_id), data=entry.data, idempotency_key=str(entry.id)
+                )
+                entry.status = "applied"
+                metrics.ORDER_JOURNAL_LAG_SECONDS.observe(time.time() - entry.journaled_at)
+            except Exception as e:
+                entry.last_error = repr(e)
+                if is_retryable(e) and entry.attempts < ORDER_JOURNAL_MAX_ATTEMPTS:
+                    delay = min(
+                        ORDER_JOURNAL_RETRY_MIN_DELAY * 2 ** (entry.attempts - 1), ORDER_JOURNAL_RETRY_MAX_DELAY
+                    )
+                    entry.next_attempt_at = time.time() + delay
+                    logger.warning(f"Failed to modify order {entry.order_id}, retrying in {delay:.0f}s: {e!r}")
+                else:
+                    entry.status = "failed"
+                    logger.error(
+                        f"Failed to modify order {entry.order_id} on {entry.attempts} attempts, giving up: {e!r}"
+                    )
+
+        metrics.ORDER_JOURNAL_ENTRIES_TOTAL.inc(result="retried" if entry.status == "pending" else entry.status)
+        await self.save(redis_cli, entry)
+        if entry.status == "failed":
+            # Tickets are not used on the shop, so they can be used again once the order is fixed.
+            await self.release(redis_cli, *(p.id for p in entry.data.products if p.status == "used"))
+
+    async def report(self, redis_cli: redis_client.AsyncRedisSession, entries: list[OrderJournalEntry]) -> None:
+        """
+        Reports the results to the desks, and removes the reported entries from the journal. Failed ones are kept on it,
+        until they're pruned after the retention.
+        Entries which cannot be reported yet are retried on the next poll.
+        """
+        reported = await self.report_to_sessions(redis_cli, entries)
+        async with redis_cli.pipeline(transaction=True) as pipeline:
+            for entry in entries:
+                if entry.id not in reported:
+                    entry.next_attempt_at = time.time() + ORDER_JOURNAL_POLL_INTERVAL
+                    self.queue_save(pipeline, entry)
+                    continue
+                pipeline.zrem(redis_client.RedisKey.ORDER_JOURNAL_PENDING, str(entry.id))
+                if entry.status == "applied":
+                    pipeline.hdel(redis_client.RedisKey.ORDER_JOURNAL, str(entry.id))
+                else:
+                    pipeline.zadd(redis_client.RedisKey.ORDER_JOURNAL_FAILED, {str(entry.id): time.time()})
+            await pipeline.execute()
+
+    async def report_to_sessions(
+        self, redis_cli: redis_client.AsyncRedisSession, entries: list[OrderJournalEntry]
+    ) -> set[uuid.UUID]:
+        """
+        Returns the ids of the reported entries, all under a single lock of the app state.
+        Entries of the desks still handling the order are not reported, so that the desks' own commits don't conflict.
+        """
+
+        def is_busy(app_state: models.AppState, entry: OrderJournalEntry) -> bool | None:
+            if not (entry.session_id and (session := app_state.sessions.get(entry.session_id))):
+                return None
+            return bool(session.state.order and session.state.order.id == entry.order_id)
+
+        snapshot = await dependencies.app_state_snapshot_cache.get(redis_cli)
+        # Entries without the desk are reported as-is.
+        reported = {entry.id for entry in entries if is_busy(snapshot, entry) is None}
+        if not (to_report := [entry for entry in entries if is_busy(snapshot, entry) is False]):
+            return reported
+
+        reported_on_state: set[uuid.UUID] = set()
+        try:
+            async with dependencies.locked_app_state_context(redis_cli=redis_cli) as app_state:
+                for entry in to_report:
+                    if (busy := is_busy(app_state, entry)) is not False:
+                        if not busy:
+                            reported_on_state.add(entry.id)
+                        continue
+
+                    state = app_state.sessions[typing.cast(uuid.UUID, entry.session_id)].state
+                    if entry.status == "applied":
+                        state.unsynced_orders.pop(entry.order_id, None)
+                    else:
+                        state.unsynced_orders[entry.order_id] = "failed"
+                    if entry.result:
+                        state.handled_order = [entry.result if o == entry.result else o for o in state.handled_order]
+                    state.commit_id = uuid.uuid4()
+                    reported_on_state.add(entry.id)
+        except fastapi.HTTPException:
+            # Conflicted with the other writers on the optimistic write mode
+            return reported
+        return reported | reported_on_state
+
+
+order_journal = OrderJournal()
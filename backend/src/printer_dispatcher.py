@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import random
+import time
+import typing
+import uuid
+
+import pydantic
+import src.metrics as metrics
+import src.models as models
+import src.redis_client as redis_client
+import src.tracing as tracing
+
+# Jobs running longer than this are not counted as the load, so the jobs of a crashed worker don't stick forever.
+PRINTER_JOB_TIMEOUT = float(os.getenv("PRINTER_JOB_TIMEOUT", "60"))  # seconds
+# Printers are not picked for a while after a failed job, unless every printer of the pool has failed.
+PRINTER_FAILURE_COOLDOWN = float(os.getenv("PRINTER_FAILURE_COOLDOWN", "30"))  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class PrintJob(pydantic.BaseModel):
+    id: str = pydantic.Field(default_factory=lambda: uuid.uuid4().hex)
+    printer: models.Printer
+    # Set by the caller when writing to the printer failed, so that the next jobs go to the other printers.
+    failed: bool = False
+
+
+class PrinterDispatcher:
+    """
+    Picks the printer of each print job among the printers of the desk's pool.
+
+    Jobs in flight and the failures are recorded on Redis, so that the load is shared by every API worker.
+    Each job goes to the ready printer (connected, and not failed recently) with the fewest jobs in flight,
+    so a jammed or slow printer gets fewer jobs while its queue is long, and none for a while after it fails.
+    Desks with a single printer are dispatched to it without touching Redis.
+
+    Usage:
+        async with printer_dispatcher.dispatch(redis_cli, session.state) as job:
+            if job:
+                try:
+                    await job.printer.async_print_image(image, redis_cli)
+                except Exception:
+                    job.failed = True
+    """
+
+    async def pick(self, redis_cli: redis_client.AsyncRedisSession, printers: list[models.Printer]) -> models.Printer:
+        now = time.time()
+        async with redis_cli.pipeline(transaction=False) as pipeline:
+            for printer in printers:
+                key = redis_client.RedisKey.PRINTER_JOBS.format(printer=printer.identifier)
+                pipeline.zremrangebyscore(key, "-inf", now - PRINTER_JOB_TIMEOUT)
+                pipeline.zcard(key)
+            pipeline.hmget(redis_client.RedisKey.PRINTER_FAILED_AT, [printer.identifier for printer in printers])
+            *results, failed_at_values = await pipeline.execute()
+
+        loads = dict(zip((printer.identifier for printer in printers), results[1::2]))
+        failed_at = {p.identifier: float(t) for p, t in zip(printers, failed_at_values) if t is not None}
+        ready = [
+            printer
+            for printer in printers
+            if os.path.exists(printer.cdc_path)
+            and failed_at.get(printer.identifier, 0) < now - PRINTER_FAILURE_COOLDOWN
+        ]
+        # Labels are still sent to the least recently failed one if no printer is ready, rather than dropped.
+        candidates = ready or sorted(printers, key=lambda p: failed_at.get(p.identifier, 0))[:1]
+        least_load = min(loads[printer.identifier] for printer in candidates)
+        # Ties are broken randomly, as the workers would otherwise pick the same printer at once.
+        return random.choice([printer for printer in candidates if loads[printer.identifier] == least_load])
+
+    @contextlib.asynccontextmanager
+    async def dispatch(
+        self, redis_cli: redis_client.AsyncRedisSession, state: models.SessionState
+    ) -> typing.AsyncIterator[PrintJob | None]:
+        """Yields the print job on the picked printer, or None if the desk has no printer."""
+        if not (printers := state.printers):
+            yield None
+            return
+        if not state.printer_pool:
+            yield PrintJob(printer=printers[0])
+            return
+
+        with tracing.span("printer.dispatch", pool=state.printer_pool):
+            job = PrintJob(printer=await self.pick(redis_cli, printers))
+            tracing.annotate(printer=job.printer.identifier)
+        metrics.PRINTER_DISPATCHES_TOTAL.inc(pool=state.printer_pool, printer=job.printer.identifier)
+
+        key = redis_client.RedisKey.PRINTER_JOBS.format(printer=job.printer.identifier)
+        async with redis_cli.pipeline(transaction=False) as pipeline:
+            pipeline.zadd(key, {job.id: time.time()})
+            pipeline.expire(key, int(PRINTER_JOB_TIMEOUT))
+            await pipeline.execute()
+        try:
+            yield job
+        except Exception:
+            job.failed = True
+            raise
+        finally:
+            async with redis_cli.pipeline(transaction=False) as pipeline:
+                pipeline.zrem(key, job.id)
+                if job.failed:
+                    logger.warning(f"Printer {job.printer.identifier} of pool {state.printer_pool} failed a job")
+                    pipeline.hset(redis_client.RedisKey.PRINTER_FAILED_AT, job.printer.identifier, time.time())
+                else:
+                    pipeline.hdel(redis_client.RedisKey.PRINTER_FAILED_AT, job.printer.identifier)
+                await pipeline.execute()
+
+
+printer_dispatcher = PrinterDispatcher()
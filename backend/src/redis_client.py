@@ -1,16 +1,157 @@
+import datetime
 import logging
+import os
 import typing
+import uuid
 
 import pydantic
 import redis
 import redis.asyncio as aioredis
+import src.embedded_state as embedded_state
 
 logger = logging.getLogger(__name__)
 
+KeyT = str | bytes
+ValueT = bytes | float | int | str
+# Members & scores of ZADD. Keys are typed as redis-py takes them, since a mapping is invariant in its key type.
+SortedSetScores = dict[KeyT, float]
+
+AppStateWriteMode = typing.Literal["lock", "optimistic"]
+# lock: every write is serialized with the global Redis lock.
+# optimistic: writes are not serialized, and committed with WATCH/MULTI, merged and retried on conflicts.
+APP_STATE_WRITE_MODE: AppStateWriteMode = typing.cast(AppStateWriteMode, os.getenv("APP_STATE_WRITE_MODE", "lock"))
+OPTIMISTIC_COMMIT_MAX_RETRIES = 10
+# Max delay of the first retry in seconds, doubled on every conflict and jittered so that the writers spread out.
+OPTIMISTIC_COMMIT_BACKOFF = 0.005
+
+HANDLED_ORDER_ARCHIVE_LIMIT = 10000
+HANDLED_ORDER_ARCHIVE_TTL = datetime.timedelta(days=1)
+
 
 class RedisKey:
     APP_STATE_WRITE_LOCK = "app_state_write_lock"
     PUBSUB_CHANNEL = "global_status"
+    # Counter increased on every app state commit, published to PUBSUB_CHANNEL on broadcast.
+    APP_STATE_VERSION = "app_state_version"
+    HANDLED_ORDER_ARCHIVE = "handled_order_archive:{session_id}"
+    # Sorted set of session ids, scored by the timestamp of the session's last ping
+    SESSION_PING_AT = "session_ping_at"
+    # Hash of the metric series, incremented by every process. See src.metrics.
+    METRICS = "metrics"
+    # List of the finished spans of a trace, newest at the head, expiring after the retention. See src.tracing.
+    TRACE_SPANS = "trace_spans:{trace_id}"
+    # Sorted sets of the trace ids, scored by the duration (ms) and the start time (s) of their root spans.
+    TRACE_DURATIONS = "trace_durations"
+    TRACE_STARTED_AT = "trace_started_at"
+    # Sorted set of the print jobs in flight on a pooled printer, scored by the start time. See src.printer_dispatcher.
+    PRINTER_JOBS = "printer_jobs:{printer}"
+    # Hash of the timestamps of the last failed print job, keyed by the printer identifier.
+    PRINTER_FAILED_AT = "printer_failed_at"
+    # Sorted set of the files stored on a TSPL printer, scored by the time they're last used. See models.Printer.
+    PRINTER_FILES = "printer_files:{printer}"
+    # Lock of a TSPL printer, held while a job using the files stored on it is encoded and written.
+    PRINTER_FILES_LOCK = "printer_files_lock:{printer}"
+    # Hash of the order modifications to apply to the shop, keyed by the entry id. See src.order_journal.
+    ORDER_JOURNAL = "order_journal"
+    # Sorted set of the journal entries to work on, scored by the time of the next attempt.
+    ORDER_JOURNAL_PENDING = "order_journal_pending"
+    # Sorted set of the journal entries being worked on by a worker, scored by the expiry of the lease.
+    ORDER_JOURNAL_LEASES = "order_journal_leases"
+    # Sorted set of the failed journal entries kept on the journal, scored by the time they're reported.
+    ORDER_JOURNAL_FAILED = "order_journal_failed"
+    # Sorted set of the order product ids marked as used on the journal, scored by the time they're marked.
+    ORDER_PRODUCT_CLAIMS = "order_product_claims"
+
+
+class RedisCommands(typing.Protocol):
+    """
+    Commands used by ROSA, which redis-py and the embedded store (see src.embedded_state) both implement.
+    Results are typed as Any, since the async sessions return awaitables and the pipelines return themselves.
+    """
+
+    def get(self, name: KeyT, /) -> typing.Any: ...
+    def set(self, name: KeyT, value: ValueT, /) -> typing.Any: ...
+    def incr(self, name: KeyT, /) -> typing.Any: ...
+    def delete(self, *names: KeyT) -> typing.Any: ...
+    def expire(self, name: KeyT, time: int | datetime.timedelta, /) -> typing.Any: ...
+    def lpush(self, name: KeyT, /, *values: ValueT) -> typing.Any: ...
+    def ltrim(self, name: KeyT, start: int, end: int, /) -> typing.Any: ...
+    def lrange(self, name: KeyT, start: int, end: int, /) -> typing.Any: ...
+    def hset(self, name: KeyT, key: KeyT, value: ValueT, /) -> typing.Any: ...
+    def hdel(self, name: KeyT, /, *keys: KeyT) -> typing.Any: ...
+    def hincrbyfloat(self, name: KeyT, key: KeyT, amount: float, /) -> typing.Any: ...
+    def hgetall(self, name: KeyT, /) -> typing.Any: ...
+    def hmget(self, name: KeyT, keys: typing.Iterable[KeyT], /) -> typing.Any: ...
+    def zadd(self, name: KeyT, mapping: typing.Mapping[KeyT, ValueT], /, nx: bool = False) -> typing.Any: ...
+    def zrem(self, name: KeyT, /, *values: ValueT) -> typing.Any: ...
+    def zrangebyscore(self, name: KeyT, min: float | str, max: float | str, /) -> typing.Any: ...
+
+    def zrevrangebyscore(
+        self, name: KeyT, max: float | str, min: float | str, /, start: int | None = None, num: int | None = None
+    ) -> typing.Any: ...
+
+    def zremrangebyscore(self, name: KeyT, min: float | str, max: float | str, /) -> typing.Any: ...
+    def zcard(self, name: KeyT, /) -> typing.Any: ...
+
+
+class RedisPipeline(RedisCommands, typing.Protocol):
+    """Subset of redis.client.Pipeline used by ROSA"""
+
+    def watch(self, *names: KeyT) -> typing.Any: ...
+    def unwatch(self) -> typing.Any: ...
+    def multi(self) -> typing.Any: ...
+    def execute(self) -> list[typing.Any]: ...
+    def __enter__(self) -> typing.Self: ...
+    def __exit__(self, exc_type: typing.Any, exc_value: typing.Any, traceback: typing.Any, /) -> typing.Any: ...
+
+
+class AsyncRedisPipeline(RedisCommands, typing.Protocol):
+    """Subset of redis.asyncio.client.Pipeline used by ROSA"""
+
+    def watch(self, *names: KeyT) -> typing.Awaitable[typing.Any]: ...
+    def unwatch(self) -> typing.Any: ...
+    def multi(self) -> typing.Any: ...
+    def execute(self) -> typing.Awaitable[list[typing.Any]]: ...
+    async def __aenter__(self) -> typing.Self: ...
+    async def __aexit__(self, exc_type: typing.Any, exc_value: typing.Any, traceback: typing.Any, /) -> typing.Any: ...
+
+
+class RedisSession(RedisCommands, typing.Protocol):
+    """
+    Subset of redis.Redis used by ROSA, which the sessions of both RedisClient and EmbeddedStateClient are.
+    Usage:
+        def clean(redis_session: redis_client.RedisSession) -> None:
+            with redis_session.pipeline(transaction=True) as pipeline:
+                ...
+    """
+
+    def ping(self) -> typing.Any: ...
+    def publish(self, channel: KeyT, message: KeyT, /) -> typing.Any: ...
+    def pubsub(self, *, ignore_subscribe_messages: bool = False) -> typing.Any: ...
+    def pipeline(self, transaction: bool = True) -> RedisPipeline: ...
+    def lock(self, name: str, /, timeout: float | None = None) -> typing.ContextManager[typing.Any]: ...
+
+
+class AsyncRedisSession(RedisCommands, typing.Protocol):
+    """Subset of redis.asyncio.Redis used by ROSA, which the async sessions of the state clients are."""
+
+    def ping(self) -> typing.Awaitable[typing.Any]: ...
+    def publish(self, channel: KeyT, message: KeyT, /) -> typing.Awaitable[typing.Any]: ...
+    def pubsub(self, *, ignore_subscribe_messages: bool = False) -> typing.Any: ...
+    def pipeline(self, transaction: bool = True) -> AsyncRedisPipeline: ...
+    def lock(self, name: str, /, timeout: float | None = None) -> typing.AsyncContextManager[typing.Any]: ...
+
+
+def archive_handled_orders(
+    pipeline: RedisCommands,
+    session_id: uuid.UUID,
+    orders: list[str],
+) -> None:
+    """Queues commands that push orders (oldest first) to the session's handled order archive, newest at the head."""
+    key = RedisKey.HANDLED_ORDER_ARCHIVE.format(session_id=session_id)
+    pipeline.lpush(key, *orders)
+    pipeline.ltrim(key, 0, HANDLED_ORDER_ARCHIVE_LIMIT - 1)
+    pipeline.expire(key, HANDLED_ORDER_ARCHIVE_TTL)
 
 
 class RedisClient(pydantic.BaseModel):
@@ -49,3 +190,18 @@ class RedisClient(pydantic.BaseModel):
     @property
     def sync_session(self) -> redis.Redis:
         return redis.Redis(connection_pool=self.sync_connection_pool)
+
+
+StateClient = RedisClient | embedded_state.EmbeddedStateClient
+
+
+def connect(dsn: str | None) -> StateClient:
+    """
+    Connects to the state store of the DSN.
+    redis://...: Redis server, shared by the nodes.
+    sqlite:///path/to/state.sqlite3: embedded store, shared by the processes of a single node. See src.embedded_state.
+        The path is relative to the working directory, and sqlite:////path/to/state.sqlite3 is an absolute path.
+    """
+    if dsn and dsn.startswith(embedded_state.EMBEDDED_STATE_DSN_PREFIX):
+        return embedded_state.EmbeddedStateClient(dsn)
+    return RedisClient(dsn=dsn)
@@ -1,8 +1,14 @@
-import pathlib as pt
+import importlib
+import pkgutil
 
 import fastapi
-import src.utils.stdlibs.import_utils as import_utils
 
 
 def get_routes() -> list[fastapi.APIRouter]:
-    return import_utils.auto_import_objs("router", "", pt.Path(__file__).parent)
+    # Imported by the package name rather than executed from the file path,
+    # so that the route modules are not loaded twice when they're also imported elsewhere.
+    return [
+        router
+        for module_info in pkgutil.iter_modules(__path__)
+        if (router := getattr(importlib.import_module(f"{__name__}.{module_info.name}"), "router", None))
+    ]
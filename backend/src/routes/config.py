@@ -1,6 +1,13 @@
+import asyncio
+import http
+import typing
+import uuid
+
 import fastapi
+import pydantic
 import src.dependencies as deps
 import src.models as models
+import src.redis_client as redis_client
 import src.utils.hals as hals
 
 router = fastapi.APIRouter(prefix="/config")
@@ -14,28 +21,110 @@ def set_session_config(session: deps.lockedSessionInfoDI, payload: models.Sessio
 
 
 @router.put(path="/shop-domain")
-async def set_shop_domain_config(app_state: deps.lockedAppStateDI, payload: models.ShopAPIConfig) -> models.AppState:
+async def set_shop_domain_config(
+    app_state: deps.lockedAppStateDI, redis_cli: deps.redisDI, payload: models.ShopAPIConfig
+) -> models.AppState:
     """상점 API 설정 API"""
     if app_state.shop_api.domain != payload.domain:
         for session in app_state.sessions.values():
             session.state.order = None
             session.state.handled_order = []
+            session.state.pop_archivable_orders()
+            session.state.commit_id = uuid.uuid4()
+        if app_state.sessions:
+            await redis_cli.delete(
+                *(redis_client.RedisKey.HANDLED_ORDER_ARCHIVE.format(session_id=sid) for sid in app_state.sessions)
+            )
     app_state.shop_api = payload
     return app_state
 
 
 @router.get(path="/shop-domain/check-connectivity")
-async def check_connectivity(app_state: deps.appStateQuerierDI) -> dict[str, bool]:
+async def check_connectivity(app_state: deps.appStateQuerierDI) -> dict[str, bool | dict[str, typing.Any]]:
     """상점 API 연결 확인 API"""
-    return {"status": await app_state.shop_api.can_communicate()}
+    # 차단기가 열려 있으면 상점에 요청하지 않고 실패하므로, 이 API 워커의 차단기 상태를 함께 반환합니다.
+    status = await app_state.shop_api.can_communicate()
+    return {"status": status, "circuit_breaker": app_state.shop_api.guard.status.model_dump()}
 
 
-@router.get(path="/devices/possibles")
-async def list_possible_devices(app_state: deps.appStateQuerierDI) -> list[models.USBDevice]:
-    """등록 가능한 장치 목록 조회 API"""
-    used_block_paths: list[str] = []
+def get_used_block_paths(app_state: models.AppState, exclude_pool: str | None = None) -> set[str]:
+    used_block_paths: set[str] = set()
     for s in app_state.sessions.values():
         device_list: list[models.USBDevice] = [d for d in (s.state.printer, s.state.reader) if d]
         for d in device_list:
-            used_block_paths.append(d.block_path)
-    return [models.USBDevice(**d) for d in hals.list_usb_devices() if d["block_path"] not in used_block_paths]
+            used_block_paths.add(d.block_path)
+    for name, pool in app_state.printer_pools.items():
+        if name != exclude_pool:
+            used_block_paths.update(p.block_path for p in pool.printers)
+    return used_block_paths
+
+
+@router.get(path="/devices/possibles")
+async def list_possible_devices(app_state: deps.appStateQuerierDI) -> list[models.USBDevice]:
+    """등록 가능한 장치 목록 조회 API (프린터 풀에 등록된 프린터 제외)"""
+    used_block_paths = get_used_block_paths(app_state)
+    devices = await asyncio.to_thread(hals.device_inventory.list)
+    return [models.USBDevice(**d) for d in devices if d["block_path"] not in used_block_paths]
+
+
+class SetPrinterPoolRequestPayload(pydantic.BaseModel):
+    cdc_paths: list[str] = pydantic.Field(min_length=1)
+    cmd_mode: models.PrinterCmdType = "ESCP"
+    label: models.PrinterProfile.Label
+    render_profile: models.PrinterProfile.RenderProfile | None = None
+
+    @pydantic.field_validator("cdc_paths", mode="before")
+    @classmethod
+    def validate_cdc_paths(cls, v: list[str]) -> list[str]:
+        if not all(hals.retrieve_usb_device(cdc_path) for cdc_path in v):
+            raise ValueError("CDC paths must be block devices.")
+        return v
+
+    def as_model(self, name: str) -> models.PrinterPool:
+        # Printers of a pool share the same label profile, so that the labels print the same on any of them.
+        return models.PrinterPool(
+            name=name,
+            printers=[
+                models.Printer(
+                    **hals.retrieve_usb_device(cdc_path),
+                    cmd_type=self.cmd_mode,
+                    label=self.label,
+                    render_profile=self.render_profile,
+                )
+                for cdc_path in self.cdc_paths
+            ],
+        )
+
+
+@router.get(path="/printer-pools")
+async def list_printer_pools(app_state: deps.appStateQuerierDI) -> list[models.PrinterPool]:
+    """프린터 풀 목록 조회 API"""
+    return list(app_state.printer_pools.values())
+
+
+@router.put(path="/printer-pools/{name}")
+async def set_printer_pool(
+    app_state: deps.lockedAppStateDI, name: str, payload: SetPrinterPoolRequestPayload
+) -> models.AppState:
+    """
+    프린터 풀 설정 API
+    같은 라벨 설정을 가진 여러 프린터를 하나의 풀로 묶으며, 풀을 사용하는 데스크의 라벨은 풀에서 가장 한가한 프린터로 출력됩니다.
+    """
+    pool = payload.as_model(name)
+    if any(p.block_path in get_used_block_paths(app_state, exclude_pool=name) for p in pool.printers):
+        raise fastapi.HTTPException(status_code=http.HTTPStatus.CONFLICT, detail="이미 사용 중인 프린터입니다.")
+
+    # printer_pools is always replaced rather than modified, as the shared state is cached until it's replaced.
+    app_state.printer_pools = {**app_state.printer_pools, name: pool}
+    return app_state
+
+
+@router.delete(path="/printer-pools/{name}")
+async def delete_printer_pool(app_state: deps.lockedAppStateDI, name: str) -> models.AppState:
+    """프린터 풀 삭제 API"""
+    app_state.printer_pools = {k: v for k, v in app_state.printer_pools.items() if k != name}
+    for session in app_state.sessions.values():
+        if session.state.printer_pool == name:
+            session.state.printer_pool = None
+            session.state.commit_id = uuid.uuid4()
+    return app_state
@@ -0,0 +1,19 @@
+import http
+
+import fastapi
+import src.warmup as warmup
+
+router = fastapi.APIRouter(prefix="")
+
+
+@router.get(path="/health")
+async def get_health(request: fastapi.Request, response: fastapi.Response) -> dict:
+    """헬스 체크 API"""
+    warm_up: warmup.WarmUp | None = getattr(request.app.state, "warm_up", None)
+    if not (ready := bool(warm_up and warm_up.ready)):
+        # Not ready until the warm-up is finished, so that the traffic is routed only to the warmed up workers.
+        response.status_code = http.HTTPStatus.SERVICE_UNAVAILABLE
+    return {
+        "status": "ready" if ready else "warming_up",
+        "warm_up": warm_up.model_dump(mode="json") if warm_up else None,
+    }
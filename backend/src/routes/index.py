@@ -1,7 +1,5 @@
-import pathlib
-
 import fastapi
-import fastapi.staticfiles
+import src.static_assets as static_assets
 import starlette.responses
 
 router = fastapi.APIRouter(prefix="")
@@ -9,8 +7,8 @@ router = fastapi.APIRouter(prefix="")
 
 @router.get(path="/", response_class=fastapi.responses.HTMLResponse)
 @router.get(path="/index.html", response_class=fastapi.responses.HTMLResponse)
-async def index() -> str:
+async def index(request: fastapi.Request) -> starlette.responses.Response:
     """index.html 페이지"""
-    if not pathlib.Path("src/static/index.html").exists():
-        return "index.html not found"
-    return starlette.responses.FileResponse("src/static/index.html")
+    if not (asset := static_assets.static_assets.get("index.html")):
+        return fastapi.responses.HTMLResponse("index.html not found")
+    return asset.response(request.headers, static_assets.REVALIDATE_CACHE_CONTROL)
@@ -1,15 +1,20 @@
+import asyncio
 import base64
+import contextlib
 import http
-import io
 import logging
 import traceback
+import typing
 
 import fastapi
 import PIL.Image
 import src.dependencies as deps
+import src.label_store as label_store
 import src.models as models
+import src.printer_dispatcher as printer_dispatcher
 import src.utils.hals.printers.escp as escp_utils
 import src.utils.hals.printers.tspl as tspl_utils
+import src.utils.renderers.html_renderer as html_renderer
 
 PRINTER_SUPPORTS: dict[models.PrinterCmdType, type] = {
     "TSPL": tspl_utils.TSPL,
@@ -20,6 +25,20 @@ logger = logging.getLogger(__name__)
 router = fastapi.APIRouter(prefix="/label")
 
 
+def get_label_render_params(state: models.SessionState, preview: bool) -> tuple[dict[str, str], models.RenderOptions]:
+    """Context of the label templates and the render options for the session's printer"""
+    additional_context = {"width": "960", "height": "410"}
+    render_options = models.RenderOptions()
+    if profile := state.printer_profile:
+        additional_context.update(profile.label.model_dump(mode="json"))
+        render_options = profile.render_options
+        if preview:
+            # Previews are shown as-is, but rendered in the printer's scale, so that a preview shares
+            # the cached renders with the print rendered in the same way (a page per label or a single page).
+            render_options = render_options.model_copy(update={"rotate": False})
+    return additional_context, render_options
+
+
 @router.get(
     path="/preview",
     responses={
@@ -32,40 +51,112 @@ async def preview_labels(session_info: deps.sessionInfoQuerierDI, browser: deps.
     """라벨 출력 미리보기 API"""
     session_info.state.check_order_available()
 
-    additional_context = {"width": "960", "height": "410"}
-    if session_info.state.printer:
-        additional_context.update(session_info.state.printer.label.model_dump(mode="json"))
-
-    images: list[bytes]
+    additional_context, render_options = get_label_render_params(session_info.state, preview=True)
+    images: list[PIL.Image.Image]
     if session_info.state.print_priced_option_label:
-        images = await session_info.state.order.get_all_rendered_label_images(browser, additional_context)
+        images = await session_info.state.order.get_all_rendered_label_images(
+            browser, additional_context, render_options
+        )
     else:
-        images = [await session_info.state.order.get_rendered_nameplate_label_image(browser, additional_context)]
+        images = [
+            await session_info.state.order.get_rendered_nameplate_label_image(
+                browser, additional_context, render_options
+            )
+        ]
+
+    return [base64.b64encode(html_renderer.image_to_png(image)).decode("utf-8") for image in images]
+
 
-    return [base64.b64encode(image).decode("utf-8") for image in images]
+@router.websocket(path="/preview/stream")
+async def stream_preview_labels(
+    websocket: fastapi.WebSocket,
+    session_info: deps.sessionInfoQuerierDI,
+    browser: deps.browserDI,
+    thumbnail: bool = False,
+) -> None:
+    """
+    라벨 출력 미리보기 스트리밍 API
+    렌더링이 끝난 라벨부터 순서에 상관없이 전송합니다. 각 라벨마다 아래의 두 메시지를 차례로 전송합니다.
+    1. 라벨 정보 JSON 텍스트 메시지: {"index": 라벨 순서, "total": 전체 라벨 수, "width": px, "height": px}
+    2. 라벨 이미지 PNG 바이너리 메시지
+    모든 라벨을 전송하면 연결을 종료합니다.
+    """
+    await websocket.accept()
+    try:
+        session_info.state.check_order_available()
+    except fastapi.HTTPException as e:
+        await websocket.close(code=fastapi.status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+
+    # Each label is rendered on its own page to be sent as soon as it's rendered, so unlike preview_labels,
+    # the stream shares the cached renders with the prints only when the nameplate is printed alone.
+    additional_context, render_options = get_label_render_params(session_info.state, preview=True)
+    coroutines = session_info.state.order.get_label_images_coroutine(
+        browser,
+        additional_context,
+        include_exchange_tickets=session_info.state.print_priced_option_label,
+        render_options=render_options,
+    )
+
+    async def render_with_index(
+        index: int, coroutine: typing.Awaitable[PIL.Image.Image]
+    ) -> tuple[int, PIL.Image.Image]:
+        return index, await coroutine
+
+    with contextlib.suppress(fastapi.WebSocketDisconnect):
+        for rendered in asyncio.as_completed([render_with_index(i, c) for i, c in enumerate(coroutines)]):
+            index, image = await rendered
+            if thumbnail:
+                image = html_renderer.image_to_thumbnail(image)
+
+            await websocket.send_json(
+                {"index": index, "total": len(coroutines), "width": image.width, "height": image.height}
+            )
+            await websocket.send_bytes(html_renderer.image_to_png(image))
+        await websocket.close()
 
 
 @router.post(path="/print")
-async def print_label(session_info: deps.sessionInfoQuerierDI, browser: deps.browserDI) -> models.AppState:
+async def print_label(
+    session_info: deps.sessionInfoQuerierDI, browser: deps.browserDI, redis_cli: deps.redisDI
+) -> models.AppState:
     """라벨 출력 API"""
     session_info.state.check_order_available()
 
-    additional_context = {"width": "960", "height": "410"}
-    if session_info.state.printer:
-        additional_context.update(session_info.state.printer.label.model_dump(mode="json"))
+    additional_context, render_options = get_label_render_params(session_info.state, preview=False)
+    order = session_info.state.order
+    labels = order.get_labels(additional_context, include_exchange_tickets=session_info.state.print_priced_option_label)
+    # Labels of an order are printed on the same printer, which is picked among the pool if the desk uses one.
+    async with printer_dispatcher.printer_dispatcher.dispatch(redis_cli, session_info.state) as job:
+        # Labels pre-rendered by the label-prerender command are printed as-is, unless the order is changed since then.
+        printed_stored_labels = 0
+        if job:
+            try:
+                printed_stored_labels = await label_store.label_store.print_labels(job.printer, str(order.id), labels)
+            except label_store.StoredLabelPrintError as e:
+                job.failed = True
+                # 이미 출력된 라벨은 다시 출력하지 않고, 실패한 라벨부터 렌더링해서 출력합니다.
+                printed_stored_labels = e.printed
+                logger.error(f"Failed to print stored labels:\n{''.join(traceback.format_exception(e))}")
+        if printed_stored_labels < len(labels):
+            images: list[PIL.Image.Image]
+            if session_info.state.print_priced_option_label:
+                images = await session_info.state.order.get_all_rendered_label_images(
+                    browser, additional_context, render_options
+                )
+            else:
+                images = [
+                    await session_info.state.order.get_rendered_nameplate_label_image(
+                        browser, additional_context, render_options
+                    )
+                ]
 
-    images: list[bytes]
-    if session_info.state.print_priced_option_label:
-        images = await session_info.state.order.get_all_rendered_label_images(browser, additional_context)
-    else:
-        images = [await session_info.state.order.get_rendered_nameplate_label_image(browser, additional_context)]
-
-    for image_bytes in images:
-        with io.BytesIO(image_bytes) as image_io:
-            if printer := session_info.state.printer:
-                try:
-                    printer.print_image(image=PIL.Image.open(image_io))
-                except Exception as e:
-                    logger.error("Failed to print label:\n", traceback.format_exception(e))
+            for image in images[printed_stored_labels:]:
+                if job:
+                    try:
+                        await job.printer.async_print_image(image=image, redis_cli=redis_cli)
+                    except Exception as e:
+                        job.failed = True
+                        logger.error("Failed to print label:\n", traceback.format_exception(e))
 
     return session_info
@@ -0,0 +1,11 @@
+import fastapi
+import src.dependencies as deps
+import src.metrics as metrics
+
+router = fastapi.APIRouter(prefix="")
+
+
+@router.get(path="/metrics", response_class=fastapi.responses.PlainTextResponse)
+async def get_metrics(redis_cli: deps.redisDI) -> str:
+    """Prometheus 메트릭 조회 API"""
+    return await metrics.registry.render(redis_cli)
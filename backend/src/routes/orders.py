@@ -1,27 +1,44 @@
 import asyncio
 import datetime
 import http
-import io
 import logging
+import os
 import traceback
 
 import fastapi
 import httpx
 import PIL.Image
 import src.dependencies as deps
+import src.label_store as label_store
 import src.models as models
+import src.order_journal as order_journal
+import src.printer_dispatcher as printer_dispatcher
+import src.tracing as tracing
 import src.utils.stdlibs.str_utils as str_utils
 
 logger = logging.getLogger(__name__)
 router = fastapi.APIRouter(prefix="/session/my/order")
-WAITING_TIME = datetime.timedelta(seconds=6)
+# 자동 모드에서 라벨 출력 후 주문 정보를 화면에 보여주는 시간
+WAITING_TIME = datetime.timedelta(seconds=float(os.getenv("AUTOMATED_ORDER_WAITING_TIME", "6")))
 
 
+# 상점 API 호출은 오래 걸릴 수 있으므로, 상점 API 호출이 끝난 뒤에 세션 정보를 잠그고 수정합니다.
+# 호출 전의 세션 정보는 캐시되지 않은 최신 정보를 쓰고, 잠근 뒤에는 세션의 주문이 그대로인지 다시 확인합니다.
 @router.put(path="")
-async def set_session_order(session: deps.lockedSessionInfoDI, order_id: str | None = None) -> models.SessionState:
+async def set_session_order(
+    redis_cli: deps.redisDI, session: deps.freshSessionInfoQuerierDI, order_id: str | None = None
+) -> models.SessionState:
     """세션 주문정보 정보 설정 API"""
-    session.state.order = await session.state.app.shop_api.get_order(order_id=order_id) if order_id else None
-    return session.state
+    previous_order_id = session.state.order.id if session.state.order else None
+    order = await session.state.app.shop_api.get_order(order_id=order_id) if order_id else None
+    if order:
+        # 상점에 아직 반영되지 않은 수정 사항은 로컬 저널에서 반영합니다.
+        order = await order_journal.order_journal.apply_pending(redis_cli, order)
+    async with deps.locked_session_info_context(redis_cli=redis_cli, session_id=session.state.id) as locked_session:
+        # 상점 API 호출 중에 다른 요청(e.g. 스캔)이 주문을 바꿨다면, 더 최신의 주문을 덮어쓰지 않습니다.
+        locked_session.state.check_order_unchanged(previous_order_id)
+        locked_session.state.order = order
+        return locked_session.state
 
 
 @router.get(path="")
@@ -31,15 +48,26 @@ async def search_order(app_state: deps.appStateQuerierDI, custom_responses: str
 
 
 @router.patch(path="")
-async def modify_order(session: deps.lockedSessionInfoDI, payload: models.OrderModifyRequestDTO) -> models.SessionState:
+async def modify_order(
+    redis_cli: deps.redisDI, session: deps.freshSessionInfoQuerierDI, payload: models.OrderModifyRequestDTO
+) -> models.SessionState:
     """주문 정보 수정 API"""
     session.state.check_order_available()
-    session.state.order = await session.state.app.shop_api.modify_order(order_id=session.state.order.id, data=payload)
-    return session.state
+    order = await session.state.app.shop_api.modify_order(order_id=session.state.order.id, data=payload)
+    # 수동으로 사용 처리된 티켓도 자동 모드에서 중복 사용으로 감지되도록 저널에 기록합니다.
+    for product in payload.products:
+        if product.status == "used":
+            await order_journal.order_journal.claim(redis_cli, product.id)
+    async with deps.locked_session_info_context(redis_cli=redis_cli, session_id=session.state.id) as locked_session:
+        locked_session.state.check_order_unchanged(order.id)
+        locked_session.state.order = order
+        return locked_session.state
 
 
 @router.delete(path="")
-async def refund_order(session: deps.lockedSessionInfoDI, otp: str | None = None) -> models.SessionState:
+async def refund_order(
+    redis_cli: deps.redisDI, session: deps.freshSessionInfoQuerierDI, otp: str | None = None
+) -> models.SessionState:
     """주문 정보 환불 API"""
     session.state.check_order_available()
 
@@ -50,8 +78,11 @@ async def refund_order(session: deps.lockedSessionInfoDI, otp: str | None = None
         await session.state.app.shop_api.refund_order(order_id=session.state.order.id, otp=otp)
     except httpx.HTTPStatusError as e:
         return fastapi.Response(status_code=e.response.status_code, content=e.response.text.encode("utf-8"))
-    session.state.order = await session.state.app.shop_api.get_order(order_id=session.state.order.id)
-    return session.state
+    order = await session.state.app.shop_api.get_order(order_id=session.state.order.id)
+    async with deps.locked_session_info_context(redis_cli=redis_cli, session_id=session.state.id) as locked_session:
+        locked_session.state.check_order_unchanged(order.id)
+        locked_session.state.order = order
+        return locked_session.state
 
 
 @router.put(path="/automated")
@@ -69,44 +100,74 @@ async def handle_automated_session_order(
             status_code=http.HTTPStatus.UNPROCESSABLE_ENTITY, detail="order_id는 필수입니다."
         )
 
+    tracing.annotate(order_id=order_id, session_id=str(state.id))
+
+    # session은 다른 요청과 공유되는 캐시된 상태이므로, 수정하지 않고 지역 변수로 주문 정보를 다룹니다.
     order_data = await state.app.shop_api.get_order(order_id=order_id)
-    async with deps.locked_session_info_context(
-        redis_cli=redis_cli, session_id=state.id, used_as_dependency=False
-    ) as tmp_session:
-        tmp_session.state.order = state.order = order_data
-        # TODO: FIXME: 지금이야 단건 주문만 가능하지만, 만약 여러 상품을 한번에 주문할 수 있는 경우 수정 필요
-        ticket_opr = order_data.products[0]
-        if order_data.current_status not in ("completed", "partial_refunded") or ticket_opr.status != "paid":
-            tmp_session.state.automated = False
+    # TODO: FIXME: 지금이야 단건 주문만 가능하지만, 만약 여러 상품을 한번에 주문할 수 있는 경우 수정 필요
+    ticket_opr = order_data.products[0]
+    is_paid = order_data.current_status in ("completed", "partial_refunded") and ticket_opr.status == "paid"
+    # 사용 처리는 상점 API를 기다리지 않고 로컬 저널에 기록한 뒤, 백그라운드에서 상점에 반영합니다.
+    # 저널에 먼저 사용 처리된 티켓은 상점에 아직 반영되지 않았더라도 중복 사용으로 처리합니다.
+    is_duplicated = is_paid and not await order_journal.order_journal.claim(redis_cli, ticket_opr.id)
+    modification = models.OrderModifyRequestDTO(products=[{"id": ticket_opr.id, "status": "used"}])
+    if not is_duplicated:
+        order_data = order_data.apply_modification(modification)
 
-    async with deps.locked_session_info_context(
-        redis_cli=redis_cli, session_id=state.id, used_as_dependency=False
-    ) as tmp_session:
-        # TODO: FIXME: 지금이야 단건 주문만 가능하지만, 만약 여러 상품을 한번에 주문할 수 있는 경우 수정 필요
-        tmp_session.state.order = state.order = await session.state.app.shop_api.modify_order(
-            order_id=session.state.order.id,
-            data=models.OrderModifyRequestDTO(products=[{"id": state.order.products[0].id, "status": "used"}]),
-        )
+    try:
+        async with deps.locked_session_info_context(
+            redis_cli=redis_cli, session_id=state.id, used_as_dependency=False
+        ) as tmp_session:
+            tmp_session.state.order = order_data
+            if not is_paid or is_duplicated:
+                tmp_session.state.automated = False
+            if not is_duplicated:
+                tmp_session.state.unsynced_orders[order_data.id] = "pending"
+        if not is_duplicated:
+            await order_journal.order_journal.append(redis_cli, order_data.id, modification, session_id=state.id)
+    except Exception:
+        if is_paid and not is_duplicated:
+            await order_journal.order_journal.release(redis_cli, ticket_opr.id)
+        raise
 
     start_time = datetime.datetime.now()
-    ctx = state.printer.label.model_dump(mode="json") if state.printer else {"width": "960", "height": "410"}
-    images: list[bytes]
-    if state.print_priced_option_label:
-        images = await state.order.get_all_rendered_label_images(browser, ctx)
-    else:
-        images = [await state.order.get_rendered_nameplate_label_image(browser, ctx)]
-
-    for image_bytes in images:
-        with io.BytesIO(image_bytes) as image_io:
-            if printer := state.printer:
-                try:
-                    printer.print_image(image=PIL.Image.open(image_io))
-                except Exception as e:
-                    logger.error("Failed to print label:\n", traceback.format_exception(e))
+    profile = state.printer_profile
+    ctx = profile.label.model_dump(mode="json") if profile else {"width": "960", "height": "410"}
+    render_options = profile.render_options if profile else models.RenderOptions()
+    labels = order_data.get_labels(ctx, include_exchange_tickets=state.print_priced_option_label)
+    # Labels of an order are printed on the same printer, which is picked among the pool if the desk uses one.
+    async with printer_dispatcher.printer_dispatcher.dispatch(redis_cli, state) as job:
+        # Labels pre-rendered by the label-prerender command are printed as-is, unless the order is changed since then.
+        printed_stored_labels = 0
+        if job:
+            try:
+                printed_stored_labels = await label_store.label_store.print_labels(
+                    job.printer, str(order_data.id), labels
+                )
+            except label_store.StoredLabelPrintError as e:
+                job.failed = True
+                # 이미 출력된 라벨은 다시 출력하지 않고, 실패한 라벨부터 렌더링해서 출력합니다.
+                printed_stored_labels = e.printed
+                logger.error(f"Failed to print stored labels:\n{''.join(traceback.format_exception(e))}")
+        if printed_stored_labels < len(labels):
+            images: list[PIL.Image.Image]
+            if state.print_priced_option_label:
+                images = await order_data.get_all_rendered_label_images(browser, ctx, render_options)
+            else:
+                images = [await order_data.get_rendered_nameplate_label_image(browser, ctx, render_options)]
+
+            for image in images[printed_stored_labels:]:
+                if job:
+                    try:
+                        await job.printer.async_print_image(image=image, redis_cli=redis_cli)
+                    except Exception as e:
+                        job.failed = True
+                        logger.error("Failed to print label:\n", traceback.format_exception(e))
 
     end_time = datetime.datetime.now()
     took_time = end_time - start_time
-    await asyncio.sleep((WAITING_TIME - took_time).seconds)
+    with tracing.span("order.display_wait"):
+        await asyncio.sleep(max((WAITING_TIME - took_time).total_seconds(), 0))
 
     async with deps.locked_session_info_context(
         redis_cli=redis_cli, session_id=state.id, used_as_dependency=False
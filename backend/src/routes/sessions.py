@@ -1,10 +1,13 @@
 import datetime
+import http
+import typing
 
 import fastapi
 import fastapi.exceptions
 import pydantic
 import src.dependencies as deps
 import src.models as models
+import src.redis_client as redis_client
 import src.utils.hals as hals
 
 router = fastapi.APIRouter(prefix="/session")
@@ -34,6 +37,28 @@ async def get_my_session(session: deps.sessionInfoQuerierDI) -> models.SessionSt
     return session.state
 
 
+@router.get(path="/my/handled-orders")
+async def list_my_handled_orders(
+    session: deps.sessionInfoQuerierDI,
+    redis_cli: deps.redisDI,
+    offset: typing.Annotated[int, fastapi.Query(ge=0)] = 0,
+    limit: typing.Annotated[int, fastapi.Query(ge=1, le=100)] = 20,
+) -> list[models.OrderDTO]:
+    """처리한 주문 목록 조회 API (최신순)"""
+    # 최근 주문은 세션 정보에, 오래된 주문은 아카이브에 저장되어 있습니다.
+    live_orders = session.state.unarchived_orders[::-1]
+    result = live_orders[offset : offset + limit]  # noqa: E203
+    if len(result) < limit:
+        start = max(offset - len(live_orders), 0)
+        archived_orders = await redis_cli.lrange(
+            redis_client.RedisKey.HANDLED_ORDER_ARCHIVE.format(session_id=session.state.id),
+            start,
+            start + limit - len(result) - 1,
+        )
+        result += [models.OrderDTO.model_validate_json(order) for order in archived_orders]
+    return result
+
+
 @router.put(path="/my/desk")
 async def set_my_desk_status(
     session: deps.lockedSessionInfoDI, status: models.DeskStatus | None
@@ -68,13 +93,15 @@ class SetDeviceRequestPayload(pydantic.BaseModel):
 
 class SetPrinterRequestPayload(SetDeviceRequestPayload, pydantic.BaseModel):
     cmd_mode: models.PrinterCmdType = "ESCP"
-    label: models.Printer.Label
+    label: models.PrinterProfile.Label
+    render_profile: models.PrinterProfile.RenderProfile | None = None
 
     def as_model(self) -> models.Printer:
         return models.Printer(
             **hals.retrieve_usb_device(self.cdc_path),
             cmd_type=self.cmd_mode,
             label=self.label,
+            render_profile=self.render_profile,
         )
 
 
@@ -94,8 +121,9 @@ async def unregister_reader(session: deps.lockedSessionInfoDI) -> models.Session
 
 @router.put(path="/my/devices/printer")
 async def register_printer(session: deps.lockedSessionInfoDI, payload: SetPrinterRequestPayload) -> models.SessionState:
-    """프린터 정보 설정 API"""
+    """프린터 정보 설정 API (설정된 프린터 풀은 해제됩니다.)"""
     session.state.printer = payload.as_model()
+    session.state.printer_pool = None
     return session.state
 
 
@@ -104,3 +132,27 @@ async def unregister_printer(session: deps.lockedSessionInfoDI) -> models.Sessio
     """프린터 정보 해제 API"""
     session.state.printer = None
     return session.state
+
+
+class SetPrinterPoolRequestPayload(pydantic.BaseModel):
+    name: str
+
+
+@router.put(path="/my/devices/printer-pool")
+async def register_printer_pool(
+    session: deps.lockedSessionInfoDI, payload: SetPrinterPoolRequestPayload
+) -> models.SessionState:
+    """프린터 풀 설정 API (설정된 프린터는 해제됩니다.)"""
+    if payload.name not in session.state.app.printer_pools:
+        raise fastapi.HTTPException(status_code=http.HTTPStatus.NOT_FOUND, detail="프린터 풀이 없습니다.")
+
+    session.state.printer_pool = payload.name
+    session.state.printer = None
+    return session.state
+
+
+@router.delete(path="/my/devices/printer-pool")
+async def unregister_printer_pool(session: deps.lockedSessionInfoDI) -> models.SessionState:
+    """프린터 풀 해제 API"""
+    session.state.printer_pool = None
+    return session.state
@@ -0,0 +1,17 @@
+import typing
+
+import fastapi
+import src.dependencies as deps
+import src.tracing as tracing
+
+router = fastapi.APIRouter(prefix="/traces")
+
+
+@router.get(path="/slow")
+async def list_slow_traces(
+    redis_cli: deps.redisDI,
+    min_duration_ms: typing.Annotated[float, fastapi.Query(ge=0)] = 1000,
+    limit: typing.Annotated[int, fastapi.Query(ge=1, le=100)] = 20,
+) -> list[tracing.Trace]:
+    """최근의 느린 트레이스를 느린 순으로 조회하는 API"""
+    return await tracing.recorder.query_slow_traces(redis_cli, min_duration_ms=min_duration_ms, limit=limit)
@@ -1,10 +1,12 @@
 import asyncio
 import contextlib
 import datetime
+import time
 import uuid
 
 import fastapi
 import src.dependencies as deps
+import src.metrics as metrics
 import src.models as models
 import src.redis_client as redis_client
 
@@ -19,6 +21,14 @@ async def is_websocket_connected(websocket: fastapi.WebSocket) -> bool:
     return False
 
 
+def is_up_to_date(session_info: models.SessionInfo | None, commit_id: uuid.UUID | None) -> bool:
+    return bool(
+        session_info
+        and session_info.ping_at + models.SESSION_REFRESH_REQUIRED_DELTA > datetime.datetime.now()
+        and commit_id == session_info.state.commit_id
+    )
+
+
 @router.websocket(path="/ws")
 async def ws_subscriber(websocket: fastapi.WebSocket, redis_cli: deps.redisDI, session_id: deps.sessionIDDI) -> None:
     if not session_id:
@@ -36,26 +46,31 @@ async def ws_subscriber(websocket: fastapi.WebSocket, redis_cli: deps.redisDI, s
             # 2. 마지막으로 메시지를 보낸지 30초가 지났을 때
             # 3. 마지막으로 보낸 메시지의 commit_id와 쿼리한 commit_id가 다를 때
             should_broadcast = True if await pubsub.get_message(ignore_subscribe_messages=True, timeout=1) else False
+            received_at = time.perf_counter()
+            # 보낼 것이 없다면 스냅샷만 확인하고, 세션 정보를 잠그지 않습니다.
+            if not should_broadcast and is_up_to_date(
+                (await deps.app_state_snapshot_cache.get(redis_cli)).sessions.get(session_id), commit_id
+            ):
+                continue
+
             async with deps.locked_session_info_context(
                 redis_cli=redis_cli,
                 session_id=session_id,
                 used_as_dependency=False,
                 broadcast=False,  # 여기서 broadcast를 하게되면 항상 PubSub 메시지가 있게 되므로, 여기서는 broadcast를 하지 않습니다.
             ) as session_info:
-                if (
-                    not should_broadcast
-                    and session_info.ping_at + models.SESSION_REFRESH_REQUIRED_DELTA > datetime.datetime.now()
-                    and commit_id == session_info.state.commit_id
-                ):
+                if not should_broadcast and is_up_to_date(session_info, commit_id):
                     continue
 
                 # commit_id는 실제로 정보를 수정하는 곳에서만 변경해야 하므로, 여기서는 commit_id를 변경하지 않습니다.
                 session_info.ping_at = datetime.datetime.now()
                 commit_id = session_info.state.commit_id
                 await websocket.send_json(session_info.state.model_dump(mode="json"))
+                if should_broadcast:
+                    metrics.WEBSOCKET_FANOUT_LAG_SECONDS.observe(time.perf_counter() - received_at)
 
     # Unsubscribe from PubSub Channel
     await pubsub.unsubscribe(redis_client.RedisKey.PUBSUB_CHANNEL)
 
-    with contextlib.suppress(RuntimeError):
+    with contextlib.suppress(RuntimeError, fastapi.WebSocketDisconnect):
         await websocket.close()
@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import time
+import typing
+import weakref
+
+import httpx
+import pydantic
+import src.metrics as metrics
+
+# Deadline of each operation, including the wait for the concurrency limit and the hedged request.
+SHOP_API_TIMEOUTS: dict[str, float] = {
+    "search": float(os.getenv("SHOP_API_SEARCH_TIMEOUT", "5")),
+    "retrieve": float(os.getenv("SHOP_API_RETRIEVE_TIMEOUT", "3")),
+    "modify": float(os.getenv("SHOP_API_MODIFY_TIMEOUT", "5")),
+    "refund": float(os.getenv("SHOP_API_REFUND_TIMEOUT", "10")),
+}
+# Idempotent operations, which are sent once more if the first request is slower than usual.
+SHOP_API_HEDGED_OPERATIONS = frozenset(("search", "retrieve"))
+SHOP_API_HEDGE_PERCENTILE = 0.95
+SHOP_API_HEDGE_MIN_DELAY = 0.05  # seconds
+SHOP_API_HEDGE_INITIAL_DELAY = 0.5  # seconds, until enough latencies are observed
+SHOP_API_LATENCY_WINDOW = 100  # latest latencies per operation to derive the hedge delay from
+# Concurrency limit of the requests in flight per worker, adjusted by AIMD between the min and max.
+SHOP_API_CONCURRENCY_INITIAL = int(os.getenv("SHOP_API_CONCURRENCY_INITIAL", "8"))
+SHOP_API_CONCURRENCY_MIN = 1
+SHOP_API_CONCURRENCY_MAX = int(os.getenv("SHOP_API_CONCURRENCY_MAX", "64"))
+SHOP_API_CONCURRENCY_BACKOFF = 0.5
+# Consecutive failures to open the breaker, and seconds to fail fast before letting a probe request through.
+SHOP_API_BREAKER_FAILURE_THRESHOLD = int(os.getenv("SHOP_API_BREAKER_FAILURE_THRESHOLD", "5"))
+SHOP_API_BREAKER_OPEN_DURATION = float(os.getenv("SHOP_API_BREAKER_OPEN_DURATION", "10"))
+# Orders & search results kept per shop, which are served while the shop is unavailable.
+SHOP_API_FALLBACK_CACHE_SIZE = int(os.getenv("SHOP_API_FALLBACK_CACHE_SIZE", "4096"))
+OVERLOAD_STATUS_CODES = {429, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+CircuitBreakerState = typing.Literal["closed", "open", "half_open"]
+T = typing.TypeVar("T")
+
+
+class ShopAPIUnavailableError(httpx.TransportError):
+    """
+    Raised without sending the request when the circuit breaker is open, or when the operation timed out.
+    It's a transport error, so that it's handled like the shop being unreachable (e.g. retried by the order journal).
+    """
+
+
+def is_unavailable(error: Exception) -> bool:
+    """Whether the error means that the shop is down or overloaded, rather than the request is wrong."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code in OVERLOAD_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+class CircuitBreakerStatus(pydantic.BaseModel):
+    state: CircuitBreakerState
+    consecutive_failures: int
+    retry_at: float | None  # Timestamp when the probe request is let through, while the breaker is open
+    concurrency_limit: int
+    in_flight: int
+
+
+class CircuitBreaker:
+    """
+    Fails fast after the consecutive failures, instead of letting every request wait for the timeout.
+    After the open duration, a single probe request is let through (half-open), which closes the breaker on success.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = SHOP_API_BREAKER_FAILURE_THRESHOLD,
+        open_duration: float = SHOP_API_BREAKER_OPEN_DURATION,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+        self.state: CircuitBreakerState = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.time() >= self.opened_at + self.open_duration:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return self.state == "closed"
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("Shop API circuit breaker is closed")
+        self.state, self.consecutive_failures, self.probing = "closed", 0, False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Shop API circuit breaker is opened after {self.consecutive_failures} failures")
+            self.state, self.opened_at = "open", time.time()
+
+
+class AIMDLimiter:
+    """
+    Adaptive limit of the requests in flight: increased by 1 for every limit of successful requests (additive),
+    and halved on the overload signals (multiplicative), at most once per the latest latency.
+    Requests over the limit wait for a slot, rather than piling up on the overloaded shop.
+    """
+
+    def __init__(
+        self,
+        initial: int = SHOP_API_CONCURRENCY_INITIAL,
+        min_limit: int = SHOP_API_CONCURRENCY_MIN,
+        max_limit: int = SHOP_API_CONCURRENCY_MAX,
+    ) -> None:
+        self.limit = float(initial)
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.latency = 0.0
+        self.condition = asyncio.Condition()
+
+    @property
+    def available(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> typing.AsyncIterator[None]:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.available)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+    def record_success(self, latency: float) -> None:
+        self.latency = latency
+        # Limit is only raised while it's used, so that it doesn't grow unbounded on the quiet hours.
+        if self.in_flight * 2 >= self.limit:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def record_overload(self) -> None:
+        # Requests sent before the previous decrease are failing with it, so they don't decrease the limit again.
+        if (now := time.monotonic()) - self.decreased_at < max(self.latency, SHOP_API_HEDGE_MIN_DELAY):
+            return
+        self.decreased_at = now
+        self.limit = max(self.limit * SHOP_API_CONCURRENCY_BACKOFF, self.min_limit)
+
+
+class FallbackCache(typing.Generic[T]):
+    """Latest responses of the shop, served while the shop is unavailable, evicting the least recently used."""
+
+    def __init__(self, size: int = SHOP_API_FALLBACK_CACHE_SIZE) -> None:
+        self.size = size
+        self.items: collections.OrderedDict[str, T] = collections.OrderedDict()
+
+    def get(self, key: str) -> T | None:
+        if (item := self.items.get(key)) is not None:
+            self.items.move_to_end(key)
+        return item
+
+    def put(self, key: str, item: T) -> None:
+        self.items[key] = item
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class ShopAPIGuard:
+    """
+    Resilience layer of the requests to a shop: per-operation timeouts, the adaptive concurrency limit,
+    hedged requests for the idempotent operations, and the circuit breaker.
+
+    Usage:
+        guard = shop_api_guards.get(domain)
+        response = await guard.call("retrieve", lambda: client.request(...))
+        guard.orders.put(order_id, order)  # served by the callers when the shop is unavailable
+    """
+
+    def __init__(self, domain: str) -> None:
+        self.domain = domain
+        self.breaker = CircuitBreaker()
+        self.limiter = AIMDLimiter()
+        self.latencies: dict[str, collections.deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=SHOP_API_LATENCY_WINDOW)
+        )
+        self.orders: FallbackCache[typing.Any] = FallbackCache()
+        self.searches: FallbackCache[typing.Any] = FallbackCache()
+
+    @property
+    def status(self) -> CircuitBreakerStatus:
+        return CircuitBreakerStatus(
+            state=self.breaker.state,
+            consecutive_failures=self.breaker.consecutive_failures,
+            retry_at=self.breaker.opened_at + self.breaker.open_duration if self.breaker.state == "open" else None,
+            concurrency_limit=int(self.limiter.limit),
+            in_flight=self.limiter.in_flight,
+        )
+
+    def hedge_delay(self, operation: str) -> float:
+        if len(latencies := self.latencies[operation]) < SHOP_API_LATENCY_WINDOW // 10:
+            return SHOP_API_HEDGE_INITIAL_DELAY
+        return max(sorted(latencies)[int(len(latencies) * SHOP_API_HEDGE_PERCENTILE)], SHOP_API_HEDGE_MIN_DELAY)
+
+    async def call(self, operation: str, send: typing.Callable[[], typing.Awaitable[httpx.Response]]) -> httpx.Response:
+        if not self.breaker.allow():
+            metrics.SHOP_API_SHORT_CIRCUITS_TOTAL.inc(operation=operation, reason="breaker_open")
+            raise ShopAPIUnavailableError(f"Shop API {self.domain} is unavailable, circuit breaker is open")
+
+        try:
+            async with asyncio.timeout(SHOP_API_TIMEOUTS[operation]):
+                if operation in SHOP_API_HEDGED_OPERATIONS:
+                    response = await self.send_hedged(operation, send)
+                else:
+                    response = await self.send(operation, send)
+        except TimeoutError as e:
+            self.record_failure()
+            metrics.SHOP_API_SHORT_CIRCUITS_TOTAL.inc(operation=operation, reason="timeout")
+            raise ShopAPIUnavailableError(f"Shop API {self.domain} didn't respond to {operation} in time") from e
+        except httpx.TransportError:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Cancelled by the caller, which doesn't tell anything about the shop.
+            self.breaker.probing = False
+            raise
+
+        if response.status_code >= 500 or response.status_code in OVERLOAD_STATUS_CODES:
+            self.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def record_failure(self) -> None:
+        self.breaker.record_failure()
+        self.limiter.record_overload()
+
+    async def send(self, operation: str, send: typing.Callable[[], typing.Awaitable[httpx.Response]]) -> httpx.Response:
+        async with self.limiter.slot():
+            started_at = time.perf_counter()
+            response = await send()
+            if response.status_code < 500 and response.status_code not in OVERLOAD_STATUS_CODES:
+                latency = time.perf_counter() - started_at
+                self.latencies[operation].append(latency)
+                self.limiter.record_success(latency)
+        return response
+
+    async def send_hedged(
+        self, operation: str, send: typing.Callable[[], typing.Awaitable[httpx.Response]]
+    ) -> httpx.Response:
+        """Sends the request again if it's slower than the usual latency, and returns whichever succeeds first."""
+        first = asyncio.ensure_future(self.send(operation, send))
+        attempts = {first}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay(operation))
+            # Hedging only takes the spare capacity, as it would add more load to the overloaded shop otherwise.
+            if done or not self.limiter.available:
+                return await first
+
+            metrics.SHOP_API_HEDGES_TOTAL.inc(operation=operation)
+            attempts.add(asyncio.ensure_future(self.send(operation, send)))
+            while attempts:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None and attempt.result().status_code < 500:
+                        return attempt.result()
+                if not attempts:
+                    # Both failed, so the result of either of them tells why.
+                    return done.pop().result()
+            raise RuntimeError("unreachable")  # pragma: no cover
+        finally:
+            # Also on the timeout of the operation, which cancels this while waiting for the attempts.
+            for attempt in attempts:
+                attempt.cancel()
+
+
+class ShopAPIGuardRegistry:
+    """
+    Guards per shop domain, on each event loop as the limiter is bound to the loop it's used on.
+    Guards of a loop are dropped with the loop, e.g. the loops of the tests and the CLI commands.
+    """
+
+    def __init__(self) -> None:
+        self.guards: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, ShopAPIGuard]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get(self, domain: str) -> ShopAPIGuard:
+        if (guards := self.guards.get(loop := asyncio.get_running_loop())) is None:
+            # Limiters which were waited on refer to their loops, so the closed loops are not always collected.
+            for closed_loop in [other for other in self.guards if other.is_closed()]:
+                del self.guards[closed_loop]
+            guards = self.guards[loop] = {}
+        if not (guard := guards.get(domain)):
+            guard = guards[domain] = ShopAPIGuard(domain)
+        return guard
+
+
+shop_api_guards = ShopAPIGuardRegistry()
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import pathlib
+import tempfile
+import typing
+
+import fastapi.staticfiles
+import pydantic
+import starlette.datastructures
+import starlette.responses
+import starlette.types
+
+STATIC_DIR = pathlib.Path(os.getenv("STATIC_DIR", "src/static"))
+# Precompressed copies are named by the digest of the source, so they're shared by the workers and kept across restarts.
+STATIC_BUILD_DIR = pathlib.Path(os.getenv("STATIC_BUILD_DIR", "static_build"))
+# Templates are rendered by the browser of the API server, so they load the static files from the server itself.
+STATIC_BASE_URL = os.getenv("STATIC_BASE_URL", "http://localhost:28000/static")
+STATIC_COMPRESS_MIN_SIZE = 1024  # bytes
+# Formats which are already compressed
+STATIC_INCOMPRESSIBLE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".woff", ".woff2", ".gz", ".br"}
+
+# Fingerprinted URLs change along with the content, so they're cached as long as possible without revalidation.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Plain URLs are revalidated on every use, which costs a 304 response only.
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+logger = logging.getLogger(__name__)
+
+Encoder = typing.Callable[[bytes], bytes]
+
+
+def get_encoders() -> dict[str, Encoder]:
+    """Returns the content-codings to precompress, in the order of preference."""
+    encoders: dict[str, Encoder] = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    with contextlib.suppress(ImportError):
+        import brotli  # optional, installed along with aiohttp[speedups]
+
+        encoders = {"br": lambda data: brotli.compress(data, quality=11), **encoders}
+    return encoders
+
+
+def negotiate_encoding(accept_encoding: str, available: typing.Iterable[str]) -> str | None:
+    """Returns the content-coding of the highest quality accepted by the client, or None for the identity."""
+    qualities: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        if (param := params.strip()).startswith("q="):
+            with contextlib.suppress(ValueError):
+                quality = float(param[2:])
+        qualities[coding.strip().lower()] = quality
+
+    # Ties are broken by the order of the available codings, which is the server's preference.
+    best = max(available, key=lambda coding: qualities.get(coding, qualities.get("*", 0)), default=None)
+    return best if best and qualities.get(best, qualities.get("*", 0)) > 0 else None
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so the W/ prefix is ignored.
+    if not if_none_match:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
+
+
+class StaticAsset(pydantic.BaseModel):
+    name: str  # POSIX path relative to the static directory
+    path: pathlib.Path
+    digest: str
+    mtime_ns: int
+    size: int
+    media_type: str
+    encodings: dict[str, pathlib.Path] = pydantic.Field(default_factory=dict)  # content-coding -> precompressed file
+
+    model_config = pydantic.ConfigDict(frozen=True)
+
+    @classmethod
+    def from_path(cls, name: str, path: pathlib.Path, build_directory: pathlib.Path) -> StaticAsset:
+        stat_result = path.stat()
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        return cls(
+            name=name,
+            path=path,
+            digest=digest,
+            mtime_ns=stat_result.st_mtime_ns,
+            size=stat_result.st_size,
+            media_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            encodings={
+                coding: encoded_path
+                for coding in get_encoders()
+                # Empty copies mark the files which are not smaller when compressed.
+                if (encoded_path := build_directory / f"{digest}.{coding}").exists() and encoded_path.stat().st_size
+            },
+        )
+
+    @property
+    def compressible(self) -> bool:
+        return self.size >= STATIC_COMPRESS_MIN_SIZE and self.path.suffix.lower() not in STATIC_INCOMPRESSIBLE_SUFFIXES
+
+    @property
+    def fingerprinted_name(self) -> str:
+        # Digest goes before the suffix, so the type is still guessed from the name, e.g. react.development.1a2b3c.js
+        path = pathlib.PurePosixPath(self.name)
+        return str(path.with_name(f"{path.stem}.{self.digest[:12]}{path.suffix}"))
+
+    def etag(self, coding: str | None) -> str:
+        # Each encoding is a different representation, so it gets its own strong ETag.
+        return f'"{self.digest[:32]}-{coding}"' if coding else f'"{self.digest[:32]}"'
+
+    def is_modified(self) -> bool:
+        try:
+            stat_result = self.path.stat()
+        except FileNotFoundError:
+            return True
+        return (stat_result.st_mtime_ns, stat_result.st_size) != (self.mtime_ns, self.size)
+
+    def response(
+        self, request_headers: starlette.datastructures.Headers, cache_control: str
+    ) -> starlette.responses.Response:
+        coding = negotiate_encoding(request_headers.get("accept-encoding", ""), self.encodings)
+        headers = {"ETag": self.etag(coding), "Cache-Control": cache_control}
+        if self.encodings:
+            headers["Vary"] = "Accept-Encoding"
+        if etag_matches(request_headers.get("if-none-match"), headers["ETag"]):
+            return starlette.responses.Response(status_code=304, headers=headers)
+
+        if coding:
+            headers["Content-Encoding"] = coding
+        return starlette.responses.FileResponse(
+            self.encodings[coding] if coding else self.path, media_type=self.media_type, headers=headers
+        )
+
+
+class StaticAssetManifest(pydantic.BaseModel):
+    """
+    Digests & precompressed copies of the static files, to serve them with the fingerprinted URLs.
+
+    Usage:
+        static_assets.build()  # on startup, or at the build time by the static-build command
+        static_assets.url("react.development.js")  # http://localhost:28000/static/react.development.1a2b3c4d5e6f.js
+        static_assets.resolve("react.development.1a2b3c4d5e6f.js")  # (StaticAsset, True)
+    """
+
+    directory: pathlib.Path = STATIC_DIR
+    build_directory: pathlib.Path = STATIC_BUILD_DIR
+    assets: dict[str, StaticAsset] = pydantic.Field(default_factory=dict)
+    fingerprints: dict[str, str] = pydantic.Field(default_factory=dict)  # fingerprinted name -> name
+
+    def load(self) -> None:
+        assets = [
+            StaticAsset.from_path(path.relative_to(self.directory).as_posix(), path, self.build_directory)
+            for path in sorted(self.directory.rglob("*"))
+            if path.is_file() and not path.name.startswith(".")
+        ]
+        self.assets = {asset.name: asset for asset in assets}
+        self.fingerprints = {asset.fingerprinted_name: asset.name for asset in assets}
+
+    def build(self) -> None:
+        """Loads the static files, and compresses the ones which are not compressed yet."""
+        self.build_directory.mkdir(parents=True, exist_ok=True)
+        # Workers start at once, so only one of them compresses the files and the others use its results.
+        with open(self.build_directory / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.load()
+            for asset in self.assets.values():
+                if asset.compressible:
+                    self.compress(asset)
+        self.load()
+        logger.info(f"Loaded {len(self.assets)} static files, encodings: {', '.join(get_encoders())}")
+
+    def compress(self, asset: StaticAsset) -> None:
+        data: bytes | None = None
+        for coding, encoder in get_encoders().items():
+            if (path := self.build_directory / f"{asset.digest}.{coding}").exists():
+                continue
+
+            if data is None:
+                data = asset.path.read_bytes()
+            # Identity is served instead if compressing doesn't help, so an empty file marks it as compressed.
+            encoded = encoder(data)
+            with tempfile.NamedTemporaryFile(dir=self.build_directory, delete=False) as file:
+                file.write(encoded if len(encoded) < len(data) else b"")
+            os.replace(file.name, path)
+
+    def get(self, name: str) -> StaticAsset | None:
+        if not self.assets:
+            # Templates can be rendered before the startup loading (e.g. in CLI tools)
+            self.load()
+        if (asset := self.assets.get(name)) and not asset.is_modified():
+            return asset
+
+        # New & changed files are served right away, but without the precompressed copies until the next build.
+        path = self.directory / name
+        if not (path.is_file() and path.resolve().is_relative_to(self.directory.resolve())):
+            self.assets.pop(name, None)
+            return None
+        asset = self.assets[name] = StaticAsset.from_path(name, path, self.build_directory)
+        self.fingerprints[asset.fingerprinted_name] = name
+        return asset
+
+    def resolve(self, path: str) -> tuple[StaticAsset, bool] | None:
+        """Returns the asset of the requested path, and whether the path is fingerprinted."""
+        if name := self.fingerprints.get(path):
+            # Outdated fingerprints are not served, as they would be cached forever with the new content.
+            if (asset := self.get(name)) and asset.fingerprinted_name == path:
+                return asset, True
+            return None
+        return (asset, False) if (asset := self.get(path)) else None
+
+    def url(self, name: str, with_suffix: bool = True) -> str:
+        """Fingerprinted URL of the static file. Suffix can be dropped for the require.js paths, which append .js."""
+        url = f"{STATIC_BASE_URL}/{asset.fingerprinted_name if (asset := self.get(name)) else name}"
+        return url if with_suffix else url.removesuffix(pathlib.PurePosixPath(name).suffix)
+
+
+class PrecompressedStaticFiles(fastapi.staticfiles.StaticFiles):
+    """
+    Static files served with the precompressed copies negotiated by Accept-Encoding,
+    the strong ETags for the conditional requests, and the immutable caching for the fingerprinted URLs.
+    Files not in the manifest (e.g. added after the startup) are served by StaticFiles as before.
+    """
+
+    def __init__(self, manifest: StaticAssetManifest) -> None:
+        super().__init__(directory=manifest.directory)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope: starlette.types.Scope) -> starlette.responses.Response:
+        if scope["method"] not in ("GET", "HEAD") or not (resolved := self.manifest.resolve(path)):
+            return await super().get_response(path, scope)
+
+        asset, fingerprinted = resolved
+        cache_control = IMMUTABLE_CACHE_CONTROL if fingerprinted else REVALIDATE_CACHE_CONTROL
+        return asset.response(starlette.datastructures.Headers(scope=scope), cache_control)
+
+
+static_assets = StaticAssetManifest()
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import logging
+import os
+import re
+import secrets
+import time
+import typing
+
+import httpx
+import pydantic
+import redis
+import src.redis_client as redis_client
+
+if typing.TYPE_CHECKING:
+    import starlette.types
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "rosa")
+# Spans are exported as OTLP/JSON to this endpoint (e.g. http://localhost:4318/v1/traces) only if it's set.
+OTLP_TRACES_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+OTLP_EXPORT_TIMEOUT = 1  # seconds
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))  # seconds
+# Number of the spans kept on the process memory until they are flushed.
+TRACE_RING_BUFFER_SIZE = int(os.getenv("TRACE_RING_BUFFER_SIZE", "10000"))
+# Traces are kept on Redis for this long after they started.
+TRACE_RETENTION = datetime.timedelta(seconds=float(os.getenv("TRACE_RETENTION", "3600")))
+
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT_REGEX = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class SpanContext(pydantic.BaseModel):
+    trace_id: str
+    span_id: str
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def from_traceparent(cls, traceparent: str | None) -> SpanContext | None:
+        if traceparent and (match := TRACEPARENT_REGEX.match(traceparent.strip().lower())):
+            return cls(trace_id=match[1], span_id=match[2])
+        return None
+
+
+class Span(SpanContext, pydantic.BaseModel):
+    parent_id: str | None = None
+    name: str
+    service: str = SERVICE_NAME
+    start_ns: int = pydantic.Field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    attributes: dict[str, str | int | float | bool] = pydantic.Field(default_factory=dict)
+    error: str | None = None
+
+    def to_otlp(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+class Trace(pydantic.BaseModel):
+    trace_id: str
+    started_at: int  # ns
+    duration_ms: float
+    spans: list[Span]
+
+
+current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanRecorder:
+    """
+    Finished spans are kept on the process memory, and flushed to a list per trace on Redis,
+    so that the spans recorded by the scanner processes and the uvicorn workers can be viewed together.
+    Traces are indexed by the duration of their root spans, so that the slow ones are queried without reading the rest.
+    If OTEL_EXPORTER_OTLP_TRACES_ENDPOINT is set, the flushed spans are also exported to the collector.
+    """
+
+    def __init__(self) -> None:
+        self.spans: collections.deque[Span] = collections.deque(maxlen=TRACE_RING_BUFFER_SIZE)
+        self.autoflush_redis_cli: redis_client.RedisSession | None = None
+        # Exports of the synchronous flushes, which are run on a thread so that the scanner doesn't wait for them.
+        self._exporter: concurrent.futures.ThreadPoolExecutor | None = None
+
+    def record(self, span: Span) -> None:
+        self.spans.append(span)
+        if self.autoflush_redis_cli and current_span.get() is None:
+            self.flush(self.autoflush_redis_cli)
+
+    def autoflush_to(self, redis_cli: redis_client.RedisSession) -> None:
+        """Flushes spans synchronously whenever a trace ends on this process, for the CLI processes."""
+        self.autoflush_redis_cli = redis_cli
+
+    def _pop_all(self) -> list[Span]:
+        spans: list[Span] = []
+        with contextlib.suppress(IndexError):
+            while True:
+                spans.append(self.spans.popleft())
+        return spans
+
+    def _queue_flush(self, pipeline: redis_client.RedisCommands, spans: list[Span]) -> None:
+        """Queues the commands to store the spans, followed by the query of the trace ids expired by the retention."""
+        spans_by_trace: dict[str, list[Span]] = collections.defaultdict(list)
+        for span in spans:
+            spans_by_trace[span.trace_id].append(span)
+        for trace_id, trace_spans in spans_by_trace.items():
+            key = redis_client.RedisKey.TRACE_SPANS.format(trace_id=trace_id)
+            pipeline.lpush(key, *(span.model_dump_json() for span in trace_spans))
+            pipeline.expire(key, TRACE_RETENTION)
+
+        if roots := [span for span in spans if span.parent_id is None and span.end_ns]:
+            durations: redis_client.SortedSetScores = {
+                span.trace_id: (span.end_ns - span.start_ns) / 1_000_000 for span in roots
+            }
+            started_at: redis_client.SortedSetScores = {span.trace_id: span.start_ns / 1e9 for span in roots}
+            pipeline.zadd(redis_client.RedisKey.TRACE_DURATIONS, durations)
+            pipeline.zadd(redis_client.RedisKey.TRACE_STARTED_AT, started_at)
+        expired_at = time.time() - TRACE_RETENTION.total_seconds()
+        pipeline.zrangebyscore(redis_client.RedisKey.TRACE_STARTED_AT, "-inf", expired_at)
+
+    def _queue_prune(self, pipeline: redis_client.RedisCommands, trace_ids: list[bytes]) -> None:
+        pipeline.zrem(redis_client.RedisKey.TRACE_DURATIONS, *trace_ids)
+        pipeline.zrem(redis_client.RedisKey.TRACE_STARTED_AT, *trace_ids)
+
+    def _otlp_payload(self, spans: list[Span]) -> dict:
+        by_service: dict[str, list[dict]] = collections.defaultdict(list)
+        for span in spans:
+            by_service[span.service].append(span.to_otlp())
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": otlp_spans}],
+                }
+                for service, otlp_spans in by_service.items()
+            ]
+        }
+
+    def _export(self, spans: list[Span]) -> None:
+        try:
+            httpx.post(OTLP_TRACES_ENDPOINT, json=self._otlp_payload(spans), timeout=OTLP_EXPORT_TIMEOUT)
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to export spans: {e}")
+
+    def flush(self, redis_cli: redis_client.RedisSession) -> None:
+        if not (spans := self._pop_all()):
+            return
+        try:
+            with redis_cli.pipeline(transaction=False) as pipeline:
+                self._queue_flush(pipeline, spans)
+                *_, expired_trace_ids = pipeline.execute()
+            if expired_trace_ids:
+                with redis_cli.pipeline(transaction=False) as pipeline:
+                    self._queue_prune(pipeline, expired_trace_ids)
+                    pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to flush spans: {e}")
+
+        if OTLP_TRACES_ENDPOINT:
+            if not self._exporter:
+                self._exporter = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="otlp_export")
+            self._exporter.submit(self._export, spans)
+
+    async def async_flush(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        if not (spans := self._pop_all()):
+            return
+        try:
+            async with redis_cli.pipeline(transaction=False) as pipeline:
+                self._queue_flush(pipeline, spans)
+                *_, expired_trace_ids = await pipeline.execute()
+            if expired_trace_ids:
+                async with redis_cli.pipeline(transaction=False) as pipeline:
+                    self._queue_prune(pipeline, expired_trace_ids)
+                    await pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to flush spans: {e}")
+
+        if OTLP_TRACES_ENDPOINT:
+            try:
+                async with httpx.AsyncClient(timeout=OTLP_EXPORT_TIMEOUT) as client:
+                    await client.post(OTLP_TRACES_ENDPOINT, json=self._otlp_payload(spans))
+            except httpx.HTTPError as e:
+                logger.warning(f"Failed to export spans: {e}")
+
+    async def flush_periodically(self, redis_cli: redis_client.AsyncRedisSession) -> None:
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+            await self.async_flush(redis_cli)
+
+    async def query_slow_traces(
+        self, redis_cli: redis_client.AsyncRedisSession, min_duration_ms: float, limit: int
+    ) -> list[Trace]:
+        """Returns the slowest traces first, which took min_duration_ms or longer."""
+        await self.async_flush(redis_cli)
+
+        trace_ids = [
+            trace_id.decode()
+            for trace_id in await redis_cli.zrevrangebyscore(
+                redis_client.RedisKey.TRACE_DURATIONS, "+inf", min_duration_ms, start=0, num=limit
+            )
+        ]
+        async with redis_cli.pipeline(transaction=False) as pipeline:
+            for trace_id in trace_ids:
+                pipeline.lrange(redis_client.RedisKey.TRACE_SPANS.format(trace_id=trace_id), 0, -1)
+            results = await pipeline.execute()
+
+        traces: list[Trace] = []
+        for trace_id, data in zip(trace_ids, results):
+            if not (spans := sorted((Span.model_validate_json(d) for d in data), key=lambda s: s.start_ns)):
+                continue  # Expired, but not pruned from the index yet
+            started_at = spans[0].start_ns
+            duration_ms = (max(s.end_ns or s.start_ns for s in spans) - started_at) / 1_000_000
+            traces.append(Trace(trace_id=trace_id, started_at=started_at, duration_ms=duration_ms, spans=spans))
+        return traces
+
+
+recorder = SpanRecorder()
+
+
+@contextlib.contextmanager
+def _start_span(name: str, parent: SpanContext | None, start_ns: int | None, attributes: dict) -> typing.Iterator[Span]:
+    span = Span(
+        trace_id=parent.trace_id if parent else secrets.token_hex(16),
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        start_ns=start_ns or time.time_ns(),
+        attributes=attributes,
+    )
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = repr(e)
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        current_span.reset(token)
+        recorder.record(span)
+
+
+@contextlib.contextmanager
+def trace(
+    name: str, parent: SpanContext | None = None, start_ns: int | None = None, **attributes: str | int | float | bool
+) -> typing.Iterator[Span]:
+    """Starts a span as a child of the given remote parent or the current span, or as a root of a new trace."""
+    with _start_span(name, parent or current_span.get(), start_ns, attributes) as span:
+        yield span
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: str | int | float | bool) -> typing.Iterator[Span | None]:
+    """Starts a child span of the current span. Nothing is recorded if there's no trace in progress."""
+    if (parent := current_span.get()) is None:
+        yield None
+        return
+    with _start_span(name, parent, None, attributes) as child:
+        yield child
+
+
+def record_span(name: str, start_ns: int, end_ns: int, **attributes: str | int | float | bool) -> None:
+    """Records an already finished span as a child of the current span."""
+    if (parent := current_span.get()) is None:
+        return
+    recorder.record(
+        Span(
+            trace_id=parent.trace_id,
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id,
+            name=name,
+            start_ns=start_ns,
+            end_ns=end_ns,
+            attributes=attributes,
+        )
+    )
+
+
+def annotate(**attributes: str | int | float | bool) -> None:
+    if span := current_span.get():
+        span.attributes.update(attributes)
+
+
+def inject_headers() -> dict[str, str]:
+    return {TRACEPARENT_HEADER: context.traceparent} if (context := current_span.get()) else {}
+
+
+class TraceContextMiddleware:
+    """Continues the trace of the requests that have traceparent header, e.g. the ones from the scanner manager."""
+
+    def __init__(self, app: starlette.types.ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(
+        self, scope: starlette.types.Scope, receive: starlette.types.Receive, send: starlette.types.Send
+    ) -> None:
+        if scope["type"] != "http" or not (
+            parent := SpanContext.from_traceparent(dict(scope["headers"]).get(b"traceparent", b"").decode())
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        with trace(f"{scope['method']} {scope['path']}", parent=parent) as server_span:
+
+            async def send_with_status(message: starlette.types.Message) -> None:
+                if message["type"] == "http.response.start":
+                    server_span.attributes["http.status_code"] = message["status"]
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
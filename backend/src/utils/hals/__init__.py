@@ -1,13 +1,18 @@
 from __future__ import annotations
 
 import collections as cl
+import os
 import platform
 import re
 import subprocess as sp  # nosec B404
+import threading
+import time
 import typing
 
 DEV_BLK_INFO_EXTRACTOR = re.compile(r"\/dev\/bus\/usb\/(?P<bus>\d)+\/(?P<device>\d)+")
 LSUSB_INFO_EXTRACTOR = re.compile(r"Bus (?P<bus>\d)+ Device (?P<device>\d)+: ID (?P<usb_id>[0-9a-fA-F:]+) (?P<name>.*)")
+# Seconds to reuse the listed devices, as listing runs udevadm for every device node.
+DEVICE_INVENTORY_TTL = float(os.getenv("DEVICE_INVENTORY_TTL", "5"))
 EXCLUDE_MAGIC_KEYWORD = (
     "virtual",
     "video",
@@ -117,9 +122,42 @@ def list_usb_devices() -> list[Device]:
     return dev_list
 
 
+class DeviceInventory:
+    """
+    Cached result of list_usb_devices.
+
+    Usage:
+        device_inventory.refresh()  # on startup, or when the devices are changed
+        device_inventory.list()  # listed again only if the cache is older than the TTL
+    """
+
+    def __init__(self, ttl: float = DEVICE_INVENTORY_TTL) -> None:
+        self.ttl = ttl
+        self.devices: list[Device] = []
+        self.listed_at: float | None = None
+        self.lock = threading.Lock()
+
+    def refresh(self) -> list[Device]:
+        with self.lock:
+            self.devices, self.listed_at = list_usb_devices(), time.monotonic()
+            return self.devices
+
+    def list(self) -> list[Device]:
+        if self.listed_at is None or time.monotonic() - self.listed_at > self.ttl:
+            return self.refresh()
+        return self.devices
+
+
+device_inventory = DeviceInventory()
+
+
 def retrieve_usb_device(cdc_path: str) -> Device | None:
-    return next((dev for dev in list_usb_devices() if dev["cdc_path"] == cdc_path), None)
+    # A device plugged in after the last listing is not on the cache yet, so the inventory is refreshed once.
+    for devices in (device_inventory.list, device_inventory.refresh):
+        if device := next((dev for dev in devices() if dev["cdc_path"] == cdc_path), None):
+            return device
+    return None
 
 
 def retrieve_usb_devices(cdc_paths: list[str]) -> list[Device]:
-    return [dev for dev in list_usb_devices() if dev["cdc_path"] in cdc_paths]
+    return [dev for dev in device_inventory.list() if dev["cdc_path"] in cdc_paths]
@@ -57,7 +57,7 @@ class ESCP_ResponseParser:
 
         def __call__(self, data: bytes) -> list[str]:  # type: ignore[override]
             int_data = int.from_bytes(data, "big")
-            return [msg for bit, msg in self.possible_values.items() if int_data & (1 << bit)]
+            return [msg for mask, msg in self.possible_values.items() if int_data & mask]
 
     @dataclasses.dataclass
     class MediaSizeParser(ChunkParser):
@@ -174,6 +174,107 @@ class ESCP_ResponseParser:
         return collected_data
 
 
+class ESCP_CompiledResponseParser:
+    """
+    Same result as ESCP_ResponseParser, but decodes with a precomputed struct layout and per-field lookup tables.
+
+    Usage:
+        parser = ESCP_CompiledResponseParser(ESCP_ResponseParser.RESP_PARSE_MAP)
+        parser.parse_response(data)  # a single status packet
+
+        # Continuous status monitoring
+        buffer = b""
+        while chunk := dev.read(...):
+            responses, buffer = parser.parse_stream(buffer + chunk)
+    """
+
+    # Print head mark & size of the status packets, used to find the start of a packet on a stream.
+    HEADER = b"\x80\x20"
+    HEX_TABLE: tuple[str, ...] = tuple(hex(i) for i in range(0x100))
+
+    Decoder = typing.Callable[..., typing.Any]
+
+    def __init__(self, parse_map: list[ESCP_ResponseParser.ChunkParser]) -> None:
+        struct_format = ">"
+        self.fields: list[tuple[str, int, int, ESCP_CompiledResponseParser.Decoder]] = []
+        for parser in parse_map:
+            if not parser.important:
+                struct_format += "x" * parser.size
+                continue
+
+            start = struct_format.count("B")
+            struct_format += "B" * parser.size
+            key = parser.name.lower().replace(" ", "_")
+            self.fields.append((key, start, start + parser.size, self.compile_decoder(parser)))
+
+        self.layout = struct.Struct(struct_format)
+
+    @classmethod
+    def compile_decoder(cls, parser: ESCP_ResponseParser.ChunkParser) -> Decoder:
+        """Builds a function which decodes the unpacked bytes of the field, as same as the parser does."""
+        if isinstance(parser, ESCP_ResponseParser.ErrorParser) and parser.size == 2:
+            # Error bits are looked up per byte, lower byte first to keep the order of ERR_INFOS.
+            high_table = tuple(tuple(parser((i << 8).to_bytes(2, "big"))) for i in range(0x100))
+            low_table = tuple(tuple(parser(i.to_bytes(2, "big"))) for i in range(0x100))
+            return lambda high, low: [*low_table[low], *high_table[high]]
+
+        if isinstance(parser, ESCP_ResponseParser.SimpleChunkParser):
+            hex_table = cls.HEX_TABLE
+            return lambda *values: " ".join([hex_table[v] for v in values])
+
+        if parser.size != 1:
+            return lambda *values: parser(bytes(values))
+
+        def try_parse(value: int) -> typing.Any:
+            try:
+                return parser(bytes([value]))
+            except ValueError:
+                return None
+
+        table = tuple(try_parse(i) for i in range(0x100))
+
+        def lookup(value: int) -> typing.Any:
+            if (resp := table[value]) is None:
+                return parser(bytes([value]))  # raises ValueError
+            return resp
+
+        return lookup
+
+    def _parse_from(self, data: bytes, offset: int) -> ESCP_Response:
+        values = self.layout.unpack_from(data, offset)
+        response = {key: decode(*values[start:stop]) for key, start, stop, decode in self.fields}
+        return typing.cast(ESCP_Response, response)
+
+    def parse_response(self, data: bytes) -> ESCP_Response:
+        if len(data) != self.layout.size:
+            raise ValueError(f"Expected {self.layout.size} bytes, got {len(data)}")
+        return self._parse_from(data, 0)
+
+    def parse_stream(self, data: bytes | bytearray) -> tuple[list[ESCP_Response], bytes]:
+        """
+        Parses every complete status packet on the concatenated data of the reads.
+        Bytes before the packet header and invalid packets are skipped.
+        Returns the responses and the remaining bytes, which should be prepended to the next read.
+        """
+        data = bytes(data)
+        responses: list[ESCP_Response] = []
+        offset = 0
+        while (offset := data.find(self.HEADER, offset)) != -1 and offset + self.layout.size <= len(data):
+            try:
+                responses.append(self._parse_from(data, offset))
+                offset += self.layout.size
+            except ValueError:
+                offset += 1
+
+        if offset == -1:
+            # The last byte may be the start of the next header.
+            return responses, data[-1:] if data.endswith(self.HEADER[:1]) else b""
+        return responses, data[offset:]
+
+
+escp_response_parser = ESCP_CompiledResponseParser(ESCP_ResponseParser.RESP_PARSE_MAP)
+
+
 class ESCP(pydantic.BaseModel):
     """
     ESC/P Script Generator
@@ -231,7 +332,12 @@ class ESCP(pydantic.BaseModel):
             # < ESC 3 LINE_HEIGHT > Adjust line-feed size
             self.escp_context.cmdlist.append(b"\x1B\x33" + bytes([16]))
 
-            image = PIL.ImageOps.invert(image.convert("1").rotate(90, expand=1).resize((410, 480)))
+            bw_img = image if image.mode == "1" else image.convert("1")
+            image = bw_img.rotate(90, expand=1) if self.escp_context.rotate else bw_img
+            if image.size != self.escp_context.page_size:
+                # Labels rendered in the printer's dots (see models.Printer.RenderProfile) are not resampled.
+                image = image.resize(self.escp_context.page_size)
+            image = PIL.ImageOps.invert(image)
             im = image.transpose(PIL.Image.Transpose.ROTATE_270).transpose(PIL.Image.Transpose.FLIP_LEFT_RIGHT)
             width_pixels, height_pixels = im.size
             top, left = 0, 0
@@ -250,6 +356,9 @@ class ESCP(pydantic.BaseModel):
             self.escp_context.cmdlist.append(b"\x1B\x32")
 
     cmdlist: list[bytes] = pydantic.Field(default_factory=list)
+    page_size: tuple[int, int] = (410, 480)  # raster size in dots, after rotating the label to the feed direction
+    # Rotates the label to the feed direction (its height across the print head), unless it's rendered in it.
+    rotate: bool = True
     model_config = pydantic.ConfigDict(arbitrary_types_allowed=True)
 
     @property
@@ -262,8 +371,12 @@ class ESCP(pydantic.BaseModel):
     def __exit__(self, *args: ContextExitArgType) -> None:
         pass
 
+    @property
+    def payload(self) -> bytes:
+        return b"".join(self.cmdlist)
+
     def print(self, cdc_path: str) -> None:
         if not (dev := pathlib.Path(cdc_path)).exists():
             raise FileNotFoundError(f"Device {dev} not found")
 
-        dev.write_bytes(b"".join(self.cmdlist))
+        dev.write_bytes(self.payload)
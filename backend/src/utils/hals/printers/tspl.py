@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import collections
+import io
 import pathlib
-import re
 import types
 import typing
+import zlib
 
 import numpy as np
 import PIL.Image
@@ -13,7 +15,24 @@ ContextExitArgType = tuple[type[BaseException], BaseException, typing.Optional[t
 PrinterDetectMode = typing.Literal[b"AUTO", b"GAP", b"BLINE"] | None
 
 BLUR_KERNEL_SIZE = 127
-BIT_8_CUTTER: re.Pattern[str] = re.compile(pattern="........")
+# Rows of unchanged pixels between the changed regions to merge them into a single BITMAP,
+# as every BITMAP command costs its header and the printer's processing time.
+REGION_MERGE_GAP = 16
+# Byte mode capacities of QR code version 1 ~ 10 per error correction level
+QRCODE_BYTE_CAPACITIES: dict[str, tuple[int, ...]] = {
+    "L": (17, 32, 53, 78, 106, 134, 154, 192, 230, 271),
+    "M": (14, 26, 42, 62, 84, 106, 122, 152, 180, 213),
+    "Q": (11, 20, 32, 46, 60, 74, 86, 108, 130, 151),
+    "H": (7, 14, 24, 34, 44, 58, 64, 84, 98, 119),
+}
+
+BACKGROUND_CACHE_SIZE = 8
+# Files kept on each printer, as the file storage is small and the files on the flash memory are never erased otherwise.
+MAX_STORED_FILES = 8
+
+# File names & pixels of the recently used backgrounds, keyed by id() as PIL images are not hashable.
+# The image is kept along with them, so that the id is not reused while it's cached.
+_backgrounds: collections.OrderedDict[int, tuple[PIL.Image.Image, str, np.ndarray]] = collections.OrderedDict()
 
 
 def align_to_pixelperfect(x: int, y: int, w: int, h: int) -> tuple[int, int, int, int]:
@@ -29,6 +48,71 @@ def align_to_pixelperfect(x: int, y: int, w: int, h: int) -> tuple[int, int, int
     return x, y, w, h
 
 
+def pack_bitmap(image: PIL.Image.Image) -> bytes:
+    bit_arr = np.asarray(image, dtype=np.uint8).reshape(-1)
+    # Trailing bits that cannot fill a whole byte are dropped, as the printer cannot handle them.
+    return np.packbits(bit_arr[: bit_arr.size - bit_arr.size % 8]).tobytes()
+
+
+def get_background(image: PIL.Image.Image) -> tuple[str, np.ndarray]:
+    """Returns the file name and the pixels of the 1-bit background image."""
+    if cached := _backgrounds.get(id(image)):
+        _backgrounds.move_to_end(id(image))
+        return cached[1], cached[2]
+
+    pixels = np.asarray(image)
+    # Name is derived from the content, in 8.3 format, so the changed backgrounds are downloaded again.
+    file_name = f"{zlib.crc32(pixels.tobytes()) ^ zlib.crc32(repr(pixels.shape).encode()):08X}.BMP"
+    _backgrounds[id(image)] = (image, file_name, pixels)
+    if len(_backgrounds) > BACKGROUND_CACHE_SIZE:
+        _backgrounds.popitem(last=False)
+    return file_name, pixels
+
+
+def find_changed_regions(changed: np.ndarray) -> list[tuple[int, int, int, int]]:
+    """Returns (x, y, w, h) boxes covering every changed pixel, with x and w aligned to bytes for BITMAP."""
+    width = changed.shape[1]
+    regions: list[tuple[int, int, int, int]] = []
+    if not (rows := np.flatnonzero(changed.any(axis=1))).size:
+        return regions
+
+    # Splits the changed rows into bands where the unchanged gap is larger than REGION_MERGE_GAP.
+    band_breaks = np.flatnonzero(np.diff(rows) > REGION_MERGE_GAP + 1)
+    for top, bottom in zip(rows[np.r_[0, band_breaks + 1]], rows[np.r_[band_breaks, rows.size - 1]]):
+        cols = np.flatnonzero(changed[top : bottom + 1].any(axis=0))  # noqa: E203
+        x = int(cols[0]) - int(cols[0]) % 8
+        w = min(-(-(int(cols[-1]) + 1 - x) // 8) * 8, width)
+        regions.append((max(min(x, width - w), 0), int(top), w, int(bottom) + 1 - int(top)))
+    return regions
+
+
+class TSPLQRCode(pydantic.BaseModel):
+    """QR code drawn by the printer, placed on the center of the box"""
+
+    x: int
+    y: int
+    size: int  # width & height of the box in dots
+    data: str
+    ecc_level: typing.Literal["L", "M", "Q", "H"] = "H"
+
+    @property
+    def cell_width(self) -> int:
+        data_len = len(self.data.encode())
+        capacities = QRCODE_BYTE_CAPACITIES[self.ecc_level]
+        if (version := next((v for v, cap in enumerate(capacities, start=1) if data_len <= cap), None)) is None:
+            raise ValueError(f"QR code data is too long: {data_len} bytes")
+        return max(self.size // (17 + 4 * version), 1)
+
+    @property
+    def command(self) -> bytes:
+        # Auto encoding mode may select a smaller version than the byte mode, which is still fit in the box.
+        modules_size = self.size - self.size % self.cell_width
+        x, y = self.x + (self.size - modules_size) // 2, self.y + (self.size - modules_size) // 2
+        # Double quotes end the string on TSPL, so they're escaped as \["].
+        data = self.data.replace('"', '\\["]')
+        return f'QRCODE {x},{y},{self.ecc_level},{self.cell_width},A,0,"{data}"'.encode()
+
+
 class TSPL(pydantic.BaseModel):
     """
     TSPL Script Generator
@@ -76,19 +160,37 @@ class TSPL(pydantic.BaseModel):
         def build_exit_cmds(self) -> list[bytes]:
             return []
 
-        def write_image(self, image: PIL.Image.Image) -> None:
-            bw_img = image.convert("1")
-            bit_arr_str = "".join(map(str, np.array(bw_img, dtype=int).flatten(order="c")))
-            img_hex_num_str = b"".join(
-                map(lambda x: int(x, 2).to_bytes(length=1, byteorder="little"), BIT_8_CUTTER.findall(bit_arr_str))
-            )
+        def write_image(self, image: PIL.Image.Image, x: int = 0, y: int = 0) -> None:
+            bw_img = image if image.mode == "1" else image.convert("1")
 
             # BITMAP x, y, width, height, mode, bitmap data
             # mode: 0 = overwrite / 1 = OR / 2 = XOR
             self.tspl_context.cmdlist.append(
-                f"BITMAP 0,0,{int(bw_img.size[0] / 8)},{bw_img.size[1]},0,".encode() + img_hex_num_str
+                f"BITMAP {x},{y},{int(bw_img.size[0] / 8)},{bw_img.size[1]},0,".encode() + pack_bitmap(bw_img)
             )
 
+        def write_composed_image(
+            self, image: PIL.Image.Image, background: PIL.Image.Image, qrcode: TSPLQRCode | None = None
+        ) -> None:
+            """
+            Draws the image as the background stored on the printer, the cropped regions different from it,
+            and the QR code drawn by the printer, so that only the variable parts are sent for each label.
+            Background must be the same size as the image, and be blank on the QR code box.
+            """
+            bw_img = image if image.mode == "1" else image.convert("1")
+            bw_background = background if background.mode == "1" else background.convert("1")
+            background_file, background_pixels = self.tspl_context.download_image(bw_background)
+            self.tspl_context.cmdlist.append(f'PUTBMP 0,0,"{background_file}"'.encode())
+
+            changed = np.asarray(bw_img) != background_pixels
+            if qrcode:
+                changed[qrcode.y : qrcode.y + qrcode.size, qrcode.x : qrcode.x + qrcode.size] = False  # noqa: E203
+            for x, y, w, h in find_changed_regions(changed):
+                self.write_image(bw_img.crop((x, y, x + w, y + h)), x=x, y=y)
+
+            if qrcode:
+                self.tspl_context.cmdlist.append(qrcode.command)
+
     cmdlist: list[bytes] = pydantic.Field(default_factory=list)
 
     size: tuple[float, float] = (80, 40)  # in mm
@@ -101,10 +203,24 @@ class TSPL(pydantic.BaseModel):
     direction: typing.Literal["FORWARD", "BACKWARD"] = "FORWARD"
     mirror: bool = False
 
+    # Identifier of the printer which has the stored_files. Files are downloaded every time if not set.
+    printer_id: str | None = None
+    # Files stored on the printer by the previous jobs, least recently used first, which are KILLed when the printer
+    # has MAX_STORED_FILES files. Recorded by the caller, see models.Printer.async_print_image.
+    stored_files: list[str] = pydantic.Field(default_factory=list)
+    # Files stored on the flash memory survive the power cycle of the printer, unlike the DRAM.
+    # Without printer_id, files are not reused, so they're always stored on the DRAM.
+    file_storage: typing.Literal["DRAM", "FLASH"] = "FLASH"
+
     auto_detect: bool = False
     gap_detect: bool = False
     bline_detect: bool = False
 
+    # Files used by this job, which are recorded as recently used on the printer after the job is sent.
+    _used_files: dict[str, None] = pydantic.PrivateAttr(default_factory=dict)
+    # Files KILLed by this job, which are unrecorded from the printer after the job is sent.
+    _killed_files: set[str] = pydantic.PrivateAttr(default_factory=set)
+
     model_config = pydantic.ConfigDict(arbitrary_types_allowed=True)
 
     @property
@@ -122,8 +238,48 @@ class TSPL(pydantic.BaseModel):
         self.cmdlist.extend(INITIAL_END_CMD)
         pass
 
+    def download_image(self, image: PIL.Image.Image) -> tuple[str, np.ndarray]:
+        """
+        Downloads the 1-bit image as a BMP file to the printer if it's not downloaded yet.
+        Returns the file name and the pixels of the image.
+        """
+        file_name, pixels = get_background(image)
+        stored = set(self.stored_files) - self._killed_files if self.printer_id else set()
+        if file_name in stored or file_name in self._used_files:
+            self._used_files[file_name] = None
+            return file_name, pixels
+
+        storage = "F," if self.printer_id and self.file_storage == "FLASH" else ""
+        if self.printer_id:
+            # Least recently used files are erased to make room, except the ones used by this job.
+            evictable = [f for f in self.stored_files if f in stored and f not in self._used_files]
+            for evicted in evictable[: max(len(stored | self._used_files.keys()) + 1 - MAX_STORED_FILES, 0)]:
+                self.cmdlist.append(f'KILL {storage}"{evicted}"'.encode())
+                self._killed_files.add(evicted)
+
+        with io.BytesIO() as output:
+            image.save(output, format="BMP")
+            bmp = output.getvalue()
+        self.cmdlist.append(f'DOWNLOAD {storage}"{file_name}",{len(bmp)},'.encode() + bmp)
+        self._used_files[file_name] = None
+        return file_name, pixels
+
+    @property
+    def used_files(self) -> list[str]:
+        """Files used by this job, in the order of use, including the ones downloaded by it"""
+        return list(self._used_files)
+
+    @property
+    def killed_files(self) -> list[str]:
+        """Files KILLed by this job, which may include the ones downloaded again by it"""
+        return sorted(self._killed_files)
+
+    @property
+    def payload(self) -> bytes:
+        return b"\r\n".join(self.cmdlist) + b"\r\n"
+
     def print(self, cdc_path: str) -> None:
         if not (dev := pathlib.Path(cdc_path)).exists():
             raise FileNotFoundError(f"Device {dev} not found")
 
-        dev.write_bytes(b"\r\n".join(self.cmdlist) + b"\r\n")
+        dev.write_bytes(self.payload)
@@ -1,7 +1,9 @@
+import time
 import typing
 
 import pydantic
 import serial
+import src.tracing as tracing
 
 ParityType = typing.Literal["N", "E", "O", "M", "S"]
 
@@ -28,9 +30,14 @@ class SerialInfo(pydantic.BaseModel):
         try:
             with self.serial as serial_device:
                 while read_data := serial_device.read():
+                    if not collected_data:
+                        read_started_at = time.time_ns()
                     collected_data += read_data.decode()
                     if collected_data.endswith(("\n", "\r", "\0")):
-                        callback(collected_data)
+                        # Trace of a scan starts from the first byte of the scanned data.
+                        with tracing.trace("qrcode.scan", start_ns=read_started_at, port=self.port):
+                            tracing.record_span("qrcode.serial_read", read_started_at, time.time_ns())
+                            callback(collected_data)
                         collected_data = ""
         except serial.SerialException as e:
             raise SerialInfoError(f"Error while reading data from serial port: {e}") from e
@@ -1,15 +1,51 @@
-import functools
+import asyncio
+import hashlib
+import html as html_utils
 import io
+import logging
+import os
+import pathlib
 
 import async_lru
 import jinja2
+import numpy as np
 import PIL.Image
+import PIL.ImageChops
 import playwright.async_api
+import pydantic
+import src.executors as executors
+import src.metrics as metrics
+import src.static_assets as static_assets
+import src.tracing as tracing
 
+logger = logging.getLogger(__name__)
 
-@functools.lru_cache(maxsize=32)
-def get_template_obj(template: str) -> jinja2.Template:
-    return jinja2.Template(
+TEMPLATE_DIR = pathlib.Path("src/templates")
+TEMPLATE_SUFFIX = ".html"
+THUMBNAIL_MAX_SIZE = (320, 320)  # px
+# Attaches the layout of the template to the rendered labels, so that the printers supporting it (TSPL) can keep the
+# static background on the printer and receive only the variable parts. Costs two more renders per template.
+LABEL_COMPOSITION = os.getenv("LABEL_COMPOSITION", "false").lower() == "true"
+# Different payloads of the same length, to find the QR code box of a template from the difference of the renders.
+LAYOUT_QRCODE_DATA = ("A" * 22, "_" * 22)
+LABEL_SIZE_CONTEXT_KEYS = ("width", "height")
+# Labels of a batch are rendered as the frames stacked on a single page, which is captured at once.
+SPRITE_SHEET_HTML = """<!DOCTYPE html>
+<html>
+<head>
+  <style>
+    body {{ margin: 0; }}
+    #sheet {{ width: fit-content; }}
+    iframe {{ display: block; border: 0; }}
+  </style>
+</head>
+<body><div id="sheet">{frames}</div></body>
+</html>"""
+SPRITE_FRAME_HTML = '<iframe style="width: {width}px; height: {height}px" srcdoc="{srcdoc}"></iframe>'
+
+
+def build_template_obj(template: str) -> jinja2.Template:
+    template_obj = jinja2.Template(
         source=template,
         trim_blocks=True,
         lstrip_blocks=True,
@@ -17,29 +53,294 @@ def get_template_obj(template: str) -> jinja2.Template:
         variable_start_string='"{{',
         variable_end_string='}}"',
     )
+    # Fingerprinted URLs let the browser keep the scripts in its cache, instead of revalidating them on every render.
+    template_obj.globals["static_url"] = static_assets.static_assets.url
+    return template_obj
+
+
+class TemplateEntry(pydantic.BaseModel):
+    name: str
+    path: pathlib.Path
+    digest: str
+    mtime_ns: int
+    template: jinja2.Template
+
+    model_config = pydantic.ConfigDict(arbitrary_types_allowed=True, frozen=True)
+
+    @classmethod
+    def from_path(cls, path: pathlib.Path) -> "TemplateEntry":
+        source = path.read_bytes()
+        return cls(
+            name=path.stem,
+            path=path,
+            digest=hashlib.sha256(source).hexdigest(),
+            mtime_ns=path.stat().st_mtime_ns,
+            template=build_template_obj(source.decode("utf-8")),
+        )
+
+    @property
+    def version(self) -> str:
+        return f"{self.name}@{self.digest[:12]}"
+
+
+class TemplateRegistry(pydantic.BaseModel):
+    """
+    Preloaded & compiled templates, keyed by the template file name without suffix.
+
+    Usage:
+        template_registry.load()  # on startup
+        template_registry.get("nameplate_label").template.render(...)
+        await template_registry.watch()  # reloads templates when the files change
+    """
+
+    directory: pathlib.Path = TEMPLATE_DIR
+    entries: dict[str, TemplateEntry] = pydantic.Field(default_factory=dict)
+
+    def load(self) -> None:
+        self.entries = {path.stem: TemplateEntry.from_path(path) for path in self._iter_template_paths()}
+        logger.info(f"Loaded templates: {', '.join(entry.version for entry in self.entries.values())}")
+
+    def scan_changes(self) -> tuple[dict[str, TemplateEntry], set[str], list[str]]:
+        """
+        Compiles the changed templates without modifying the entries, so that it can be run off the event loop.
+        Returns the new & updated entries, the names of the removed ones, and the names whose content changed.
+        """
+        entries = dict(self.entries)  # get() may add entries on the event loop meanwhile
+        current_paths = {path.stem: path for path in self._iter_template_paths()}
+        updated: dict[str, TemplateEntry] = {}
+        removed = entries.keys() - current_paths.keys()
+        changed: list[str] = sorted(removed)
+
+        for name, path in current_paths.items():
+            entry = entries.get(name)
+            if entry and entry.mtime_ns == path.stat().st_mtime_ns:
+                continue
+
+            new_entry = TemplateEntry.from_path(path)
+            if not entry or entry.digest != new_entry.digest:
+                changed.append(name)
+            updated[name] = new_entry
+        return updated, removed, changed
+
+    def apply_changes(self, updated: dict[str, TemplateEntry], removed: set[str], changed: list[str]) -> None:
+        for name in removed:
+            self.entries.pop(name, None)
+        self.entries.update(updated)
+        if changed:
+            logger.info(f"Reloaded templates: {', '.join(changed)}")
+
+    def reload_changed(self) -> list[str]:
+        updated, removed, changed = self.scan_changes()
+        self.apply_changes(updated, removed, changed)
+        return changed
+
+    def get(self, name: str) -> TemplateEntry:
+        if name not in self.entries:
+            # Templates can be requested before the startup preloading (e.g. in CLI tools)
+            self.entries[name] = TemplateEntry.from_path(self.directory / f"{name}{TEMPLATE_SUFFIX}")
+        return self.entries[name]
+
+    async def watch(self) -> None:
+        import watchfiles  # inotify based on Linux, installed along with uvicorn[standard]
+
+        async for _ in watchfiles.awatch(self.directory):
+            try:
+                # Templates are compiled on a thread, but the entries are only modified on the event loop.
+                self.apply_changes(*await asyncio.to_thread(self.scan_changes))
+            except Exception as e:
+                logger.warning(f"Failed to reload templates: {e}")
+
+    def _iter_template_paths(self) -> list[pathlib.Path]:
+        return sorted(self.directory.glob(f"*{TEMPLATE_SUFFIX}"))
+
+
+template_registry = TemplateRegistry()
+
+
+async def _screenshot(
+    browser: playwright.async_api.Browser, html: str, element: str | None, device_scale_factor: float
+) -> bytes:
+    with tracing.span("render_html.page"), metrics.RENDER_HTML_PAGE_SECONDS.time():
+        # Screenshot is taken in device pixels, so the scale factor renders the label directly in the printer's dots.
+        page = await browser.new_page(device_scale_factor=device_scale_factor)
+        await page.set_content(html=html, wait_until="networkidle")
+        result = await (page.locator(element) if element else page).screenshot(type="png", omit_background=True)
+        await page.close()
+        return result
 
 
 @async_lru.alru_cache(maxsize=64)
-async def _render_html(browser: playwright.async_api.Browser, html: str, element: str | None = None) -> bytes:
-    page = await browser.new_page()
-    await page.set_content(html=html, wait_until="networkidle")
-    result = await (page.locator(element) if element else page).screenshot(type="png", omit_background=True)
-    await page.close()
-    return result
+async def _render_html(
+    browser: playwright.async_api.Browser, html: str, element: str | None = None, device_scale_factor: float = 1.0
+) -> PIL.Image.Image:
+    result = await _screenshot(browser, html, element, device_scale_factor)
+    # Screenshot is decoded only once here, and the 1-bit image is passed to the printer drivers as-is.
+    # As the result is cached, callers must not modify the returned image in place.
+    return await executors.image_executor.decode_screenshot(result)
+
+
+@async_lru.alru_cache(maxsize=16)
+async def _render_html_batch(
+    browser: playwright.async_api.Browser,
+    frames: tuple[tuple[str, int, int], ...],  # html, width & height in px of each label
+    device_scale_factor: float = 1.0,
+) -> tuple[PIL.Image.Image, ...]:
+    sheet_html = SPRITE_SHEET_HTML.format(
+        frames="".join(
+            SPRITE_FRAME_HTML.format(width=width, height=height, srcdoc=html_utils.escape(html))
+            for html, width, height in frames
+        )
+    )
+    sheet = await executors.image_executor.decode_screenshot(
+        await _screenshot(browser, sheet_html, "#sheet", device_scale_factor)
+    )
+
+    # Frames are stacked from the top left, so each label is sliced at the sum of the heights of the previous ones.
+    pixels = np.asarray(sheet)
+    images: list[PIL.Image.Image] = []
+    top = 0
+    for _, width, height in frames:
+        rows = slice(round(top * device_scale_factor), round((top + height) * device_scale_factor))
+        images.append(PIL.Image.fromarray(pixels[rows, : round(width * device_scale_factor)]))
+        top += height
+    return tuple(images)
+
+
+def rotate_image(image: PIL.Image.Image) -> PIL.Image.Image:
+    # Transposing moves the pixels without resampling, unlike rotating by an arbitrary angle.
+    return image.transpose(PIL.Image.Transpose.ROTATE_90)
+
+
+class LabelLayout(pydantic.BaseModel):
+    """Static parts of a template, which are the same on every label rendered from it"""
+
+    background: PIL.Image.Image  # 1-bit image, blank on the variable parts and the QR code box
+    qrcode_box: tuple[int, int, int] | None  # x, y, size
+
+    model_config = pydantic.ConfigDict(arbitrary_types_allowed=True, frozen=True)
+
+
+@async_lru.alru_cache(maxsize=16)
+async def get_label_layout(
+    browser: playwright.async_api.Browser,
+    template_id: str,
+    template_version: str,
+    size_context: tuple[tuple[str, str], ...],
+    element: str | None = None,
+    device_scale_factor: float = 1.0,
+    rotate: bool = False,
+) -> LabelLayout:
+    # template_version is only for the cache key, so that the layout is built again when the template is changed.
+    # size_context is the context which decides the size of the label (e.g. width and height), as a hashable key.
+    template = template_registry.get(template_id).template
+    first, second = [
+        await _render_html(
+            browser, template.render(**dict(size_context), qrcode_data=data), element, device_scale_factor
+        )
+        for data in LAYOUT_QRCODE_DATA
+    ]
+    if rotate:
+        first, second = rotate_image(first), rotate_image(second)
+
+    background, qrcode_box = first.copy(), None
+    if bbox := PIL.ImageChops.logical_xor(first, second).getbbox():
+        x, y = bbox[:2]
+        size = max(bbox[2] - x, bbox[3] - y)
+        background.paste(255, (x, y, x + size, y + size))
+        qrcode_box = (x, y, size)
+    return LabelLayout(background=background, qrcode_box=qrcode_box)
 
 
 async def render_html(
-    browser: playwright.async_api.Browser, template: str, context: dict[str, str], element: str | None = None
-) -> bytes:
+    browser: playwright.async_api.Browser,
+    template_id: str,
+    context: dict[str, str],
+    element: str | None = None,
+    device_scale_factor: float = 1.0,
+    rotate: bool = False,
+    dpi: int | None = None,
+) -> PIL.Image.Image:
     # As context is a dictionary and lru_cache cannot handle it,
     # we need to build a html first and then lru_cache it with the html
-    html = get_template_obj(template).render(**context)
-    return await _render_html(browser=browser, html=html, element=element)
+    with tracing.span("render_html", template=template_id), metrics.RENDER_HTML_SECONDS.time(template=template_id):
+        entry = template_registry.get(template_id)
+        html = entry.template.render(**context)
+        image = await _render_html(browser, html, element, device_scale_factor)
+        return await _finish_label(browser, entry, context, image, element, device_scale_factor, rotate, dpi)
+
+
+async def render_html_batch(
+    browser: playwright.async_api.Browser,
+    labels: list[tuple[str, dict[str, str]]],
+    device_scale_factor: float = 1.0,
+    rotate: bool = False,
+    dpi: int | None = None,
+) -> list[PIL.Image.Image]:
+    """
+    Renders the labels (template id & context pairs) on a single page, instead of a page per label.
+    Contexts must have the width and the height, and the templates must place #container of that size
+    on the top left of the body, as the labels are cropped at the frames of that size.
+    """
+    if not labels:
+        return []
+
+    with tracing.span("render_html_batch", labels=len(labels)):
+        entries = [template_registry.get(template_id) for template_id, _ in labels]
+        frames = tuple(
+            (entry.template.render(**context), int(context["width"]), int(context["height"]))
+            for entry, (_, context) in zip(entries, labels)
+        )
+        images = await _render_html_batch(browser, frames, device_scale_factor)
+        return [
+            await _finish_label(browser, entry, context, image, "#container", device_scale_factor, rotate, dpi)
+            for entry, (_, context), image in zip(entries, labels, images)
+        ]
 
 
-def image_to_bw(image: bytes) -> bytes:
+async def _finish_label(
+    browser: playwright.async_api.Browser,
+    entry: TemplateEntry,
+    context: dict[str, str],
+    image: PIL.Image.Image,
+    element: str | None,
+    device_scale_factor: float,
+    rotate: bool,
+    dpi: int | None,
+) -> PIL.Image.Image:
+    # Rotated images are not cached, so that the previews (not rotated) and the prints share the cached renders.
+    # Cached images must not be modified in place, so the metadata of the label is set on a copy of them.
+    if rotate:
+        image = rotate_image(image)
+    elif dpi or LABEL_COMPOSITION:
+        image = image.copy()
+    if dpi:
+        image.info["dpi"] = (dpi, dpi)
+    if LABEL_COMPOSITION:
+        size_context = tuple((k, context[k]) for k in LABEL_SIZE_CONTEXT_KEYS if k in context)
+        image.info["label_layout"] = await get_label_layout(
+            browser, entry.name, entry.version, size_context, element, device_scale_factor, rotate
+        )
+        image.info["qrcode_data"] = context.get("qrcode_data")
+    return image
+
+
+@tracing.span("image_to_bw")
+@metrics.IMAGE_TO_BW_SECONDS.time()
+def image_to_bw(image: bytes) -> PIL.Image.Image:
     with io.BytesIO(image) as input:
         with PIL.Image.open(input) as img:
-            with io.BytesIO() as output:
-                img.convert("1", dither=PIL.Image.Dither.NONE).save(output, format="PNG")
-                return output.getvalue()
+            return img.convert("1", dither=PIL.Image.Dither.NONE)
+
+
+def image_to_png(image: PIL.Image.Image) -> bytes:
+    with io.BytesIO() as output:
+        # Physical size of the label, if it's rendered for a printer of the known DPI.
+        image.save(output, format="PNG", **({"dpi": image.info["dpi"]} if "dpi" in image.info else {}))
+        return output.getvalue()
+
+
+def image_to_thumbnail(image: PIL.Image.Image, max_size: tuple[int, int] = THUMBNAIL_MAX_SIZE) -> PIL.Image.Image:
+    # 1-bit images are resampled with the nearest neighbor filter, so we need to convert it to grayscale first.
+    thumbnail = image.convert("L")
+    thumbnail.thumbnail(max_size)
+    return thumbnail
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+import os
+import time
+import typing
+
+import httpx
+import playwright.async_api
+import pydantic
+import src.executors as executors
+import src.models as models
+import src.redis_client as redis_client
+import src.static_assets as static_assets
+import src.utils.hals as hals
+import src.utils.renderers.html_renderer as html_renderer
+
+# Templates load their scripts from the API server itself (STATIC_BASE_URL),
+# so the pre-rendering waits until a static file of the templates is served from there.
+WARM_UP_STATIC_TIMEOUT = float(os.getenv("WARM_UP_STATIC_TIMEOUT", "10"))
+WARM_UP_RENDER_CONTEXT: dict[str, str] = {
+    "user_name": "POCA",
+    "user_org": "POCA",
+    "option_name": "POCA",
+    "option_value": "POCA",
+    "qrcode_data": "AAAAAAAAAAAAAAAAAAAAAA",
+}
+
+logger = logging.getLogger(__name__)
+
+WarmUpStepStatus = typing.Literal["pending", "done", "skipped", "failed"]
+
+
+class WarmUpStep(pydantic.BaseModel):
+    status: WarmUpStepStatus = "pending"
+    elapsed_ms: float | None = None
+    detail: str | None = None
+
+
+class WarmUp(pydantic.BaseModel):
+    """
+    Warms up the slow paths of the first label on startup, and reports the progress for the health check.
+
+    Usage:
+        app.state.warm_up = warm_up = WarmUp()
+        task = asyncio.create_task(warm_up.run(redis_cli, browser))  # after the server started to listen
+        warm_up.ready  # True after every step is finished, even if some of them failed
+    """
+
+    started_at: datetime.datetime = pydantic.Field(default_factory=datetime.datetime.now)
+    finished_at: datetime.datetime | None = None
+    steps: dict[str, WarmUpStep] = pydantic.Field(
+        default_factory=lambda: {name: WarmUpStep() for name in ("devices", "shop_api", "image_executor", "render")}
+    )
+
+    @property
+    def ready(self) -> bool:
+        return self.finished_at is not None
+
+    async def run(self, redis_cli: redis_client.AsyncRedisSession, browser: playwright.async_api.Browser) -> None:
+        # Steps don't depend on each other, and the device listing is mostly waiting for the subprocesses.
+        await asyncio.gather(
+            self._run_step("devices", self.warm_up_devices()),
+            self._run_step("shop_api", self.warm_up_shop_api(redis_cli)),
+            self._run_step("image_executor", executors.image_executor.warm_up()),
+            self._run_step("render", self.warm_up_render(browser)),
+        )
+        self.finished_at = datetime.datetime.now()
+        logger.info(f"Warmed up in {(self.finished_at - self.started_at).total_seconds():.2f}s")
+
+    async def _run_step(self, name: str, coro: typing.Awaitable[str | None]) -> None:
+        started_at = time.perf_counter()
+        try:
+            detail = await coro
+            self.steps[name] = WarmUpStep(status="skipped" if detail else "done", detail=detail)
+        except Exception as e:
+            logger.warning(f"Failed to warm up {name}: {e!r}")
+            self.steps[name] = WarmUpStep(status="failed", detail=repr(e))
+        self.steps[name].elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+    async def warm_up_devices(self) -> None:
+        await asyncio.to_thread(hals.device_inventory.refresh)
+
+    async def warm_up_shop_api(self, redis_cli: redis_client.AsyncRedisSession) -> str | None:
+        if not (app_state_data := await redis_cli.get(redis_client.RedisKey.PUBSUB_CHANNEL)):
+            return "Shop API is not configured yet"
+        await models.shop_api_client_pool.warm_up(models.AppState.load_from_storage(app_state_data).shop_api)
+        return None
+
+    async def warm_up_render(self, browser: playwright.async_api.Browser) -> None:
+        static_url = static_assets.static_assets.url("mvp.css")
+        async with httpx.AsyncClient() as client:
+            deadline = time.monotonic() + WARM_UP_STATIC_TIMEOUT
+            while time.monotonic() < deadline:
+                try:
+                    (await client.get(static_url)).raise_for_status()
+                    break
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.2)
+            else:
+                logger.warning(f"{static_url} is not reachable, pre-rendering without the static files")
+
+        for template_id in html_renderer.template_registry.entries:
+            await html_renderer.render_html(browser, template_id, WARM_UP_RENDER_CONTEXT, element="#container")
@@ -0,0 +1,55 @@
+import typing
+import uuid
+
+import fakeredis
+import pytest
+import pytest_asyncio
+import redis.asyncio as aioredis
+import src.dependencies as deps
+import src.redis_client as redis_client
+
+
+@pytest_asyncio.fixture(params=["lock", "optimistic"])
+async def redis_cli(
+    request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch
+) -> typing.AsyncIterator[aioredis.Redis]:
+    monkeypatch.setattr(redis_client, "APP_STATE_WRITE_MODE", request.param)
+    monkeypatch.setattr(deps, "app_state_snapshot_cache", deps.AppStateSnapshotCache())
+    async with fakeredis.aioredis.FakeRedis() as client:
+        yield client
+
+
+async def get_version(redis_cli: aioredis.Redis) -> bytes | None:
+    return await redis_cli.get(redis_client.RedisKey.APP_STATE_VERSION)
+
+
+@pytest.mark.asyncio
+async def test_unchanged_commit_keeps_version_and_snapshot(redis_cli: aioredis.Redis) -> None:
+    async with deps.locked_app_state_context(redis_cli=redis_cli) as app_state:
+        session_id = app_state.create_session().state.id
+    version = await get_version(redis_cli)
+    snapshot = await deps.app_state_snapshot_cache.get(redis_cli)
+
+    # e.g. the websocket polling its session without sending anything
+    async with deps.locked_session_info_context(
+        redis_cli=redis_cli, session_id=session_id, used_as_dependency=False, broadcast=False
+    ):
+        pass
+
+    assert await get_version(redis_cli) == version
+    assert await deps.app_state_snapshot_cache.get(redis_cli) is snapshot
+
+
+@pytest.mark.asyncio
+async def test_changed_commit_increases_version(redis_cli: aioredis.Redis) -> None:
+    async with deps.locked_app_state_context(redis_cli=redis_cli) as app_state:
+        session_id = app_state.create_session().state.id
+    version = await get_version(redis_cli)
+    snapshot = await deps.app_state_snapshot_cache.get(redis_cli)
+
+    async with deps.locked_session_info_context(redis_cli=redis_cli, session_id=session_id) as session_info:
+        session_info.state.unsynced_orders[uuid.uuid4()] = "pending"
+
+    assert int(await get_version(redis_cli)) == int(version) + 1
+    assert (await deps.app_state_snapshot_cache.get(redis_cli)).sessions[session_id].state.unsynced_orders
+    assert not snapshot.sessions[session_id].state.unsynced_orders
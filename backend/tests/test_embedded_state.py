@@ -0,0 +1,43 @@
+import pathlib
+
+import pytest
+import src.embedded_state as embedded_state
+import src.redis_client as redis_client
+
+
+@pytest.mark.parametrize(
+    ("dsn", "path"),
+    [
+        ("sqlite:///state/rosa.sqlite3", pathlib.Path("state/rosa.sqlite3")),
+        ("sqlite:////var/lib/rosa/state.sqlite3", pathlib.Path("/var/lib/rosa/state.sqlite3")),
+        ("sqlite:///state/rosa%20desk.sqlite3", pathlib.Path("state/rosa desk.sqlite3")),
+    ],
+)
+def test_dsn_path(dsn: str, path: pathlib.Path) -> None:
+    assert embedded_state.dsn_path(dsn) == path
+
+
+@pytest.mark.parametrize("dsn", ["sqlite://", "sqlite:///", "sqlite://localhost/rosa.sqlite3"])
+def test_dsn_path_rejects_unshareable_dsn(dsn: str) -> None:
+    with pytest.raises(ValueError):
+        embedded_state.dsn_path(dsn)
+
+
+@pytest.mark.asyncio
+async def test_absolute_dsn_is_opened_on_absolute_path(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    working_dir = tmp_path / "working_dir"
+    working_dir.mkdir()
+    monkeypatch.chdir(working_dir)
+    path = tmp_path / "state" / "rosa.sqlite3"
+
+    client = redis_client.connect(f"sqlite:///{path}")
+    assert isinstance(client, embedded_state.EmbeddedStateClient)
+    try:
+        assert client.path == path
+        await (await client.async_session).set("key", "value")
+        assert await (await client.async_session).get("key") == b"value"
+    finally:
+        await client.close()
+
+    assert path.exists()
+    assert not any(working_dir.iterdir())
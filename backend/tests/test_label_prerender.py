@@ -0,0 +1,45 @@
+import asyncio
+import pathlib
+import typing
+
+import PIL.Image
+import pytest
+import src.cli.label_prerender as label_prerender
+import src.label_store as label_store
+import src.models as models
+import src.utils.renderers.html_renderer as html_renderer
+
+
+@pytest.fixture
+def printer() -> models.Printer:
+    return models.Printer(
+        bus=1,
+        device=2,
+        block_path="/dev/sda",
+        cdc_path="/dev/ttyACM0",
+        name="ESC/P printer",
+        cmd_type="ESCP",
+        render_profile=models.PrinterProfile.RenderProfile(printable_width=480, orientation="portrait"),
+    )
+
+
+def test_stored_escp_payload_is_same_as_printed_one(
+    printer: models.Printer, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    image = PIL.Image.linear_gradient("L").resize(printer.page_size).convert("1")
+
+    async def render_html_batch(*args: typing.Any, **kwargs: typing.Any) -> list[PIL.Image.Image]:
+        return [image]
+
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(label_prerender, "worker_loop", loop)
+    monkeypatch.setattr(label_prerender, "worker_browser", object())
+    monkeypatch.setattr(html_renderer, "render_html_batch", render_html_batch)
+    monkeypatch.setattr(label_store, "label_store", label_store.LabelStore(tmp_path))
+    try:
+        (object_name,) = label_prerender.render_labels(printer.profile, [("nameplate", {})])
+    finally:
+        loop.close()
+
+    stored_payload = label_store.label_store.object_path(object_name).read_bytes()
+    assert stored_payload == printer.encode_label(image).payload
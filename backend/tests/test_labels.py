@@ -0,0 +1,37 @@
+import pytest
+import src.models as models
+import src.routes.labels as labels
+
+
+@pytest.fixture
+def state() -> models.SessionState:
+    return models.SessionState(
+        printer=models.Printer(
+            bus=1,
+            device=2,
+            block_path="/dev/sda",
+            cdc_path="/dev/ttyACM0",
+            name="ESC/P printer",
+            cmd_type="ESCP",
+            label=models.PrinterProfile.Label(width=800, height=400),
+            render_profile=models.PrinterProfile.RenderProfile(printable_width=480, orientation="portrait"),
+        )
+    )
+
+
+def test_preview_is_rendered_as_printed_but_not_rotated(state: models.SessionState) -> None:
+    preview_context, preview_options = labels.get_label_render_params(state, preview=True)
+    print_context, print_options = labels.get_label_render_params(state, preview=False)
+
+    assert preview_context == print_context
+    assert (int(print_context["width"]), int(print_context["height"])) == (800, 400)
+    assert print_options == state.printer_profile.render_options
+    assert print_options.rotate
+    assert preview_options == print_options.model_copy(update={"rotate": False})
+
+
+def test_label_is_rendered_in_css_px_without_printer() -> None:
+    assert labels.get_label_render_params(models.SessionState(), preview=False) == (
+        {"width": "960", "height": "410"},
+        models.RenderOptions(),
+    )
@@ -0,0 +1,88 @@
+import pathlib
+import typing
+
+import fakeredis
+import PIL.Image
+import pytest
+import pytest_asyncio
+import src.models as models
+import src.redis_client as redis_client
+import src.utils.hals.printers.tspl as tspl_utils
+import src.utils.renderers.html_renderer as html_renderer
+
+
+@pytest_asyncio.fixture(params=["redis", "embedded"])
+async def redis_cli(
+    request: pytest.FixtureRequest, tmp_path: pathlib.Path
+) -> typing.AsyncIterator[redis_client.AsyncRedisSession]:
+    if request.param == "redis":
+        async with fakeredis.aioredis.FakeRedis() as client:
+            yield client
+        return
+
+    state_client = redis_client.connect(f"sqlite:///{tmp_path / 'state.sqlite3'}")
+    try:
+        yield await state_client.async_session
+    finally:
+        await state_client.close()
+
+
+@pytest.fixture
+def printer(tmp_path: pathlib.Path) -> models.Printer:
+    (cdc_path := tmp_path / "ttyACM0").touch()
+    # Identifier falls back to the device path without the serial number.
+    return models.Printer(bus=1, device=2, block_path="/dev/sda", cdc_path=str(cdc_path), name="TSPL", cmd_type="TSPL")
+
+
+def composed_label(background: PIL.Image.Image) -> PIL.Image.Image:
+    image = background.copy()
+    image.paste(0, (0, 0, 8, 8))
+    image.info["label_layout"] = html_renderer.LabelLayout(background=background, qrcode_box=None)
+    return image
+
+
+@pytest.mark.asyncio
+async def test_stored_files_are_shared_by_the_workers(
+    redis_cli: redis_client.AsyncRedisSession, printer: models.Printer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(tspl_utils, "MAX_STORED_FILES", 1)
+    first, second = PIL.Image.new("1", (64, 32), 1), PIL.Image.new("1", (64, 32), 0)
+    first_file, second_file = tspl_utils.get_background(first)[0], tspl_utils.get_background(second)[0]
+    payload_path = pathlib.Path(printer.cdc_path)
+
+    await printer.async_print_image(composed_label(first), redis_cli)
+    assert f'DOWNLOAD F,"{first_file}"'.encode() in payload_path.read_bytes()
+    await printer.async_print_image(composed_label(first), redis_cli)
+    assert b"DOWNLOAD" not in payload_path.read_bytes()
+
+    # Another worker KILLs the first background to make room for its own,
+    # so the first one is downloaded again instead of being put from the erased file.
+    await printer.async_print_image(composed_label(second), redis_cli)
+    assert f'KILL F,"{first_file}"'.encode() in payload_path.read_bytes()
+    await printer.async_print_image(composed_label(first), redis_cli)
+    assert f'DOWNLOAD F,"{first_file}"'.encode() in payload_path.read_bytes()
+    assert f'KILL F,"{second_file}"'.encode() in payload_path.read_bytes()
+
+    key = redis_client.RedisKey.PRINTER_FILES.format(printer=printer.identifier)
+    assert await redis_cli.zrangebyscore(key, "-inf", "+inf") == [first_file.encode()]
+
+
+@pytest.mark.asyncio
+async def test_files_of_failed_job_are_downloaded_again(
+    redis_cli: redis_client.AsyncRedisSession, printer: models.Printer
+) -> None:
+    background = PIL.Image.new("1", (64, 32), 1)
+    await printer.async_print_image(composed_label(background), redis_cli)
+
+    pathlib.Path(printer.cdc_path).unlink()
+    with pytest.raises(FileNotFoundError):
+        await printer.async_print_image(composed_label(background), redis_cli)
+
+    pathlib.Path(printer.cdc_path).touch()
+    await printer.async_print_image(composed_label(background), redis_cli)
+    assert b"DOWNLOAD" in pathlib.Path(printer.cdc_path).read_bytes()
+
+
+def test_label_is_written_as_a_whole_without_stored_files(printer: models.Printer) -> None:
+    driver_ctx = printer.encode_label(composed_label(PIL.Image.new("1", (64, 32), 1)))
+    assert not any(cmd.startswith((b"DOWNLOAD", b"PUTBMP")) for cmd in driver_ctx.cmdlist)
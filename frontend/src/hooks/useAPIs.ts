@@ -2,7 +2,7 @@ import { useMutation, useSuspenseQuery } from '@tanstack/react-query'
 import * as R from 'remeda'
 
 import { LOCAL_STORAGE_SESSION_ID_KEY } from '../consts/globals'
-import { APIErrorResponseType, DeskStatus, Order, OrderModifyRequest, SessionState, SessionStateConfig, SetDeviceRequest, USBDevice } from '../models'
+import { APIErrorResponseType, DeskStatus, Order, OrderModifyRequest, SessionState, SessionStateConfig, SetDeviceRequest, ShopAPIConnectivity, USBDevice } from '../models'
 import { isAllTrue } from '../utils'
 
 export const DOMAIN = import.meta.env.VITE_POCA_URL
@@ -177,7 +177,7 @@ export const useDeleteDeviceConfigMutation = () =>
 export const useCheckShopAPIConnectionMutation = () =>
   useMutation({
     mutationKey: MUTATION_KEYS.CHECK_SHOP_API_CONNECTION,
-    mutationFn: () => LocalRequest<{ status: boolean }>({ route: 'config/shop-domain/check-connectivity', method: 'GET' }),
+    mutationFn: () => LocalRequest<ShopAPIConnectivity>({ route: 'config/shop-domain/check-connectivity', method: 'GET' }),
   })
 
 export const useSearchOrderMutation = () =>
@@ -2,6 +2,20 @@ export type DeskStatus = 'idle' | 'registering' | 'closed'
 export type OrderProductStatus = 'pending' | 'paid' | 'used' | 'refunded'
 export type PaymentHistoryStatus = 'pending' | 'completed' | 'partial_refunded' | 'refunded'
 export type PrinterCmdType = 'ESCP' | 'TSPL'
+export type OrderSyncStatus = 'pending' | 'failed'
+export type CircuitBreakerState = 'closed' | 'open' | 'half_open'
+
+export type ShopAPIConnectivity = {
+  status: boolean
+  // Circuit breaker of the API worker which answered, which fails the shop requests fast while it's open
+  circuit_breaker: {
+    state: CircuitBreakerState
+    consecutive_failures: number
+    retry_at: number | null
+    concurrency_limit: number
+    in_flight: number
+  }
+}
 
 export type APIErrorResponseType = {
   type: string
@@ -110,6 +124,8 @@ export type SessionState = SessionStateConfig & {
   desk_status: DeskStatus
   order: Order | null
   handled_order: Order[]
+  // Orders whose modifications are not applied to the shop yet, or failed to be applied
+  unsynced_orders: Record<string, OrderSyncStatus>
 
   commit_id: string
 }
@@ -133,6 +149,7 @@ export const INITIAL_APP_SESSION_STATE: SessionState = {
 
   order: null,
   handled_order: [],
+  unsynced_orders: {},
 
   commit_id: '',
 }